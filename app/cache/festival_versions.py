@@ -0,0 +1,48 @@
+import uuid
+
+from fastapi import Request, Response
+
+# Identifies this process, the versions restart from 0 with every process
+BOOT_ID = uuid.uuid4().hex[:8]
+
+
+# Version of the data of every festival, used as ETag by the endpoints read by every client
+# It is bumped by every change of the inscriptions, postes or games of a festival
+class FestivalVersions:
+
+    def __init__(self):
+        self._versions = {}
+        # Bumped by the changes touching every festival
+        self._epoch = 0
+
+    # Function to bump the version of a festival, or of all of them if festival_id is None
+    def bump(self, festival_id: int | None = None):
+        if festival_id is None:
+            self._epoch += 1
+        else:
+            self._versions[festival_id] = self._versions.get(festival_id, 0) + 1
+
+    # Function to get the strong ETag of a payload of a festival
+    # scope names the endpoint, extra the other values the payload depends on (like the user)
+    def etag(self, scope: str, festival_id: int | None, *extra) -> str:
+        parts = [BOOT_ID, str(self._epoch), scope, str(festival_id), str(self._versions.get(festival_id, 0))]
+        parts += [str(value) for value in extra]
+        return '"' + ".".join(parts) + '"'
+
+
+festival_versions = FestivalVersions()
+
+
+# Function to answer a conditional GET before computing the payload
+# The ETag is set on the response, a 304 response is returned if the client already has this version
+def not_modified_response(request: Request, response: Response, etag: str) -> Response | None:
+    response.headers["ETag"] = etag
+    # The clients must check the version before using their copy
+    response.headers["Cache-Control"] = "no-cache"
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return None
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if etag in tags or "*" in tags:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
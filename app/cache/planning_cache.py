@@ -0,0 +1,179 @@
+import asyncio
+import os
+import time
+
+from ..controllers.planning_grid import cell_key, cell_delta, load_festival_slots, poste_target, zone_target, Occupancy, build_postes_grid, build_zones_grid, postes_columnar_grid, zones_columnar_grid
+
+# The planning grids are served from memory when enabled, otherwise they are computed by the database
+ENABLED = os.environ.get("PLANNING_CACHE_ENABLED", "true").lower() == "true"
+# A festival is reloaded after this time, to catch the changes made outside of this process
+TTL_SECONDS = float(os.environ.get("PLANNING_CACHE_TTL_SECONDS", 300))
+
+SELECT_POSTES_QUERY = """
+    SELECT festival_id, poste, max_capacity
+    FROM postes
+    WHERE festival_id = $1
+    ORDER BY poste;
+    """
+SELECT_ZONES_BENEVOLES_QUERY = """
+    SELECT DISTINCT festival_id, zone_plan, zone_benevole_id, zone_benevole
+    FROM csv
+    WHERE a_animer = 'oui'
+    AND festival_id = $1
+    ORDER BY zone_plan, zone_benevole_id, zone_benevole;
+    """
+SELECT_INSCRIPTIONS_QUERY = """
+    SELECT user_id, is_poste, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau
+    FROM inscriptions
+    WHERE festival_id = $1;
+    """
+SELECT_USER_INSCRIPTIONS_QUERY = """
+    SELECT user_id, is_poste, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau
+    FROM inscriptions
+    WHERE festival_id = $1 AND user_id = $2;
+    """
+
+
+# Occupancy of the planning of a festival
+class FestivalPlanning:
+
+    def __init__(self, postes, zones, slots):
+        self.postes = postes
+        self.zones = zones
+        # Number of inscriptions by poste and slot, and by zone benevole and slot
+        self.postes_occupancy = Occupancy([poste_target(row) for row in postes], slots)
+        self.zones_occupancy = Occupancy([zone_target(row) for row in zones], slots)
+        # user_id -> cells in which the user is signed up
+        self.registrations = {}
+        self.loaded_at = time.monotonic()
+
+    def _occupancy(self, key: tuple) -> Occupancy:
+        return self.postes_occupancy if len(key) == 3 else self.zones_occupancy
+
+    # Function to replace the cells of a user and update the counts with the difference
+    # Returns the new count of the cells of the grids that changed
+    def set_user_cells(self, user_id: int, cells: set) -> list:
+        previous = self.registrations.get(user_id, set())
+        for key in previous - cells:
+            self._occupancy(key).add(key, -1)
+        for key in cells - previous:
+            self._occupancy(key).add(key, 1)
+        if cells:
+            self.registrations[user_id] = cells
+        else:
+            self.registrations.pop(user_id, None)
+        return [cell_delta(key, self._occupancy(key).count(key)) for key in previous ^ cells if self._occupancy(key).position(key) is not None]
+
+    def postes_grid(self, user_id: int) -> list:
+        return build_postes_grid(self.postes, self.postes_occupancy, self.registrations.get(user_id, ()))
+
+    def zones_grid(self, user_id: int) -> list:
+        return build_zones_grid(self.zones, self.zones_occupancy, self.registrations.get(user_id, ()))
+
+    def postes_columnar_grid(self, festival_id: int, user_id: int) -> dict:
+        return postes_columnar_grid(festival_id, self.postes, self.postes_occupancy, self.registrations.get(user_id, ()))
+
+    def zones_columnar_grid(self, festival_id: int, user_id: int) -> dict:
+        return zones_columnar_grid(festival_id, self.zones, self.zones_occupancy, self.registrations.get(user_id, ()))
+
+
+# In-process cache of the planning of the festivals
+# A festival is loaded on the first read, then every write of an inscription resyncs the cells of its user
+# Writes touching many users (auto assignment, csv refresh, activation) drop the festival to reload it
+# The users written while a festival is loading are resynced into it before it is kept
+class PlanningCache:
+
+    def __init__(self, ttl_seconds: float, enabled: bool = True):
+        self.enabled = enabled
+        self._ttl_seconds = ttl_seconds
+        self._festivals = {}
+        self._locks = {}
+        # Incremented on every invalidation of a festival, or of all of them, so that a load started before is not kept
+        self._generations = {}
+        self._generation = 0
+        # festival_id -> users whose inscriptions were written while the festival was loading
+        self._pending_users = {}
+
+    def _lock(self, festival_id: int) -> asyncio.Lock:
+        lock = self._locks.get(festival_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[festival_id] = lock
+        return lock
+
+    def _festival_generation(self, festival_id: int) -> tuple:
+        return (self._generation, self._generations.get(festival_id, 0))
+
+    def _fresh(self, festival_id: int):
+        planning = self._festivals.get(festival_id)
+        if planning is not None and time.monotonic() - planning.loaded_at < self._ttl_seconds:
+            return planning
+        return None
+
+    # Function to get the planning of a festival, loaded from the database if needed
+    async def get(self, db, festival_id: int) -> FestivalPlanning:
+        planning = self._fresh(festival_id)
+        if planning is not None:
+            return planning
+        # Only one load per festival, the other requests wait for it
+        async with self._lock(festival_id):
+            planning = self._fresh(festival_id)
+            if planning is not None:
+                return planning
+            generation = self._festival_generation(festival_id)
+            pending = self._pending_users[festival_id] = set()
+            try:
+                planning = FestivalPlanning(
+                    postes=await db.fetch_rows(SELECT_POSTES_QUERY, festival_id),
+                    zones=await db.fetch_rows(SELECT_ZONES_BENEVOLES_QUERY, festival_id),
+                    slots=await load_festival_slots(db, festival_id),
+                )
+                cells = {}
+                for row in await db.fetch_rows(SELECT_INSCRIPTIONS_QUERY, festival_id):
+                    cells.setdefault(row["user_id"], set()).add(cell_key(row))
+                for user_id, user_cells in cells.items():
+                    planning.set_user_cells(user_id, user_cells)
+                # The inscriptions written during the load may have been read before the write, their users are resynced
+                while pending:
+                    user_id = pending.pop()
+                    rows = await db.fetch_rows(SELECT_USER_INSCRIPTIONS_QUERY, festival_id, user_id)
+                    planning.set_user_cells(user_id, {cell_key(row) for row in rows})
+            finally:
+                del self._pending_users[festival_id]
+            if generation == self._festival_generation(festival_id):
+                self._festivals[festival_id] = planning
+            return planning
+
+    # Function to resync the cells of a user after a write of its inscriptions
+    # Returns the cells that changed, or None if the festival is not loaded
+    async def user_changed(self, db, festival_id: int, user_id: int):
+        if festival_id not in self._festivals:
+            # A load in progress resyncs the user before it is kept
+            if festival_id in self._pending_users:
+                self._pending_users[festival_id].add(user_id)
+            return None
+        async with self._lock(festival_id):
+            planning = self._festivals.get(festival_id)
+            if planning is None:
+                return None
+            rows = await db.fetch_rows(SELECT_USER_INSCRIPTIONS_QUERY, festival_id, user_id)
+            return planning.set_user_cells(user_id, {cell_key(row) for row in rows})
+
+    # Function to remove a deleted user from every festival
+    # Returns the cells that changed by festival
+    def remove_user(self, user_id: int) -> dict:
+        for pending in self._pending_users.values():
+            pending.add(user_id)
+        return {festival_id: planning.set_user_cells(user_id, set()) for festival_id, planning in self._festivals.items()}
+
+    # Function to drop a festival, or all of them, they are reloaded on the next read
+    def invalidate(self, festival_id: int | None = None):
+        if festival_id is None:
+            self._generation += 1
+            self._festivals.clear()
+        else:
+            self._generations[festival_id] = self._generations.get(festival_id, 0) + 1
+            self._festivals.pop(festival_id, None)
+
+
+planning_cache = PlanningCache(ttl_seconds=TTL_SECONDS, enabled=ENABLED)
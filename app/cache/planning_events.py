@@ -0,0 +1,150 @@
+import asyncio
+import json
+import os
+import uuid
+
+from ..cache.planning_cache import planning_cache
+from ..cache.festival_versions import festival_versions
+
+# Channel used to tell the other workers that inscriptions changed
+PLANNING_CHANNEL = "planning_changes"
+# The other workers are notified through postgres when enabled, needed when several workers serve the app
+NOTIFY_ENABLED = os.environ.get("PLANNING_NOTIFY_ENABLED", "true").lower() == "true"
+# Number of events kept for a slow client before asking it to reload the whole grid
+QUEUE_SIZE = int(os.environ.get("PLANNING_EVENTS_QUEUE_SIZE", 100))
+
+# Identifies this process in the notifications, to ignore its own ones
+WORKER_ID = uuid.uuid4().hex[:12]
+
+# Sent when the counts cannot be given as deltas, the clients reload the grids
+RESYNC_EVENT = {"type": "resync"}
+
+
+# In-process fan out of the planning events to the clients following a festival
+class PlanningBroadcaster:
+
+    def __init__(self, queue_size: int):
+        self._queue_size = queue_size
+        # festival_id -> queues of the clients
+        self._subscribers = {}
+
+    # Function to follow the events of a festival
+    def subscribe(self, festival_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        self._subscribers.setdefault(festival_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, festival_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(festival_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[festival_id]
+
+    # Function to send an event to the clients of a festival, or of all of them
+    def publish(self, festival_id: int | None, event: dict):
+        if festival_id is None:
+            queues = [queue for festival_queues in self._subscribers.values() for queue in festival_queues]
+        else:
+            queues = self._subscribers.get(festival_id, ())
+        for queue in queues:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The client is too slow, its pending deltas are replaced by a full reload
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC_EVENT)
+
+    def subscribers_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+
+broadcaster = PlanningBroadcaster(queue_size=QUEUE_SIZE)
+# Tasks started by the notifications, kept until they are done
+_tasks = set()
+
+
+# The functions below also bump the versions used as ETag, on every worker
+# Function to resync the cells of a user in the cache and send the deltas to the clients
+# The version is bumped once the cache has the new counts, else a GET could send the old grid under the new ETag
+async def _apply_user_changed(db, festival_id: int, user_id: int):
+    # The write is already committed, a failure of the resync drops the festival instead of failing the request
+    try:
+        deltas = await planning_cache.user_changed(db, festival_id, user_id)
+    except Exception as e:
+        print("Planning events ERROR while resyncing a user, the festival is reloaded: ", e)
+        _apply_invalidated(festival_id)
+        return
+    if deltas is None:
+        # The festival is not cached, the clients reload the grid
+        broadcaster.publish(festival_id, RESYNC_EVENT)
+    elif deltas:
+        broadcaster.publish(festival_id, {"type": "delta", "cells": deltas})
+    festival_versions.bump(festival_id)
+
+
+def _apply_invalidated(festival_id: int | None):
+    festival_versions.bump(festival_id)
+    planning_cache.invalidate(festival_id)
+    broadcaster.publish(festival_id, RESYNC_EVENT)
+
+
+def _apply_user_deleted(user_id: int):
+    festival_versions.bump()
+    for festival_id, deltas in planning_cache.remove_user(user_id).items():
+        if deltas:
+            broadcaster.publish(festival_id, {"type": "delta", "cells": deltas})
+
+
+async def _notify(db, message: dict):
+    if not NOTIFY_ENABLED:
+        return
+    message["worker"] = WORKER_ID
+    try:
+        await db.execute("SELECT pg_notify($1, $2);", PLANNING_CHANNEL, json.dumps(message))
+    except Exception as e:
+        print("Planning events ERROR while notifying: ", e)
+
+
+# Function to call after every write of the inscriptions of a user
+async def inscriptions_changed(db, festival_id: int, user_id: int):
+    await _apply_user_changed(db, festival_id, user_id)
+    await _notify(db, {"type": "user", "festival_id": festival_id, "user_id": user_id})
+
+
+# Function to call after a write touching the plannings of many users, or all festivals if festival_id is None
+async def plannings_invalidated(db, festival_id: int | None = None):
+    _apply_invalidated(festival_id)
+    await _notify(db, {"type": "invalidate", "festival_id": festival_id})
+
+
+# Function to call after the deletion of a user and its inscriptions
+async def user_deleted(db, user_id: int):
+    _apply_user_deleted(user_id)
+    await _notify(db, {"type": "delete", "user_id": user_id})
+
+
+# Function to apply a notification sent by another worker
+def _on_notification(db, payload: str):
+    message = json.loads(payload)
+    if message.get("worker") == WORKER_ID:
+        return
+    if message["type"] == "user":
+        task = asyncio.get_running_loop().create_task(_apply_user_changed(db, message["festival_id"], message["user_id"]))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+    elif message["type"] == "invalidate":
+        _apply_invalidated(message["festival_id"])
+    elif message["type"] == "delete":
+        _apply_user_deleted(message["user_id"])
+
+
+# Function to start listening to the changes made by the other workers
+async def start(db):
+    if not NOTIFY_ENABLED:
+        return
+    try:
+        await db.listen(PLANNING_CHANNEL, lambda payload: _on_notification(db, payload))
+    except Exception as e:
+        print("Planning events ERROR while listening, the other workers changes are only seen after the cache TTL: ", e)
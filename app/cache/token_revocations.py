@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+
+# Channel used to tell the other workers that a token version changed
+REVOCATION_CHANNEL = "token_revocations"
+# Time between two full refreshes of the revocations from the database
+REFRESH_SECONDS = float(os.environ.get("AUTH_REVOCATION_REFRESH_SECONDS", 30))
+
+SELECT_REVOCATIONS_QUERY = """
+    SELECT user_id, token_version, disabled
+    FROM users
+    WHERE token_version > 0 OR disabled = TRUE;
+    """
+# The deleted users are no longer in users, they are kept in deleted_users (see auth.sql)
+SELECT_DELETED_USERS_QUERY = """
+    SELECT user_id, EXTRACT(EPOCH FROM NOW() - deleted_at)::FLOAT AS age
+    FROM deleted_users
+    WHERE deleted_at > NOW() - make_interval(secs => $1);
+    """
+
+
+# Compact in-memory set of the revoked access tokens, used by the stateless token verification
+# A token carries the token_version of its user when it was created.
+# It is revoked if the user is banned or deleted, or if the version of the user was bumped since.
+# Only the users with a bumped version or a ban are kept in memory.
+class TokenRevocations:
+
+    def __init__(self, deleted_ttl_seconds: float):
+        # user_id -> current token version
+        self._versions = {}
+        self._disabled = set()
+        # user_id -> time until which the deleted user is kept (lifetime of a token)
+        self._deleted = {}
+        self._deleted_ttl_seconds = deleted_ttl_seconds
+        self._refresh_task = None
+
+    # Function to check if a token of a user is revoked
+    def is_revoked(self, user_id: int, version: int) -> bool:
+        if user_id in self._disabled:
+            return True
+        if user_id in self._deleted:
+            return True
+        return version < self._versions.get(user_id, 0)
+
+    # Function to record a new token version for a user
+    def revoke(self, user_id: int, version: int):
+        self._versions[user_id] = max(version, self._versions.get(user_id, 0))
+
+    # Function to record a ban
+    def disable(self, user_id: int):
+        self._disabled.add(user_id)
+
+    # Function to record the deletion of a user
+    def delete(self, user_id: int):
+        self._deleted[user_id] = time.monotonic() + self._deleted_ttl_seconds
+
+    # Function to apply a notification sent by another worker
+    # The payload is "user_id:version", "user_id:disabled" or "user_id:deleted"
+    def apply_notification(self, payload: str):
+        user_id, _, value = payload.partition(":")
+        if value == "disabled":
+            self.disable(int(user_id))
+        elif value == "deleted":
+            self.delete(int(user_id))
+        else:
+            self.revoke(int(user_id), int(value))
+
+    # Function to reload the revocations from the database
+    async def refresh(self, db):
+        rows = await db.fetch_rows(SELECT_REVOCATIONS_QUERY)
+        deleted_rows = await db.fetch_rows(SELECT_DELETED_USERS_QUERY, self._deleted_ttl_seconds)
+        versions = {}
+        disabled = set()
+        for row in rows:
+            versions[row["user_id"]] = row["token_version"]
+            if row["disabled"]:
+                disabled.add(row["user_id"])
+        # Keep the bumps made locally since the query started
+        for user_id, version in self._versions.items():
+            if version > versions.get(user_id, 0):
+                versions[user_id] = version
+        self._versions = versions
+        self._disabled = disabled
+        now = time.monotonic()
+        deleted = {row["user_id"]: now + self._deleted_ttl_seconds - row["age"] for row in deleted_rows}
+        # Keep the deletions seen locally or notified since the query started
+        for user_id, until in self._deleted.items():
+            if until > deleted.get(user_id, now):
+                deleted[user_id] = until
+        self._deleted = deleted
+
+    # Function to start keeping the revocations up to date
+    # They are refreshed periodically and on every notification of the other workers
+    async def start(self, db):
+        await self.refresh(db)
+        try:
+            await db.listen(REVOCATION_CHANNEL, self.apply_notification)
+        except Exception as e:
+            print("Token revocations ERROR while listening, only the periodic refresh is used: ", e)
+        self._refresh_task = asyncio.create_task(self._refresh_loop(db))
+
+    async def _refresh_loop(self, db):
+        while True:
+            await asyncio.sleep(REFRESH_SECONDS)
+            try:
+                await self.refresh(db)
+            except Exception as e:
+                print("Token revocations ERROR while refreshing: ", e)
+
+    # Function to stop the periodic refresh
+    def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+
+# A deleted user is remembered for the lifetime of an access token
+token_revocations = TokenRevocations(deleted_ttl_seconds=float(os.environ.get("AUTH_DELETED_USER_TTL_SECONDS", 50 * 60)))
@@ -0,0 +1,89 @@
+import os
+import time
+from collections import OrderedDict
+
+from ..models.user import User
+from ..cache.token_revocations import REVOCATION_CHANNEL
+
+
+# In-process cache of the users used by the authentication
+# The entries are kept for a limited time (TTL) and the least recently used ones are evicted
+# when the cache is full. They are also invalidated explicitly when a user changes,
+# and when another worker bans, deletes or changes the roles of a user (notifications of the token revocations).
+class UserCache:
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # username -> (expires_at, user)
+        self._entries = OrderedDict()
+        # user_id -> username, to invalidate a user by id
+        self._usernames = {}
+        # Incremented on every invalidation, a lookup started before an invalidation is not cached
+        self.generation = 0
+
+    # Function to get a user from the cache, returns None if missing or expired
+    def get(self, username: str) -> User | None:
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            self._remove(username)
+            return None
+        self._entries.move_to_end(username)
+        # Return a copy so that the cached user can not be modified by a request
+        return user.model_copy()
+
+    # Function to put a user in the cache
+    # generation is the value of self.generation before the user was fetched from the database
+    def set(self, user: User, generation: int):
+        if generation != self.generation:
+            return
+        self._remove(user.username)
+        self._entries[user.username] = (time.monotonic() + self.ttl_seconds, user)
+        self._usernames[user.user_id] = user.username
+        while len(self._entries) > self.max_size:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._forget_user_id(evicted)
+
+    # Function to invalidate a user by user_id
+    def invalidate(self, user_id: int):
+        self.generation += 1
+        username = self._usernames.pop(user_id, None)
+        if username is not None:
+            self._entries.pop(username, None)
+
+    # Function to apply a notification of the token revocations sent by another worker
+    # The payload is "user_id:version", "user_id:disabled" or "user_id:deleted"
+    def apply_notification(self, payload: str):
+        user_id, _, _ = payload.partition(":")
+        self.invalidate(int(user_id))
+
+    # Function to start listening to the changes of the users made by the other workers
+    async def start(self, db):
+        try:
+            await db.listen(REVOCATION_CHANNEL, self.apply_notification)
+        except Exception as e:
+            print("User cache ERROR while listening, the other workers changes are only seen after the cache TTL: ", e)
+
+    # Function to empty the cache
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self._usernames.clear()
+
+    def _remove(self, username: str):
+        entry = self._entries.pop(username, None)
+        if entry is not None:
+            self._forget_user_id(entry[1])
+
+    def _forget_user_id(self, user: User):
+        if self._usernames.get(user.user_id) == user.username:
+            del self._usernames[user.user_id]
+
+
+user_cache = UserCache(
+    max_size=int(os.environ.get("USER_CACHE_SIZE", 10000)),
+    ttl_seconds=float(os.environ.get("USER_CACHE_TTL_SECONDS", 60)),
+)
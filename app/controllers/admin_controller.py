@@ -0,0 +1,19 @@
+from ..database.db_session import get_databases
+from ..controllers.password_controller import password_hash_stats
+
+
+# Function to get the statistics of the queries executed by each database pool
+async def get_query_stats(limit: int):
+    return {db.name: db.stats.snapshot(limit) for db in get_databases()}
+
+
+# Function to reset the statistics of the queries
+async def reset_query_stats():
+    for db in get_databases():
+        db.stats.reset()
+    return { "message" :"Query stats reset successfully" }
+
+
+# Function to get the live statistics of the connection pools and of the password hashing pool
+async def get_pool_stats():
+    return {"pools": [db.pool_stats() for db in get_databases()], "password_hash": password_hash_stats()}
@@ -11,12 +11,14 @@ from fastapi.security import (
     SecurityScopes,
 )
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import ValidationError
 from fastapi.responses import JSONResponse
 import os
 
-from ..controllers.user_controller import find_user_by_username, find_user_by_email, create_user
+from ..controllers.password_controller import verify_password, get_password_hash
+from ..controllers.user_controller import find_user_by_username, find_user_and_token_version, find_user_by_username_cached, find_user_by_email, create_user
+from ..database.db import current_user_id
+from ..cache.token_revocations import token_revocations
 
 # Import models
 from ..models.user import User
@@ -34,37 +36,29 @@ from ..models.auth import UserAndToken, TokenData
 SECRET_KEY = os.environ.get("SECRET_KEY")
 ALGORITHM = os.environ.get("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = 50
+# When true, the access tokens are verified without any database lookup:
+# the user is rebuilt from the claims and checked against the revocations
+STATELESS_TOKENS = os.environ.get("AUTH_STATELESS_TOKENS", "false").lower() == "true"
 
 
 
 # Framework for authentication
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearer(
     tokenUrl="auth/token",
     scopes={"User": "Read information about the current user.", "Admin": "Read items."},
 )
 
-# Function to verify the password
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-# Function to hash the password
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
-
 # Function to authenticate the user, check if the user exists and the password is correct
+# Returns the user and its token version, (None, None) if the authentication failed
 async def authenticate_user(username: str, password: str):
-    user = await find_user_by_username(username)
+    user, token_version = await find_user_and_token_version(username)
     if not user:
-        return False
-    if not verify_password(password, user.password):
-        return False
+        return None, None
+    if not await verify_password(password, user.password):
+        return None, None
     user.password = ""
-    return user
+    return user, token_version
 
 
 # This function creates a token, it encodes the payload and signs it with the secret key
@@ -80,23 +74,29 @@ def create_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
+# Function to get the claims of the access token of a user
+# The user_id and token version are read by the stateless verification, the version comes with the lookup of the user
+def access_token_claims(user: User, token_version: int) -> dict:
+    return {"sub": user.username, "scopes": user.roles, "uid": user.user_id, "ver": token_version}
+
 
 async def login_check_user_and_password(username: str, password: str, response: JSONResponse):
     # Authenticate the user (check if the user exists and the password is correct)
-    user = await authenticate_user(username, password)
+    user, token_version = await authenticate_user(username, password)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
     # Create the access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_token(
-        data={"sub": user.username, "scopes": user.roles},
+        data=access_token_claims(user, token_version),
         expires_delta=access_token_expires,
     )
 
     # Create refresh token
+    # It carries the token version, a bump of the version logs out the session (password change...)
     refresh_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES * 5)
     refresh_token = create_token(
-        data={"sub": user.username, "scopes": user.roles},
+        data={"sub": user.username, "scopes": user.roles, "ver": token_version},
         expires_delta=refresh_token_expires,
     )
 
@@ -129,6 +129,7 @@ async def check_refresh_token_and_create_access_token(refresh_token: str | None
         payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         token_scopes = payload.get("scopes", [])
+        refresh_version = payload.get("ver")
         token_data = TokenData(scopes=token_scopes, username=username)
     # Token expired
     except (JWTError, ValidationError):
@@ -138,9 +139,10 @@ async def check_refresh_token_and_create_access_token(refresh_token: str | None
         )
 
     # Get the user from the database
-    user = await find_user_by_username(username=token_data.username)
-    # If the user does not exist, raise an exception
-    if user is None:
+    user, token_version = await find_user_and_token_version(token_data.username)
+    # If the user does not exist or its version was bumped since the refresh token was created, raise an exception
+    # (the refresh tokens created before the version was put in them have no version, they are accepted until they expire)
+    if user is None or (refresh_version is not None and refresh_version < token_version):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
@@ -149,7 +151,7 @@ async def check_refresh_token_and_create_access_token(refresh_token: str | None
     # Create the new access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_token(
-        data={"sub": user.username, "scopes": user.roles},
+        data=access_token_claims(user, token_version),
         expires_delta=access_token_expires,
     )
 
@@ -219,14 +221,39 @@ async def verify_token(
     except (JWTError, ValidationError):
         raise credentials_exception
     
-    # Get the user from the database
-    user = await find_user_by_username(username=token_data.username)
-    if user is None:
-        raise credentials_exception
+    user_id = payload.get("uid")
+    token_version = payload.get("ver")
+    if STATELESS_TOKENS and user_id is not None and token_version is not None:
+        # Stateless verification, the user is rebuilt from the claims without any query
+        if token_revocations.is_revoked(user_id, token_version):
+            raise credentials_exception
+        user = User.model_construct(
+            user_id=user_id,
+            username=token_data.username,
+            password="",
+            email="",
+            telephone="",
+            nom="",
+            prenom="",
+            tshirt="",
+            vegan=False,
+            hebergement="",
+            association="",
+            roles=token_data.scopes,
+            disabled=False
+        )
+    else:
+        # Get the user from the cache or the database
+        user = await find_user_by_username_cached(username=token_data.username)
+        if user is None:
+            raise credentials_exception
 
     # Check if the user is disabled
     if user.disabled:
         raise HTTPException(status_code=400, detail="Banned user")
+
+    # Remember the user of the request, his reads follow his own writes (read replicas)
+    current_user_id.set(user.user_id)
     
     # Check if the token has the required scopes
     for scope in security_scopes.scopes:
@@ -265,7 +292,7 @@ async def register_user(user: User):
     if email_exists:
         return JSONResponse(content={"message": "Email already exists"}, status_code=409)
     # Hash the password
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     user = User(
         username=user.username,
         email=user.email,
@@ -1,20 +1,25 @@
-from ..database.db_session import get_db
+from ..database.db_session import get_db, get_admin_db
 from ..models.festival import Festival
+from ..cache.planning_events import plannings_invalidated
+from ..controllers.planning_grid import JOURS, CRENEAUX
 
 db = get_db()
+# The activation updates whole tables, it runs on the admin pool
+admin_db = get_admin_db()
 
 
 # Function to create a new festival
-async def create_festival(festival_name: str, festival_description: str):
+# The festival has the default jours and creneaux if they are not given
+async def create_festival(festival_name: str, festival_description: str, jours: list[str] | None = None, creneaux: list[str] | None = None):
 
     query = """
-    INSERT INTO festivals (festival_name, festival_description) 
-    VALUES ($1, $2)
+    INSERT INTO festivals (festival_name, festival_description, jours, creneaux) 
+    VALUES ($1, $2, $3, $4)
     ON CONFLICT (festival_name) DO NOTHING
     RETURNING festival_id;"""
 
 
-    result = await db.fetch_val(query, festival_name, festival_description)
+    festival_id = await db.fetch_val(query, festival_name, festival_description, jours or JOURS, creneaux or CRENEAUX)
     
     # Add "Animation" Poste
     query = """
@@ -22,7 +27,8 @@ async def create_festival(festival_name: str, festival_description: str):
     VALUES ($1, 'Animation', 'Poste pour les animations');
     """
     
-    result = await db.execute(query, result)
+    result = await db.execute(query, festival_id)
+    await plannings_invalidated(db, festival_id)
     
 
     return { "message" :"Festival created successfully" }
@@ -35,7 +41,9 @@ async def get_all_festivals():
         festival_id, 
         festival_name, 
         festival_description,
-        is_active
+        is_active,
+        jours,
+        creneaux
     FROM festivals;"""
 
     result = await db.fetch_rows(query)
@@ -43,7 +51,7 @@ async def get_all_festivals():
     to_send = []
     
     for row in result:
-        to_send.append(Festival(festival_id=row["festival_id"], festival_name=row["festival_name"], festival_description=row["festival_description"], is_active=row["is_active"]))
+        to_send.append(Festival(festival_id=row["festival_id"], festival_name=row["festival_name"], festival_description=row["festival_description"], is_active=row["is_active"], jours=row["jours"], creneaux=row["creneaux"]))
 
     return to_send
 
@@ -55,9 +63,24 @@ async def delete_festival(festival_id: int):
     WHERE festival_id = $1;"""
 
     result = await db.execute(query, festival_id)
+    await plannings_invalidated(db, festival_id)
 
     return { "message" :"Festival deleted successfully" }
 
+# Function to change the jours and creneaux of a festival
+# The inscriptions of the jours and creneaux that are removed are kept but no longer shown in the plannings
+async def update_festival_slots(festival_id: int, jours: list[str], creneaux: list[str]):
+
+    query = """
+    UPDATE festivals
+    SET jours = $2, creneaux = $3
+    WHERE festival_id = $1;"""
+
+    result = await db.execute(query, festival_id, jours, creneaux)
+    await plannings_invalidated(db, festival_id)
+
+    return { "message" :"Festival jours and creneaux updated successfully" }
+
 # Function to activate a festival
 async def activate_festival(festival_id: int, is_active: bool):
     
@@ -79,87 +102,91 @@ async def activate_festival(festival_id: int, is_active: bool):
         if result["festival_id"] != festival_id:
             return { "message" :"The festival you want to deactivate is not the active festival" }
 
-    if is_active == False:
-        # Deactivate all inscriptions
-        query = """
-        UPDATE inscriptions
-        SET is_active = FALSE
-        WHERE is_active = TRUE;"""
+    # All of the updates are done in a single transaction
+    async with admin_db.transaction() as tx:
+        if is_active == False:
+            # Deactivate all inscriptions
+            query = """
+            UPDATE inscriptions
+            SET is_active = FALSE
+            WHERE is_active = TRUE;"""
         
-        result = await db.execute(query)
+            result = await tx.execute(query)
         
-        # Deactivate all postes
-        query = """
-        UPDATE postes
-        SET is_active = FALSE
-        WHERE is_active = TRUE;"""
+            # Deactivate all postes
+            query = """
+            UPDATE postes
+            SET is_active = FALSE
+            WHERE is_active = TRUE;"""
         
-        result = await db.execute(query)
+            result = await tx.execute(query)
         
-        # Deactivate all csv (zones benevoles and games)
-        query = """
-        UPDATE csv
-        SET is_active = FALSE
-        WHERE is_active = TRUE;"""
+            # Deactivate all csv (zones benevoles and games)
+            query = """
+            UPDATE csv
+            SET is_active = FALSE
+            WHERE is_active = TRUE;"""
         
-        result = await db.execute(query)
+            result = await tx.execute(query)
         
-        # Deactivate all messages
-        query = """
-        UPDATE messages
-        SET is_active = FALSE
-        WHERE is_active = TRUE;"""
+            # Deactivate all messages
+            query = """
+            UPDATE messages
+            SET is_active = FALSE
+            WHERE is_active = TRUE;"""
         
-        result = await db.execute(query)
+            result = await tx.execute(query)
         
-        # Deactivate all festivals
-        query = """
-        UPDATE festivals
-        SET is_active = FALSE
-        WHERE is_active = TRUE;"""
+            # Deactivate all festivals
+            query = """
+            UPDATE festivals
+            SET is_active = FALSE
+            WHERE is_active = TRUE;"""
         
-        result = await db.execute(query)
+            result = await tx.execute(query)
     
-    if is_active == True:
-        # Activate inscriptions for the festival
-        query = """
-        UPDATE inscriptions
-        SET is_active = TRUE
-        WHERE festival_id = $1;"""
-        
-        result = await db.execute(query, festival_id)
-        
-        # Activate posts for the festival
-        query = """
-        UPDATE postes
-        SET is_active = TRUE
-        WHERE festival_id = $1;"""
-        
-        result = await db.execute(query, festival_id)
-        
-        # Activate csv (zones benevoles and games) for the festival
-        query = """
-        UPDATE csv
-        SET is_active = TRUE
-        WHERE festival_id = $1;"""
+        if is_active == True:
+            # Activate inscriptions for the festival
+            query = """
+            UPDATE inscriptions
+            SET is_active = TRUE
+            WHERE festival_id = $1;"""
+        
+            result = await tx.execute(query, festival_id)
+        
+            # Activate posts for the festival
+            query = """
+            UPDATE postes
+            SET is_active = TRUE
+            WHERE festival_id = $1;"""
+        
+            result = await tx.execute(query, festival_id)
+        
+            # Activate csv (zones benevoles and games) for the festival
+            query = """
+            UPDATE csv
+            SET is_active = TRUE
+            WHERE festival_id = $1;"""
     
-        result = await db.execute(query, festival_id)
+            result = await tx.execute(query, festival_id)
         
-        # Activate messages for the festival
-        query = """
-        UPDATE messages
-        SET is_active = TRUE
-        WHERE festival_id = $1;"""
+            # Activate messages for the festival
+            query = """
+            UPDATE messages
+            SET is_active = TRUE
+            WHERE festival_id = $1;"""
         
-        result = await db.execute(query, festival_id)
+            result = await tx.execute(query, festival_id)
         
-        # Activate the festival
-        query = """
-        UPDATE festivals
-        SET is_active = TRUE
-        WHERE festival_id = $1;"""
+            # Activate the festival
+            query = """
+            UPDATE festivals
+            SET is_active = TRUE
+            WHERE festival_id = $1;"""
 
-        result = await db.execute(query, festival_id)
+            result = await tx.execute(query, festival_id)
+    # The plannings are rebuilt from the activated data
+    await plannings_invalidated(db)
 
     return { "message" :"Festival activated/deactivated successfully" }
 
@@ -172,7 +199,9 @@ async def get_active_festival():
         festival_id, 
         festival_name, 
         festival_description,
-        is_active
+        is_active,
+        jours,
+        creneaux
     FROM festivals
     WHERE is_active = TRUE;"""
 
@@ -181,4 +210,4 @@ async def get_active_festival():
     if result is None:
         return None
     
-    return Festival(festival_id=result["festival_id"], festival_name=result["festival_name"], festival_description=result["festival_description"], is_active=result["is_active"])
\ No newline at end of file
+    return Festival(festival_id=result["festival_id"], festival_name=result["festival_name"], festival_description=result["festival_description"], is_active=result["is_active"], jours=result["jours"], creneaux=result["creneaux"])
\ No newline at end of file
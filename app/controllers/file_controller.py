@@ -1,37 +1,44 @@
-from ..database.db_session import get_db
+from ..database.db_session import get_db, get_admin_db
 from ..models.file import Game
+from ..cache.planning_events import plannings_invalidated
 
 db = get_db()
+# The csv refresh is a bulk job, it runs on the admin pool
+admin_db = get_admin_db()
 
 # Function to refresh the csv table
 async def refresh_csv_table(data: list):
-    # Delete all the rows in the table
-    query = "DELETE FROM csv WHERE is_active = TRUE;"
-    await db.execute(query)
-    
-    # Get the active festival
-    query = """
-    SELECT festival_id FROM festivals WHERE is_active = TRUE;"""
-    
-    festival_id = await db.fetch_val(query)
-    
-    # Add the festival_id to the data
-    for row in data:
-        row.insert(0, festival_id)
+    # The refresh is done in a single transaction so that the games are never missing
+    async with admin_db.transaction() as tx:
+        # Delete all the rows in the table
+        query = "DELETE FROM csv WHERE is_active = TRUE;"
+        await tx.execute(query)
+        
+        # Get the active festival
+        query = """
+        SELECT festival_id FROM festivals WHERE is_active = TRUE;"""
+        
+        festival_id = await tx.fetch_val(query)
+        
+        # Add the festival_id to the data
+        for row in data:
+            row.insert(0, festival_id)
 
-    # Insert all the rows
-    columns = [
-        "festival_id", "jeu_id", "nom_du_jeu", "auteur", "editeur",
-        "nb_joueurs", "age_min", "duree", "type_jeu", "notice",
-        "zone_plan", "zone_benevole", "zone_benevole_id", "a_animer",
-        "recu", "mecanismes", "themes", "tags", "description",
-        "image_jeu", "logo", "video"
-    ]
+        # Insert all the rows
+        columns = [
+            "festival_id", "jeu_id", "nom_du_jeu", "auteur", "editeur",
+            "nb_joueurs", "age_min", "duree", "type_jeu", "notice",
+            "zone_plan", "zone_benevole", "zone_benevole_id", "a_animer",
+            "recu", "mecanismes", "themes", "tags", "description",
+            "image_jeu", "logo", "video"
+        ]
 
-    await db.insert_many("csv", data, columns)
-    
-    # Call the function to check and resolve changes
-    await check_and_resolve_changes()
+        await tx.insert_many("csv", data, columns)
+        
+        # Call the function to check and resolve changes
+        await check_and_resolve_changes(tx)
+    # The zones benevoles and their inscriptions changed, the plannings are rebuilt
+    await plannings_invalidated(db)
     
     return {"message": "csv table refreshed"}
 
@@ -43,6 +50,7 @@ async def get_games_info() -> list[Game]:
     WHERE is_active = TRUE;
     """
     
+    # Read from the primary: the games are served under an ETag bumped on the primary, a lagging replica would send old ones under it
     result = await db.fetch_rows(query)
     
     if len(result) == 0:
@@ -65,12 +73,18 @@ async def get_games_info() -> list[Game]:
 # It does NOT account for:
 # renaming of a zone_plan
 # deletion of a zone_plan
-async def check_and_resolve_changes():
+async def check_and_resolve_changes(tx=None):
     query= """
     CALL update_inscriptions_animation_zones();
     """
     
-    await db.execute(query)
+    # Run in the transaction of the csv refresh if there is one
+    # The refresh invalidates the plannings itself once committed
+    if tx is None:
+        await admin_db.execute(query)
+        await plannings_invalidated(db)
+    else:
+        await tx.execute(query)
     
     return {"message": "Changes checked and resolved"}
 
@@ -83,7 +97,7 @@ async def get_games_info_by_id(festival_id: int, game_id: str) -> Game:
     WHERE festival_id = $1 AND jeu_id = $2;
     """
     
-    result = await db.fetch_row(query, festival_id, game_id)
+    result = await db.fetch_row(query, festival_id, game_id, read_only=True)
     
     if result is None:
         return {"message": "No game found"}
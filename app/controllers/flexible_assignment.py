@@ -0,0 +1,171 @@
+# This file contains the assignment of the flexible volunteers
+# A flexible volunteer is signed up to several postes (or zones benevoles) for the same jour and creneau
+# and must be kept on only one of them. The assignment maximizes the number of volunteers placed
+# within the remaining capacities, with a max flow on the volunteers grouped by their choices:
+# source -> choices (number of volunteers with these choices) -> targets (remaining capacity) -> sink
+# The slots are solved one by one, the database work is done by inscription_controller
+
+from collections import deque
+
+
+# Max flow (Dinic) on a small graph stored in flat lists
+class _FlowGraph:
+
+    def __init__(self, nb_nodes: int):
+        self.heads = [[] for _ in range(nb_nodes)]
+        # Edge i goes to targets[i] with capacities[i], edge i ^ 1 is its reverse
+        self.targets = []
+        self.capacities = []
+
+    def add_edge(self, source: int, target: int, capacity: int) -> int:
+        edge = len(self.targets)
+        self.heads[source].append(edge)
+        self.targets.append(target)
+        self.capacities.append(capacity)
+        self.heads[target].append(edge + 1)
+        self.targets.append(source)
+        self.capacities.append(0)
+        return edge
+
+    def flow(self, edge: int) -> int:
+        return self.capacities[edge ^ 1]
+
+    def max_flow(self, source: int, sink: int) -> int:
+        total = 0
+        while True:
+            levels = self._levels(source, sink)
+            if levels[sink] < 0:
+                return total
+            cursors = [0] * len(self.heads)
+            while True:
+                pushed = self._push(source, sink, float("inf"), levels, cursors)
+                if not pushed:
+                    break
+                total += pushed
+
+    def _levels(self, source: int, sink: int) -> list:
+        levels = [-1] * len(self.heads)
+        levels[source] = 0
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            for edge in self.heads[node]:
+                target = self.targets[edge]
+                if self.capacities[edge] > 0 and levels[target] < 0:
+                    levels[target] = levels[node] + 1
+                    queue.append(target)
+        return levels
+
+    def _push(self, node: int, sink: int, limit, levels: list, cursors: list) -> int:
+        if node == sink:
+            return limit
+        edges = self.heads[node]
+        while cursors[node] < len(edges):
+            edge = edges[cursors[node]]
+            target = self.targets[edge]
+            if self.capacities[edge] > 0 and levels[target] == levels[node] + 1:
+                pushed = self._push(target, sink, min(limit, self.capacities[edge]), levels, cursors)
+                if pushed:
+                    self.capacities[edge] -= pushed
+                    self.capacities[edge ^ 1] += pushed
+                    return pushed
+            cursors[node] += 1
+        return 0
+
+
+# Function to assign the flexible volunteers of a single jour and creneau
+# choices has one bitmask per volunteer, bit t set if the volunteer is signed up to the target t
+# capacities has the remaining capacity of every target (its capacity minus the volunteers that are not flexible)
+# Returns the target chosen for every volunteer and the number of volunteers placed over the capacities
+def assign_flexibles(choices: list, capacities: list) -> tuple:
+    nb_targets = len(capacities)
+    groups = {}
+    for volunteer, mask in enumerate(choices):
+        groups.setdefault(mask, []).append(volunteer)
+    masks = list(groups)
+
+    # Nodes: source, one per group of choices, one per target, sink
+    source = 0
+    sink = 1 + len(masks) + nb_targets
+    graph = _FlowGraph(sink + 1)
+    group_edges = []
+    for index, mask in enumerate(masks):
+        graph.add_edge(source, 1 + index, len(groups[mask]))
+        edges = []
+        for target in range(nb_targets):
+            if mask >> target & 1:
+                edges.append((target, graph.add_edge(1 + index, 1 + len(masks) + target, len(groups[mask]))))
+        group_edges.append(edges)
+    for target, capacity in enumerate(capacities):
+        if capacity > 0:
+            graph.add_edge(1 + len(masks) + target, sink, capacity)
+    graph.max_flow(source, sink)
+
+    assignment = [-1] * len(choices)
+    loads = [0] * nb_targets
+    overflow = 0
+    for index, mask in enumerate(masks):
+        volunteers = groups[mask]
+        position = 0
+        for target, edge in group_edges[index]:
+            for _ in range(graph.flow(edge)):
+                assignment[volunteers[position]] = target
+                position += 1
+            loads[target] += graph.flow(edge)
+        # The volunteers that do not fit anymore stay on the least loaded of their choices
+        for volunteer in volunteers[position:]:
+            target = min((target for target, _ in group_edges[index]), key=lambda target: loads[target] - capacities[target])
+            assignment[volunteer] = target
+            loads[target] += 1
+            overflow += 1
+    return assignment, overflow
+
+
+# Function to keep a single inscription for every flexible volunteer of every slot
+# inscriptions are tuples (user_id, festival_id, jour, creneau, target), target is a poste or a zone benevole
+# capacity(festival_id, target) gives the capacity of a target, None if it is unknown (then it is not limited)
+# Returns the inscriptions to delete, the target kept by (user_id, festival_id, jour, creneau) for the flexibles,
+# the number of inscriptions by (festival_id, target, jour, creneau) once assigned
+# and the number of volunteers placed over the capacities
+def plan_flexibles(inscriptions, capacity) -> tuple:
+    slots = {}
+    for user_id, festival_id, jour, creneau, target in inscriptions:
+        slots.setdefault((festival_id, jour, creneau), {}).setdefault(user_id, []).append(target)
+
+    to_delete = []
+    kept_targets = {}
+    loads = {}
+    overflow = 0
+    for (festival_id, jour, creneau), users in slots.items():
+        targets = list(dict.fromkeys(target for user_targets in users.values() for target in user_targets))
+        index = {target: position for position, target in enumerate(targets)}
+        remaining = []
+        for target in targets:
+            target_capacity = capacity(festival_id, target)
+            remaining.append(len(users) if target_capacity is None else target_capacity)
+
+        flexibles = []
+        choices = []
+        for user_id, user_targets in users.items():
+            if len(user_targets) == 1:
+                remaining[index[user_targets[0]]] -= 1
+                continue
+            mask = 0
+            for target in user_targets:
+                mask |= 1 << index[target]
+            flexibles.append(user_id)
+            choices.append(mask)
+
+        assignment, slot_overflow = assign_flexibles(choices, [max(0, capacity_left) for capacity_left in remaining])
+        overflow += slot_overflow
+        kept = {user_id: targets[target] for user_id, target in zip(flexibles, assignment)}
+        for user_id, user_targets in users.items():
+            kept_target = kept.get(user_id, user_targets[0])
+            if len(user_targets) > 1:
+                kept_targets[(user_id, festival_id, jour, creneau)] = kept_target
+            key = (festival_id, kept_target, jour, creneau)
+            loads[key] = loads.get(key, 0) + 1
+            for target in user_targets:
+                if target != kept_target:
+                    to_delete.append((user_id, festival_id, jour, creneau, target))
+    return to_delete, kept_targets, loads, overflow
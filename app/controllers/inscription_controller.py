@@ -1,18 +1,28 @@
-from ..database.db_session import get_db
+from ..database.db_session import get_db, get_admin_db
 from fastapi import HTTPException
 from ..models.user import User
 from ..models.inscription import InscriptionPoste, InscriptionZoneBenevole, BatchInscriptionPoste, BatchInscriptionZoneBenevole, AssignInscriptionPoste, AssignInscriptionZoneBenevole, ExpressInscriptionPoste, ExpressInscriptionZoneBenevole
-import json
 from typing import List
+import asyncio
+import json
+import os
+import uuid
+from ..controllers.planning_grid import ZONE_BENEVOLE_MAX_CAPACITY, FestivalSlots, Occupancy, load_festival_slots, columnar_grid_from_cells, cell_key, cell_fields, cell_delta
+from ..controllers.flexible_assignment import plan_flexibles
+from ..cache.planning_cache import planning_cache
+from ..cache.planning_events import inscriptions_changed, plannings_invalidated, broadcaster
 
 db = get_db()
-
-JOURS = ["Vendredi", "Samedi", "Dimanche"]
-CRENEAUX = ["8h-10h", "10h-12h", "12h-14h", "14h-16h", "16h-18h"]
-INSERT_QUERY = """
-    INSERT INTO inscriptions (user_id, festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau, is_poste)
-    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-    ON CONFLICT (user_id, festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau, is_poste) DO NOTHING;
+# The auto assignments rewrite many inscriptions, they run on the admin pool
+admin_db = get_admin_db()
+
+# Time between two keep-alive comments of the planning stream
+STREAM_HEARTBEAT_SECONDS = 15
+# Applies the desinscriptions and inscriptions of a user in one statement, see apply_inscriptions_batch in inscription.sql
+# The inscriptions are only signed up if their slot is not full, the result of each of them is 'inserted', 'already', 'full'
+# or 'invalid' if its jour or creneau is not one of the festival
+APPLY_BATCH_QUERY = """
+    SELECT apply_inscriptions_batch($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19, $20);
     """
 DELETE_QUERY = """
     DELETE FROM inscriptions
@@ -22,47 +32,103 @@ DELETE_QUERY_2 = """
     DELETE FROM inscriptions
     WHERE user_id = $1 AND poste = $2 AND jour = $3 AND creneau = $4 AND is_poste = $5 AND is_active = True AND festival_id = $6;
     """
-SELECT_POSTES_QUERY = """
-    SELECT festival_id, poste, max_capacity
-    FROM postes
-    WHERE festival_id = $1;
+# It is the hottest statement during the inscriptions, it is prepared on every connection
+db.register_statement("apply_inscriptions_batch", APPLY_BATCH_QUERY)
+# Queries of the planning grids, one row per poste or zone benevole, jour and creneau
+# The postes or zones are crossed with the jours and creneaux of the festival and the counts are joined
+# is_register tells if the user $2 is signed up, without sending the list of the users of every cell
+SELECT_GRID_POSTES_QUERY = """
+    SELECT
+        p.festival_id,
+        p.poste,
+        j.jour,
+        c.creneau,
+        COALESCE(i.nb_inscriptions, 0) AS nb_inscriptions,
+        COALESCE(i.is_register, False) AS is_register,
+        p.max_capacity
+    FROM postes p
+    JOIN festivals f ON f.festival_id = p.festival_id
+    CROSS JOIN LATERAL unnest(f.jours) WITH ORDINALITY AS j(jour, jour_order)
+    CROSS JOIN LATERAL unnest(f.creneaux) WITH ORDINALITY AS c(creneau, creneau_order)
+    LEFT JOIN (
+        SELECT poste, jour, creneau, COUNT(*) AS nb_inscriptions, bool_or(user_id = $2) AS is_register
+        FROM inscriptions
+        WHERE is_poste = True AND festival_id = $1
+        GROUP BY poste, jour, creneau
+    ) i ON i.poste = p.poste AND i.jour = j.jour AND i.creneau = c.creneau
+    WHERE p.festival_id = $1
+    ORDER BY j.jour_order, c.creneau_order, p.poste;
     """
-SELECT_NB_INS_POSTES_QUERY = """
-    SELECT festival_id, poste, jour, creneau, COUNT(*) AS nb_inscriptions, array_agg(user_id) AS users
-    FROM inscriptions
-    WHERE is_poste = True AND festival_id = $1
-    GROUP BY festival_id, poste, jour, creneau
-    ORDER BY festival_id, poste, jour, creneau;
+# $3 is the max capacity of a zone benevole
+SELECT_GRID_ZONES_BENEVOLES_QUERY = """
+    SELECT
+        z.festival_id,
+        'Animation' AS poste,
+        z.zone_plan,
+        z.zone_benevole_id,
+        z.zone_benevole AS zone_benevole_name,
+        j.jour,
+        c.creneau,
+        COALESCE(i.nb_inscriptions, 0) AS nb_inscriptions,
+        COALESCE(i.is_register, False) AS is_register,
+        $3::int AS max_capacity
+    FROM (
+        SELECT DISTINCT festival_id, zone_plan, zone_benevole_id, zone_benevole
+        FROM csv
+        WHERE a_animer = 'oui'
+        AND festival_id = $1
+    ) z
+    JOIN festivals f ON f.festival_id = z.festival_id
+    CROSS JOIN LATERAL unnest(f.jours) WITH ORDINALITY AS j(jour, jour_order)
+    CROSS JOIN LATERAL unnest(f.creneaux) WITH ORDINALITY AS c(creneau, creneau_order)
+    LEFT JOIN (
+        SELECT zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau, COUNT(*) AS nb_inscriptions, bool_or(user_id = $2) AS is_register
+        FROM inscriptions
+        WHERE is_poste = False AND festival_id = $1
+        GROUP BY zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau
+    ) i ON i.zone_plan = z.zone_plan AND i.zone_benevole_id = z.zone_benevole_id AND i.zone_benevole_name = z.zone_benevole AND i.jour = j.jour AND i.creneau = c.creneau
+    ORDER BY j.jour_order, c.creneau_order, z.zone_plan, z.zone_benevole_id, z.zone_benevole;
     """
+# The grids are read on every page view of the planning, they are prepared on every connection
+db.register_statement("select_grid_postes", SELECT_GRID_POSTES_QUERY)
+db.register_statement("select_grid_zones_benevoles", SELECT_GRID_ZONES_BENEVOLES_QUERY)
 
-SELECT_ZONES_BENEVOLES_QUERY = """
-    SELECT DISTINCT festival_id, zone_plan, zone_benevole_id, zone_benevole
-    FROM csv
-    WHERE a_animer = 'oui'
-    AND festival_id = $1;
-    """
-SELECT_NB_INS_ZONES_BENEVOLES_QUERY = """
-    SELECT festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau, COUNT(*) AS nb_inscriptions, array_agg(user_id) AS users
-    FROM inscriptions
-    WHERE is_poste = False AND festival_id = $1
-    GROUP BY festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau
-    ORDER BY festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau;
-    """
+
+# Function to call after every write of the inscriptions of a user
+# The planning cache resyncs the cells of the user and the new counts are pushed to the clients
+async def notify_inscriptions_changed(festival_id: int, user_id: int):
+    await inscriptions_changed(db, festival_id, user_id)
+
+
+# Function to apply desinscriptions and inscriptions of a user in one round trip and one transaction
+# desinscriptions and inscriptions are tuples (festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau)
+# clear is (festival_id, jour, creneau) to first remove the inscriptions of the user for this slot, as the express inscriptions do
+# Returns the result of each inscription in the same order
+async def apply_inscriptions_batch(user_id: int, is_poste: bool, desinscriptions: list, inscriptions: list, clear: tuple = (None, None, None)) -> list:
+    desinscriptions_columns = [list(column) for column in zip(*desinscriptions)] if desinscriptions else [[] for _ in range(7)]
+    inscriptions_columns = [list(column) for column in zip(*inscriptions)] if inscriptions else [[] for _ in range(7)]
+    return await db.fetch_val_prepared("apply_inscriptions_batch", user_id, is_poste, ZONE_BENEVOLE_MAX_CAPACITY, *clear, *desinscriptions_columns, *inscriptions_columns)
 
 
 # Function to sign up to a "poste"
 async def inscription_user_poste(user: User, inscription: InscriptionPoste):
-    query = INSERT_QUERY
-
-    result = await db.execute(query, user.user_id, inscription.festival_id, inscription.poste, "", "", "", inscription.jour, inscription.creneau, True)
+    result = await apply_inscriptions_batch(user.user_id, True, [], [(inscription.festival_id, inscription.poste, "", "", "", inscription.jour, inscription.creneau)])
+    if result[0] == "invalid":
+        raise HTTPException(status_code=400, detail="The festival has no such jour or creneau")
+    if result[0] == "full":
+        raise HTTPException(status_code=409, detail="Poste is full")
+    await notify_inscriptions_changed(inscription.festival_id, user.user_id)
     
     return {"message": "Successfully signed up to poste"}
 
 # Function to sign up to a "zone benevole"
 async def inscription_user_zone_benevole(user: User, inscription: InscriptionZoneBenevole):
-    query = INSERT_QUERY
-
-    result = await db.execute(query, user.user_id, inscription.festival_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, inscription.jour, inscription.creneau, False)
+    result = await apply_inscriptions_batch(user.user_id, False, [], [(inscription.festival_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, inscription.jour, inscription.creneau)])
+    if result[0] == "invalid":
+        raise HTTPException(status_code=400, detail="The festival has no such jour or creneau")
+    if result[0] == "full":
+        raise HTTPException(status_code=409, detail="Zone benevole is full")
+    await notify_inscriptions_changed(inscription.festival_id, user.user_id)
 
     return {"message": "Successfully signed up to zone benevole"}
 
@@ -70,12 +136,14 @@ async def inscription_user_zone_benevole(user: User, inscription: InscriptionZon
 async def desinscription_user_poste(user: User, inscription: InscriptionPoste):
     query = DELETE_QUERY
 
-    result = await db.execute(query, user.user_id, inscription.poste, "", "", "", inscription.jour, inscription.creneau, True, inscription.festival_id)
-    
-    # Remove the inscriptions for the zone benevoles under the poste "Animation" for the same jour and creneau
-    if inscription.poste == "Animation":
-        query = DELETE_QUERY_2
-        result = await db.execute(query, user.user_id, inscription.poste, inscription.jour, inscription.creneau, False, inscription.festival_id)
+    async with db.transaction() as tx:
+        result = await tx.execute(query, user.user_id, inscription.poste, "", "", "", inscription.jour, inscription.creneau, True, inscription.festival_id)
+        
+        # Remove the inscriptions for the zone benevoles under the poste "Animation" for the same jour and creneau
+        if inscription.poste == "Animation":
+            query = DELETE_QUERY_2
+            result = await tx.execute(query, user.user_id, inscription.poste, inscription.jour, inscription.creneau, False, inscription.festival_id)
+    await notify_inscriptions_changed(inscription.festival_id, user.user_id)
 
     return {"message": "Successfully removed inscription from poste"}
 
@@ -84,246 +152,317 @@ async def desinscription_user_zone_benevole(user: User, inscription: Inscription
     query = DELETE_QUERY
 
     result = await db.execute(query, user.user_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, inscription.jour, inscription.creneau, False, inscription.festival_id)
+    await notify_inscriptions_changed(inscription.festival_id, user.user_id)
 
     return {"message": "Successfully removed inscription from zone benevole"}
 
 
 # Function that returns the number of inscriptions for all postes by day and creneau
 # It also returns whether the user is signed up to the poste or not
-async def get_nb_inscriptions_poste(user_id: int, festival_id: int):
-    # First get all of the possible postes
-    query = SELECT_POSTES_QUERY
-    
-    result = await db.fetch_rows(query, festival_id)
-    
-    to_send = []
-    for jour in JOURS:
-        for creneau in CRENEAUX:
-            to_send += [{"festival_id": row["festival_id"], "poste": row["poste"], "jour": jour, "creneau": creneau, "nb_inscriptions": 0, "is_register": False, "max_capacity": row["max_capacity"]} for row in result]
-    
-    query = SELECT_NB_INS_POSTES_QUERY
-
-    result = await db.fetch_rows(query, festival_id)
-    
-    # Update the nb_inscriptions for each poste
-    for row in result:
-        for poste in to_send:
-            if row["poste"] == poste["poste"] and row["jour"] == poste["jour"] and row["creneau"] == poste["creneau"]:
-                poste["nb_inscriptions"] = row["nb_inscriptions"]
-                # Check if the user is signed up to the poste
-                if user_id in row["users"]:
-                    poste["is_register"] = True
-    
-    return to_send
+# With columnar, the grid is returned in the columnar format, see build_columnar_grid in planning_grid.py
+async def get_nb_inscriptions_poste(user_id: int, festival_id: int, columnar: bool = False):
+    if planning_cache.enabled:
+        planning = await planning_cache.get(db, festival_id)
+        return planning.postes_columnar_grid(festival_id, user_id) if columnar else planning.postes_grid(user_id)
+    # The grids are read from the primary, as the ETag they are served under is bumped on the primary
+    result = [dict(row) for row in await db.fetch_rows_prepared("select_grid_postes", festival_id, user_id)]
+    if columnar:
+        return columnar_grid_from_cells(festival_id, result, await load_festival_slots(db, festival_id))
+    return result
 
 # Function that returns the number of inscriptions for all zones benevoles by day and creneau
 # It also returns whether the user is signed up to the zone benevole or not
-async def get_nb_inscriptions_zone_benevole(user_id: int, festival_id: int):
-    # First get all of the possible zone benevoles
-    query = SELECT_ZONES_BENEVOLES_QUERY
-    
-    result = await db.fetch_rows(query, festival_id)
-    
-    max_capacity_dict = {}
-    # Calculate the max capacity for each zone benevole
-    for row in result:
-        # Check if it is None
-        if (row["zone_plan"], row["zone_benevole_id"], row["zone_benevole"]) not in max_capacity_dict:
-            max_capacity_dict[(row["zone_plan"], row["zone_benevole_id"], row["zone_benevole"])] = 2
-        elif max_capacity_dict[(row["zone_plan"], row["zone_benevole_id"], row["zone_benevole"])] < row["nb_inscriptions"]:
-            max_capacity_dict[(row["zone_plan"], row["zone_benevole_id"], row["zone_benevole"])] = row["nb_inscriptions"]
-
-    to_send = []
-    for jour in JOURS:
-        for creneau in CRENEAUX:
-            to_send += [{"festival_id": row["festival_id"], "poste": "Animation", "zone_plan": row["zone_plan"], "zone_benevole_id": row["zone_benevole_id"], "zone_benevole_name": row["zone_benevole"], "jour": jour, "creneau": creneau, "nb_inscriptions": 0, "is_register": False, "max_capacity": max_capacity_dict[(row["zone_plan"], row["zone_benevole_id"], row["zone_benevole"])]} for row in result]
-    
-    query = SELECT_NB_INS_ZONES_BENEVOLES_QUERY
+async def get_nb_inscriptions_zone_benevole(user_id: int, festival_id: int, columnar: bool = False):
+    if planning_cache.enabled:
+        planning = await planning_cache.get(db, festival_id)
+        return planning.zones_columnar_grid(festival_id, user_id) if columnar else planning.zones_grid(user_id)
+    result = [dict(row) for row in await db.fetch_rows_prepared("select_grid_zones_benevoles", festival_id, user_id, ZONE_BENEVOLE_MAX_CAPACITY)]
+    if columnar:
+        return columnar_grid_from_cells(festival_id, result, await load_festival_slots(db, festival_id))
+    return result
 
-    result = await db.fetch_rows(query, festival_id)
-    
-    
-    # Update the nb_inscriptions for each zone benevole
-    for row in result:
-        for zone_benevole in to_send:
-            if row["zone_plan"] == zone_benevole["zone_plan"] and row["zone_benevole_id"] == zone_benevole["zone_benevole_id"] and row["zone_benevole_name"] == zone_benevole["zone_benevole_name"] and row["jour"] == zone_benevole["jour"] and row["creneau"] == zone_benevole["creneau"]:
-                zone_benevole["nb_inscriptions"] = row["nb_inscriptions"]
-                # Check if the user is signed up to the zone benevole
-                if user_id in row["users"]:
-                    zone_benevole["is_register"] = True
-                
-    return to_send
 
+# Function to stream the changes of the plannings of a festival as Server-Sent Events
+# A "delta" event gives the new nb_inscriptions of the cells that changed,
+# a "resync" event asks the client to get the whole grids again
+async def stream_planning_events(festival_id: int):
+    queue = broadcaster.subscribe(festival_id)
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=STREAM_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Keeps the connection open through the proxies
+                yield ": ping\n\n"
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        broadcaster.unsubscribe(festival_id, queue)
+
+
+# Queries of the auto assignment of the flexibles, on the inscriptions of a festival
+# The inscriptions are read with inscriptions_festival_flexibles_idx, see inscription.sql
+SELECT_ACTIVE_POSTES_QUERY = """
+    SELECT festival_id, poste, max_capacity
+    FROM postes
+    WHERE festival_id = $1 AND is_active = True;
+    """
+SELECT_ACTIVE_POSTES_INSCRIPTIONS_QUERY = """
+    SELECT user_id, festival_id, jour, creneau, poste
+    FROM inscriptions
+    WHERE festival_id = $1 AND is_poste = True AND is_active = True;
+    """
+# Deletes all of the given poste inscriptions in one statement
+# The inscriptions for the zone benevoles under the poste "Animation" for the same jour and creneau are deleted with it
+DELETE_POSTES_INSCRIPTIONS_QUERY = """
+    DELETE FROM inscriptions i
+    USING unnest($2::int[], $3::text[], $4::text[], $5::text[]) AS d(user_id, jour, creneau, poste)
+    WHERE i.festival_id = $1 AND i.user_id = d.user_id AND i.jour = d.jour AND i.creneau = d.creneau
+        AND i.is_active = True
+        AND (
+            (i.is_poste = True AND i.poste = d.poste)
+            OR (i.is_poste = False AND i.poste = 'Animation' AND d.poste = 'Animation')
+        );
+    """
+SELECT_ACTIVE_ZONES_BENEVOLES_QUERY = """
+    SELECT DISTINCT festival_id, zone_plan, zone_benevole_id, zone_benevole
+    FROM csv
+    WHERE festival_id = $1 AND a_animer = 'oui' AND is_active = True;
+    """
+SELECT_ACTIVE_ZONES_INSCRIPTIONS_QUERY = """
+    SELECT user_id, festival_id, jour, creneau, zone_plan, zone_benevole_id, zone_benevole_name
+    FROM inscriptions
+    WHERE festival_id = $1 AND is_poste = False AND poste = 'Animation' AND is_active = True;
+    """
+DELETE_ZONES_INSCRIPTIONS_QUERY = """
+    DELETE FROM inscriptions i
+    USING unnest($2::int[], $3::text[], $4::text[], $5::text[], $6::text[], $7::text[])
+        AS d(user_id, jour, creneau, zone_plan, zone_benevole_id, zone_benevole_name)
+    WHERE i.festival_id = $1 AND i.user_id = d.user_id AND i.jour = d.jour AND i.creneau = d.creneau
+        AND i.zone_plan IS NOT DISTINCT FROM d.zone_plan AND i.zone_benevole_id IS NOT DISTINCT FROM d.zone_benevole_id
+        AND i.zone_benevole_name IS NOT DISTINCT FROM d.zone_benevole_name
+        AND i.is_poste = False AND i.poste = 'Animation' AND i.is_active = True;
+    """
 
-# Function to auto assign flexibles to postes
-async def auto_assign_flexibles_to_postes():
-    # Remove duplicates with regards to poste, jour and creneau
-    # Lets say we have a flexible that is signed up to n postes for a given jour and creneau
-    # We will delete n-1 of his inscriptions and keep one at random
-    # For each inscription that is deleted for the poste "Animation",
-    # we will also delete the inscriptions for the zone benevoles under the poste "Animation" for the same jour and creneau
-    query = """
-    WITH DuplicateCTE AS (
-        SELECT
-            user_id,
-            poste,
-            jour,
-            creneau,
-            ROW_NUMBER() OVER (PARTITION BY user_id, jour, creneau ORDER BY RANDOM()) AS row_num
-        FROM
-            inscriptions
-        WHERE
-            is_poste = True
-            AND is_active = True
-        )
-    DELETE FROM
-        inscriptions
-    WHERE
-        ((user_id, jour, creneau, poste) IN (
-            SELECT
-            user_id,
-            jour,
-            creneau,
-            poste
-            FROM
-                DuplicateCTE
-            WHERE
-                row_num > 1
-        ) AND is_poste = True AND is_active = True)
-    OR
-        (poste = 'Animation' AND (user_id, jour, creneau) IN (
-            SELECT
-            user_id,
-            jour,
-            creneau
-            FROM
-                DuplicateCTE
-            WHERE
-                poste = 'Animation' AND row_num > 1
-        ) AND is_poste = False AND is_active = True);
+
+# The plans of the auto assignment previews are kept in the database for this time, see auto_assign_plans in inscription.sql
+AUTO_ASSIGN_PLAN_TTL_MINUTES = int(os.environ.get("AUTO_ASSIGN_PLAN_TTL_MINUTES", 30))
+# Number of writes of the inscriptions and postes of a festival, a plan is only applied if it did not change
+# The counts are kept by writer by the triggers of inscription.sql, see festival_changes
+SELECT_FESTIVAL_CHANGES_QUERY = """
+    SELECT coalesce(sum(changes), 0)::BIGINT
+    FROM festival_changes
+    WHERE festival_id = $1;
+    """
+INSERT_AUTO_ASSIGN_PLAN_QUERY = """
+    INSERT INTO auto_assign_plans (plan_id, kind, festival_id, changes, to_delete)
+    VALUES ($1, $2, $3, $4, $5::jsonb);
+    """
+DELETE_EXPIRED_AUTO_ASSIGN_PLANS_QUERY = """
+    DELETE FROM auto_assign_plans
+    WHERE created_at < NOW() - make_interval(mins => $1);
+    """
+# A plan can only be applied once
+POP_AUTO_ASSIGN_PLAN_QUERY = """
+    DELETE FROM auto_assign_plans
+    WHERE plan_id = $1 AND kind = $2 AND created_at >= NOW() - make_interval(mins => $3)
+    RETURNING festival_id, changes, to_delete;
+    """
+# The writes of the festival wait for the apply of a plan, which only runs a few statements
+# The writers hold this lock in shared mode, the other festivals are not blocked
+LOCK_FESTIVAL_CHANGES_QUERY = """
+    SELECT pg_advisory_xact_lock($1::bigint);
     """
-    
-    await db.execute(query)
-    
-    return {"message": "Successfully auto assigned flexibles to postes"}
 
-# Function to auto assign flexibles to zones benevoles
-async def auto_assign_flexibles_to_zones_benevoles():
-    # Remove duplicates with regards to zone_plan, zone_benevole_id, zone_benevole_name, jour and creneau
-    # Lets say we have a flexible that is signed up to n zone_benevoles for a given jour and creneau
-    # We will delete n-1 of his inscriptions and keep one at random
-    
-    # We have to make sure that the flexibilities for postes are already assigned
-    await auto_assign_flexibles_to_postes()
-   
-    query = """
-    WITH DuplicateCTE AS (
-        SELECT
-            user_id,
-            poste,
-            zone_plan,
-            zone_benevole_id,
-            zone_benevole_name,
-            jour,
-            creneau,
-            ROW_NUMBER() OVER (PARTITION BY user_id, jour, creneau ORDER BY RANDOM()) AS row_num
-        FROM
-            inscriptions
-        WHERE
-            is_poste = False
-            AND poste = 'Animation'
-            AND is_active = True
+
+# Function to describe a target of the auto assignment, a poste or a zone benevole
+def assignment_target(target) -> dict:
+    if isinstance(target, tuple):
+        return {"poste": "Animation", "zone_plan": target[0], "zone_benevole_id": target[1], "zone_benevole_name": target[2]}
+    return {"poste": target}
+
+# Function to get the target of the auto assignment as in the cells of the planning, see planning_grid.py
+def assignment_cell_target(target) -> tuple:
+    return target if isinstance(target, tuple) else (target,)
+
+# Function to report the fill rate of the slots and the slots that are not full
+# targets are (festival_id, target, capacity), before and after the number of inscriptions by (festival_id, target, jour, creneau)
+def fill_report(festival_slots: FestivalSlots, targets: list, before: dict, after: dict) -> dict:
+    occupancies = []
+    for loads in (before, after):
+        occupancy = Occupancy([assignment_cell_target(target) for festival_id, target, capacity in targets], festival_slots)
+        for (festival_id, target, jour, creneau), count in loads.items():
+            occupancy.add((*assignment_cell_target(target), jour, creneau), count)
+        occupancies.append(occupancy)
+    before_occupancy, after_occupancy = occupancies
+
+    changed = []
+    unfilled = []
+    for target_index, (festival_id, target, capacity) in enumerate(targets):
+        counts_before = before_occupancy.target_counts(target_index)
+        counts_after = after_occupancy.target_counts(target_index)
+        for slot_index, (jour, creneau) in enumerate(festival_slots):
+            nb_before = counts_before[slot_index]
+            nb_after = counts_after[slot_index]
+            slot = {"festival_id": festival_id, **assignment_target(target), "jour": jour, "creneau": creneau, "max_capacity": capacity}
+            if nb_before != nb_after:
+                changed.append({**slot, "before": nb_before, "after": nb_after})
+            if nb_after < capacity:
+                unfilled.append({**slot, "nb_inscriptions": nb_after})
+    capacities = [capacity for festival_id, target, capacity in targets]
+    return {
+        "fill_rate": {"before": before_occupancy.fill_rate(capacities), "after": after_occupancy.fill_rate(capacities)},
+        "slots": changed,
+        "unfilled": unfilled,
+    }
+
+# Function to solve the auto assignment of one kind of targets and report it
+# rows are (user_id, festival_id, jour, creneau, target), festival_slots and targets as in fill_report
+def plan_auto_assign(rows: list, festival_slots: FestivalSlots, targets: list, capacity) -> dict:
+    to_delete, kept, loads, overflow = plan_flexibles(rows, capacity)
+    before = {}
+    for user_id, festival_id, jour, creneau, target in rows:
+        key = (festival_id, target, jour, creneau)
+        before[key] = before.get(key, 0) + 1
+    dropped = {}
+    for user_id, festival_id, jour, creneau, target in to_delete:
+        dropped.setdefault((user_id, festival_id, jour, creneau), []).append(assignment_target(target))
+    users = [
+        {"user_id": user_id, "festival_id": festival_id, "jour": jour, "creneau": creneau, "keep": assignment_target(kept[(user_id, festival_id, jour, creneau)]), "drop": targets}
+        for (user_id, festival_id, jour, creneau), targets in dropped.items()
+    ]
+    return {"to_delete": to_delete, "users": users, "over_capacity": overflow, **fill_report(festival_slots, targets, before, loads)}
+
+# Function to compute the auto assignment of the flexibles of a festival, without writing
+# kind is "postes", or "zones" to also assign the zones benevoles, as the postes are assigned first
+async def compute_auto_assign(conn, kind: str, festival_id: int) -> dict:
+    festival_slots = await load_festival_slots(conn, festival_id)
+    postes = await conn.fetch_rows(SELECT_ACTIVE_POSTES_QUERY, festival_id)
+    capacities = {(row["festival_id"], row["poste"]): row["max_capacity"] for row in postes}
+    rows = await conn.fetch_rows(SELECT_ACTIVE_POSTES_INSCRIPTIONS_QUERY, festival_id)
+    plan = {"postes": plan_auto_assign(
+        [(row["user_id"], row["festival_id"], row["jour"], row["creneau"], row["poste"]) for row in rows],
+        festival_slots,
+        [(row["festival_id"], row["poste"], row["max_capacity"]) for row in postes],
+        lambda festival_id, poste: capacities.get((festival_id, poste)),
+    )}
+    if kind == "zones":
+        # The zones benevoles of a dropped poste "Animation" are deleted with it
+        dropped_animation = {inscription[:4] for inscription in plan["postes"]["to_delete"] if inscription[4] == "Animation"}
+        zones = await conn.fetch_rows(SELECT_ACTIVE_ZONES_BENEVOLES_QUERY, festival_id)
+        rows = await conn.fetch_rows(SELECT_ACTIVE_ZONES_INSCRIPTIONS_QUERY, festival_id)
+        plan["zones"] = plan_auto_assign(
+            [
+                (row["user_id"], row["festival_id"], row["jour"], row["creneau"], (row["zone_plan"], row["zone_benevole_id"], row["zone_benevole_name"]))
+                for row in rows
+                if (row["user_id"], row["festival_id"], row["jour"], row["creneau"]) not in dropped_animation
+            ],
+            festival_slots,
+            [(row["festival_id"], (row["zone_plan"], row["zone_benevole_id"], row["zone_benevole"]), ZONE_BENEVOLE_MAX_CAPACITY) for row in zones],
+            lambda festival_id, zone: ZONE_BENEVOLE_MAX_CAPACITY,
         )
-        DELETE FROM
-        inscriptions
-        WHERE
-        (user_id, jour, creneau, poste, zone_plan, zone_benevole_id, zone_benevole_name) IN (
-            SELECT
-            user_id,
-            jour,
-            creneau,
-            poste,
-            zone_plan,
-            zone_benevole_id,
-            zone_benevole_name
-            FROM
-                DuplicateCTE
-            WHERE
-                row_num > 1
-        ) AND is_poste = False AND is_active = True;"""
-        
-    await db.execute(query)
-        
-    return {"message": "Successfully auto assigned flexibles to zones benevoles"}
+    return plan
+
+# Function to delete the inscriptions of a festival dropped by a plan, in one statement for the postes and one for the zones benevoles
+# The inscriptions are (user_id, festival_id, jour, creneau, target)
+async def delete_auto_assign(tx, festival_id: int, postes_to_delete: list, zones_to_delete: list):
+    if postes_to_delete:
+        columns = [[inscription[field] for inscription in postes_to_delete] for field in (0, 2, 3, 4)]
+        await tx.execute(DELETE_POSTES_INSCRIPTIONS_QUERY, festival_id, *columns)
+    if zones_to_delete:
+        columns = [[inscription[field] for inscription in zones_to_delete] for field in (0, 2, 3)]
+        columns += [list(column) for column in zip(*[inscription[4] for inscription in zones_to_delete])]
+        await tx.execute(DELETE_ZONES_INSCRIPTIONS_QUERY, festival_id, *columns)
+
+# Function to run the auto assignment of a festival and apply it at once
+# The postes and the zones benevoles passes run in the same transaction
+async def run_auto_assign(kind: str, festival_id: int) -> dict:
+    async with admin_db.transaction() as tx:
+        plan = await compute_auto_assign(tx, kind, festival_id)
+        await delete_auto_assign(tx, festival_id, plan["postes"]["to_delete"], plan.get("zones", {}).get("to_delete", []))
+    # The auto assignment touches the inscriptions of many users of the festival
+    await plannings_invalidated(db, festival_id)
+    return plan
+
+# Function to auto assign flexibles to postes
+# A flexible is signed up to several postes for the same jour and creneau, only one of them is kept.
+# The kept postes maximize the number of volunteers placed within the max_capacity of the postes,
+# see flexible_assignment.py. The other inscriptions are deleted in one statement.
+async def auto_assign_flexibles_to_postes(festival_id: int):
+    plan = (await run_auto_assign("postes", festival_id))["postes"]
+    return {"message": "Successfully auto assigned flexibles to postes", "deleted": len(plan["to_delete"]), "over_capacity": plan["over_capacity"], "unfilled": plan["unfilled"]}
+
+# Function to auto assign flexibles to zones benevoles
+# The flexibilities for postes are assigned first, then the zones benevoles with their capacity
+async def auto_assign_flexibles_to_zones_benevoles(festival_id: int):
+    plan = (await run_auto_assign("zones", festival_id))["zones"]
+    return {"message": "Successfully auto assigned flexibles to zones benevoles", "deleted": len(plan["to_delete"]), "over_capacity": plan["over_capacity"], "unfilled": plan["unfilled"]}
+
+# Function to preview the auto assignment without writing
+# Returns the changes by user and by slot, the fill rates before and after and a plan_id to apply this exact plan
+async def preview_auto_assign(kind: str, festival_id: int) -> dict:
+    async with admin_db.transaction() as tx:
+        # The count is read first: a write committed while the plan is computed makes it stale and the plan is refused
+        changes = await tx.fetch_val(SELECT_FESTIVAL_CHANGES_QUERY, festival_id)
+        plan = await compute_auto_assign(tx, kind, festival_id)
+        plan_id = uuid.uuid4().hex
+        to_delete = {"postes": plan["postes"]["to_delete"], "zones": plan.get("zones", {}).get("to_delete", [])}
+        await tx.execute(DELETE_EXPIRED_AUTO_ASSIGN_PLANS_QUERY, AUTO_ASSIGN_PLAN_TTL_MINUTES)
+        await tx.execute(INSERT_AUTO_ASSIGN_PLAN_QUERY, plan_id, kind, festival_id, changes, to_delete)
+    preview = {"plan_id": plan_id, "festival_id": festival_id, "expires_in_minutes": AUTO_ASSIGN_PLAN_TTL_MINUTES}
+    for target, target_plan in plan.items():
+        preview[target] = {key: value for key, value in target_plan.items() if key != "to_delete"}
+        preview[target]["deleted"] = len(target_plan["to_delete"])
+    return preview
+
+# Function to apply a plan computed by preview_auto_assign
+# The plan is refused if an inscription or a capacity changed since the preview
+async def apply_auto_assign_plan(kind: str, plan_id: str) -> dict:
+    async with admin_db.transaction() as tx:
+        plan = await tx.fetch_row(POP_AUTO_ASSIGN_PLAN_QUERY, plan_id, kind, AUTO_ASSIGN_PLAN_TTL_MINUTES)
+        if plan is None:
+            raise HTTPException(status_code=404, detail="Plan not found or expired")
+        festival_id = plan["festival_id"]
+        await tx.execute(LOCK_FESTIVAL_CHANGES_QUERY, festival_id)
+        if plan["changes"] != await tx.fetch_val(SELECT_FESTIVAL_CHANGES_QUERY, festival_id):
+            raise HTTPException(status_code=409, detail="The inscriptions changed since the preview, please preview again")
+        to_delete = plan["to_delete"]
+        # The zones benevoles are stored as lists in json
+        zones_to_delete = [(*inscription[:4], tuple(inscription[4])) for inscription in to_delete["zones"]]
+        await delete_auto_assign(tx, festival_id, to_delete["postes"], zones_to_delete)
+    await plannings_invalidated(db, festival_id)
+    return {"message": "Successfully applied the auto assignment plan", "festival_id": festival_id, "deleted": len(to_delete["postes"]) + len(zones_to_delete)}
 
 
 # Function to handle batch inscription and desinscription to postes
 async def batch_inscription_poste(user: User, batch_inscription: BatchInscriptionPoste):
+    # Desinscriptions and inscriptions are done in a single statement
+    # Removing the poste "Animation" also removes the inscriptions for its zone benevoles for the same jour and creneau
+    desinscriptions = [(inscription.festival_id, inscription.poste, "", "", "", inscription.jour, inscription.creneau) for inscription in batch_inscription.desinscriptions]
+    inscriptions = [(inscription.festival_id, inscription.poste, "", "", "", inscription.jour, inscription.creneau) for inscription in batch_inscription.inscriptions]
+
+    results = await apply_inscriptions_batch(user.user_id, True, desinscriptions, inscriptions)
+    for festival_id in {inscription.festival_id for inscription in batch_inscription.inscriptions + batch_inscription.desinscriptions}:
+        await notify_inscriptions_changed(festival_id, user.user_id)
     
-    if len(batch_inscription.desinscriptions) > 0:
-        # Desinscriptions
-        desincriptions = batch_inscription.desinscriptions
-        
-        # Make a list of tuples of the desincriptions
-        desincriptions = [(user.user_id, inscription.poste, "", "", "", inscription.jour, inscription.creneau, True, inscription.festival_id) for inscription in desincriptions]
-        
-        query = DELETE_QUERY
-        
-        await db.execute_many(query, desincriptions)
-        
-        desincriptions = batch_inscription.desinscriptions
-        
-        desincriptions_zone = []
-        
-        # Remove the inscriptions for the zone benevoles under the poste "Animation" for the same jour and creneau
-        for inscription in desincriptions:
-            if inscription.poste == "Animation":
-                desincriptions_zone.append((user.user_id, inscription.poste, inscription.jour, inscription.creneau, False, inscription.festival_id))
-                
-        if len(desincriptions_zone) > 0:
-            query = DELETE_QUERY_2      
-            await db.execute_many(query, desincriptions_zone)
-                
-    if len(batch_inscription.inscriptions) > 0:
-        # Inscriptions
-        inscriptions = batch_inscription.inscriptions
-        
-        # Make a list of tuples of the inscriptions
-        inscriptions = [(user.user_id, inscription.festival_id, inscription.poste, "", "", "", inscription.jour, inscription.creneau, True) for inscription in inscriptions]
-        
-        query = INSERT_QUERY
-        
-        await db.execute_many(query, inscriptions)
-    
-    return {"message": "Successfully handled batch inscriptions and desinscriptions to postes"}
+    # The result of each inscription: inserted, already, full or invalid
+    results = [{**inscription.model_dump(), "status": status} for inscription, status in zip(batch_inscription.inscriptions, results)]
+    return {"message": "Successfully handled batch inscriptions and desinscriptions to postes", "results": results}
 
 
 # Function to handle batch inscription and desinscription to zones benevoles
 async def batch_inscription_zone_benevole(user: User, batch_inscription: BatchInscriptionZoneBenevole):
+    # Desinscriptions and inscriptions are done in a single statement
+    desinscriptions = [(inscription.festival_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, inscription.jour, inscription.creneau) for inscription in batch_inscription.desinscriptions]
+    inscriptions = [(inscription.festival_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, inscription.jour, inscription.creneau) for inscription in batch_inscription.inscriptions]
+
+    results = await apply_inscriptions_batch(user.user_id, False, desinscriptions, inscriptions)
+    for festival_id in {inscription.festival_id for inscription in batch_inscription.inscriptions + batch_inscription.desinscriptions}:
+        await notify_inscriptions_changed(festival_id, user.user_id)
     
-    if len(batch_inscription.desinscriptions) > 0:
-        # Desinscriptions
-        desincriptions = batch_inscription.desinscriptions
-        
-        # Make a list of tuples of the desincriptions
-        desincriptions = [(user.user_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, inscription.jour, inscription.creneau, False, inscription.festival_id) for inscription in desincriptions]
-        
-        query = DELETE_QUERY
-        
-        await db.execute_many(query, desincriptions)
-        
-    if len(batch_inscription.inscriptions) > 0:
-        # Inscriptions
-        inscriptions = batch_inscription.inscriptions
-        
-        # Make a list of tuples of the inscriptions
-        inscriptions = [(user.user_id, inscription.festival_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, inscription.jour, inscription.creneau, False) for inscription in inscriptions]
-        
-        query = INSERT_QUERY
-        
-        await db.execute_many(query, inscriptions)
-    
-    return {"message": "Successfully handled batch inscriptions and desinscriptions to zones benevoles"}
+    results = [{**inscription.model_dump(), "status": status} for inscription, status in zip(batch_inscription.inscriptions, results)]
+    return {"message": "Successfully handled batch inscriptions and desinscriptions to zones benevoles", "results": results}
 
 
 # Function to get the inscriptions for a poste
@@ -357,7 +496,7 @@ async def get_inscriptions_poste(poste: InscriptionPoste):
             AND festival_id = $4;
     """
     
-    result = await db.fetch_rows(query, poste.poste, poste.jour, poste.creneau, poste.festival_id)
+    result = await db.fetch_rows(query, poste.poste, poste.jour, poste.creneau, poste.festival_id, read_only=True)
     
     result = [dict(row) for row in result]
     
@@ -385,13 +524,57 @@ async def get_inscriptions_zone_benevole(zone_benevole: InscriptionZoneBenevole)
             AND festival_id = $7;
     """
     
-    result = await db.fetch_rows(query, zone_benevole.poste, zone_benevole.zone_plan, zone_benevole.zone_benevole_id, zone_benevole.zone_benevole_name, zone_benevole.jour, zone_benevole.creneau, zone_benevole.festival_id)
+    result = await db.fetch_rows(query, zone_benevole.poste, zone_benevole.zone_plan, zone_benevole.zone_benevole_id, zone_benevole.zone_benevole_name, zone_benevole.jour, zone_benevole.creneau, zone_benevole.festival_id, read_only=True)
     
     result = [dict(row) for row in result]
     
     return result
 
 
+# Volunteers of every poste and zone benevole of a festival, or of one jour if $2 is not NULL
+# A volunteer is flexible if signed up to several postes (or zones benevoles) for the same jour and creneau
+SELECT_FESTIVAL_INSCRIPTIONS_DETAILS_QUERY = """
+    SELECT
+        i.is_poste,
+        i.poste,
+        i.zone_plan,
+        i.zone_benevole_id,
+        i.zone_benevole_name,
+        i.jour,
+        i.creneau,
+        u.user_id,
+        u.username,
+        COUNT(*) OVER (PARTITION BY i.user_id, i.jour, i.creneau, i.is_poste) > 1 AS is_flexible
+    FROM inscriptions i
+    INNER JOIN users u ON u.user_id = i.user_id
+    WHERE i.festival_id = $1
+        AND ($2::text IS NULL OR i.jour = $2)
+    ORDER BY i.is_poste DESC, i.jour, i.creneau, i.poste, i.zone_plan, i.zone_benevole_id, i.zone_benevole_name, u.username;
+    """
+
+
+# Function to get the volunteers of all the postes and zones benevoles of a festival in one query
+# Returns the volunteers grouped by poste or zone benevole, jour and creneau
+async def get_festival_inscriptions_details(festival_id: int, jour: str | None = None):
+    rows = await db.fetch_rows(SELECT_FESTIVAL_INSCRIPTIONS_DETAILS_QUERY, festival_id, jour, read_only=True)
+
+    cells = {}
+    for row in rows:
+        key = cell_key(row)
+        cell = cells.get(key)
+        if cell is None:
+            cell = cell_delta(key, 0)
+            cell["volunteers"] = []
+            cells[key] = cell
+        cell["nb_inscriptions"] += 1
+        cell["volunteers"].append({"user_id": row["user_id"], "username": row["username"], "is_flexible": row["is_flexible"]})
+
+    return {
+        "festival_id": festival_id,
+        "postes": [cell for key, cell in cells.items() if len(key) == 3],
+        "zones_benevoles": [cell for key, cell in cells.items() if len(key) == 5],
+    }
+
 
 # Function to assign an inscription to a user
 # Delete all OTHER inscriptions for the user for that jour and creneau
@@ -408,6 +591,7 @@ async def assign_user_to_poste(poste: AssignInscriptionPoste):
     """
     
     await db.execute(query, poste.poste, poste.jour, poste.creneau, poste.festival_id, poste.user_id)
+    await notify_inscriptions_changed(poste.festival_id, poste.user_id)
     
     return {"message": "Successfully assigned user to poste"}
 
@@ -426,23 +610,25 @@ async def delete_user_to_poste(poste: AssignInscriptionPoste):
             AND user_id = $5;
     """
     
-    await db.execute(query, poste.poste, poste.jour, poste.creneau, poste.festival_id, poste.user_id)
+    async with db.transaction() as tx:
+        await tx.execute(query, poste.poste, poste.jour, poste.creneau, poste.festival_id, poste.user_id)
     
-    # Remove the inscriptions for the zone benevoles under the poste "Animation" for the same jour and creneau
-    if poste.poste == "Animation":
-        query = """
-        DELETE FROM
-            inscriptions
-        WHERE
-            poste = $1
-            AND jour = $2
-            AND creneau = $3
-            AND is_poste = False
-            AND festival_id = $4
-            AND user_id = $5;
-        """
+        # Remove the inscriptions for the zone benevoles under the poste "Animation" for the same jour and creneau
+        if poste.poste == "Animation":
+            query = """
+            DELETE FROM
+                inscriptions
+            WHERE
+                poste = $1
+                AND jour = $2
+                AND creneau = $3
+                AND is_poste = False
+                AND festival_id = $4
+                AND user_id = $5;
+            """
         
-        await db.execute(query, poste.poste, poste.jour, poste.creneau, poste.festival_id, poste.user_id)
+            await tx.execute(query, poste.poste, poste.jour, poste.creneau, poste.festival_id, poste.user_id)
+    await notify_inscriptions_changed(poste.festival_id, poste.user_id)
     
     return {"message": "Successfully deleted user to poste"}
 
@@ -465,70 +651,59 @@ async def delete_user_to_zone_benevole(zone_benevole: AssignInscriptionZoneBenev
     """
     
     await db.execute(query, zone_benevole.poste, zone_benevole.zone_plan, zone_benevole.zone_benevole_id, zone_benevole.zone_benevole_name, zone_benevole.jour, zone_benevole.creneau, zone_benevole.festival_id, zone_benevole.user_id)
+    await notify_inscriptions_changed(zone_benevole.festival_id, zone_benevole.user_id)
     
     return {"message": "Successfully deleted user to zone benevole"}
 
 
+# The flexibles are read from flexible_slots, kept up to date by a trigger on the inscriptions, see inscription.sql
+# $2 and $3 are NULL to get the flexibles of every jour and creneau
+SELECT_FLEXIBLES_QUERY = """
+    SELECT
+        u.user_id,
+        u.username,
+        jsonb_agg(
+            jsonb_build_object(
+                'poste', i.poste,
+                'creneau', i.creneau,
+                'jour', i.jour
+            )
+        ) AS inscriptions
+    FROM flexible_slots f
+    JOIN inscriptions i
+        ON i.festival_id = f.festival_id AND i.is_poste = True AND i.user_id = f.user_id AND i.jour = f.jour AND i.creneau = f.creneau
+    JOIN users u ON u.user_id = f.user_id
+    WHERE f.festival_id = $1
+        AND f.nb_postes > 1
+        AND ($2::text IS NULL OR (f.jour = $2 AND f.creneau = $3))
+    GROUP BY u.user_id, u.username;
+    """
+SELECT_NB_FLEXIBLES_QUERY = """
+    SELECT jour, creneau, COUNT(*) AS nb_flexibles
+    FROM flexible_slots
+    WHERE festival_id = $1 AND nb_postes > 1
+    GROUP BY jour, creneau;
+    """
+
+
 # Function to get the flexibles with regards to a jour or a creneau
 async def get_flexibles(festival_id: int, jour: str, creneau: str):
-    query = """
-        WITH InscriptionWithRowNum AS (
-            SELECT
-                user_id,
-                poste,
-                jour,
-                creneau,
-                COUNT(*) OVER (PARTITION BY user_id, jour, creneau ORDER BY user_id, jour, creneau) AS partition_num
-            FROM
-                inscriptions
-            WHERE
-                is_poste = True
-                AND festival_id = $1
-                AND JOUR_FILTER
-                AND CRENEAU_FILTER
-        )
-        SELECT
-            u.user_id,
-            u.username,
-            jsonb_agg(
-                jsonb_build_object(
-                    'poste', i.poste,
-                    'creneau', i.creneau,
-                    'jour', i.jour
-                )
-            ) AS inscriptions
-        FROM
-            InscriptionWithRowNum i
-        JOIN
-            users u ON u.user_id = i.user_id
-		WHERE
-			i.partition_num > 1 
-        GROUP BY
-            u.user_id, u.username;
-        """
-        
-    JOUR_FILTER = "jour = $2"
-    CRENEAU_FILTER = "creneau = $3"
-    
-    if jour == "" or creneau == "":
-        JOUR_FILTER = "1 = 1"
-        CRENEAU_FILTER = "1 = 1"
-        
-    query = query.replace("JOUR_FILTER", JOUR_FILTER)
-    query = query.replace("CRENEAU_FILTER", CRENEAU_FILTER)
-    
     if jour == "" or creneau == "":
-        result = await db.fetch_rows(query, festival_id)
-    else:
-        result = await db.fetch_rows(query, festival_id, jour, creneau)
-    
+        jour = creneau = None
+
+    result = await db.fetch_rows(SELECT_FLEXIBLES_QUERY, festival_id, jour, creneau)
+
+    # The jsonb column is already decoded by the connection codec
     result = [dict(row) for row in result]
-    
-    for row in result:
-        row["inscriptions"] = json.loads(row["inscriptions"])
-    
+
     return result
 
+# Function to get the number of flexibles of every jour and creneau of a festival
+async def get_nb_flexibles(festival_id: int):
+    counts = {(row["jour"], row["creneau"]): row["nb_flexibles"] for row in await db.fetch_rows(SELECT_NB_FLEXIBLES_QUERY, festival_id)}
+    festival_slots = await load_festival_slots(db, festival_id)
+    return [{"festival_id": festival_id, "jour": jour, "creneau": creneau, "nb_flexibles": counts.get((jour, creneau), 0)} for jour, creneau in festival_slots]
+
 
 # Function to do express inscriptions to a poste
 async def express_inscription_poste(user: User, inscriptions: ExpressInscriptionPoste):
@@ -536,44 +711,15 @@ async def express_inscription_poste(user: User, inscriptions: ExpressInscription
     jour = inscriptions.jour
     creneau = inscriptions.creneau
     postes = inscriptions.inscriptions
-    # We are going to delete all poste inscriptions for the user for that jour and creneau
-    query = """
-        DELETE FROM
-            inscriptions
-        WHERE
-            user_id = $1
-            AND jour = $2
-            AND creneau = $3
-            AND is_poste = True
-            AND festival_id = $4;
-    """
-    
-    await db.execute(query, user.user_id, jour, creneau, festival_id)
-    
-    # Also remove the inscriptions for the zone benevoles under the poste "Animation" for the same jour and creneau
-    if "Animation" not in [inscription.poste for inscription in postes]:
-        query = """
-        DELETE FROM
-            inscriptions
-        WHERE
-            user_id = $1
-            AND poste = 'Animation'
-            AND jour = $2
-            AND creneau = $3
-            AND is_poste = False
-            AND festival_id = $4;
-        """
-        
-        await db.execute(query, user.user_id, jour, creneau, festival_id)
-    
-    # We are going to insert the new inscriptions
-    query = INSERT_QUERY
-    
-    inscriptions = [(user.user_id, festival_id, inscription.poste, "", "", "", jour, creneau, True) for inscription in postes]
-    
-    await db.execute_many(query, inscriptions)
+    # All poste inscriptions of the user for that jour and creneau are replaced by the new ones, in a single statement
+    # The inscriptions for the zone benevoles under the poste "Animation" are also removed if it is not in the new ones
+    new_inscriptions = [(festival_id, inscription.poste, "", "", "", jour, creneau) for inscription in postes]
+
+    results = await apply_inscriptions_batch(user.user_id, True, [], new_inscriptions, clear=(festival_id, jour, creneau))
+    await notify_inscriptions_changed(festival_id, user.user_id)
     
-    return {"message": "Successfully express inscribed to poste"}
+    results = [{"poste": inscription.poste, "jour": jour, "creneau": creneau, "status": status} for inscription, status in zip(postes, results)]
+    return {"message": "Successfully express inscribed to poste", "results": results}
 
 
 # Function to do express inscriptions to a zone benevole
@@ -582,78 +728,54 @@ async def express_inscription_zone_benevole(user: User, inscriptions: ExpressIns
     jour = inscriptions.jour
     creneau = inscriptions.creneau
     zones_benevoles = inscriptions.inscriptions
-    # We are going to delete all zone benevole inscriptions for the user for that jour and creneau
-    query = """
-        DELETE FROM
-            inscriptions
-        WHERE
-            user_id = $1
-            AND jour = $2
-            AND creneau = $3
-            AND is_poste = False
-            AND festival_id = $4;
+    # All zone benevole inscriptions of the user for that jour and creneau are replaced by the new ones, in a single statement
+    new_inscriptions = [(festival_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, jour, creneau) for inscription in zones_benevoles]
+
+    results = await apply_inscriptions_batch(user.user_id, False, [], new_inscriptions, clear=(festival_id, jour, creneau))
+    await notify_inscriptions_changed(festival_id, user.user_id)
+    
+    results = [{"poste": inscription.poste, "zone_plan": inscription.zone_plan, "zone_benevole_id": inscription.zone_benevole_id, "zone_benevole_name": inscription.zone_benevole_name, "jour": jour, "creneau": creneau, "status": status} for inscription, status in zip(zones_benevoles, results)]
+    return {"message": "Successfully express inscribed to zone benevole", "results": results}
+
+
+# Inscriptions of a user for a festival, in the order of the slots of the festival
+# They are read with the unique index of the inscriptions, which starts with (user_id, festival_id)
+# A slot is double booked if the user is signed up to several postes (or several zones benevoles) for the same jour and creneau
+SELECT_USER_INSCRIPTIONS_QUERY = """
+    SELECT
+        i.is_poste,
+        i.poste,
+        i.zone_plan,
+        i.zone_benevole_id,
+        i.zone_benevole_name,
+        i.jour,
+        i.creneau,
+        i.is_present,
+        COUNT(*) OVER (PARTITION BY i.jour, i.creneau, i.is_poste) > 1 AS is_conflict
+    FROM inscriptions i
+    JOIN festivals f ON f.festival_id = i.festival_id
+    WHERE i.festival_id = $1 AND i.user_id = $2
+    ORDER BY array_position(f.jours, i.jour), array_position(f.creneaux, i.creneau), i.is_poste DESC, i.poste, i.zone_plan, i.zone_benevole_id, i.zone_benevole_name;
     """
-    
-    await db.execute(query, user.user_id, jour, creneau, festival_id)
-    
-    # We are going to insert the new inscriptions
-    query = INSERT_QUERY
-    
-    inscriptions = [(user.user_id, festival_id, inscription.poste, inscription.zone_plan, inscription.zone_benevole_id, inscription.zone_benevole_name, jour, creneau, False) for inscription in zones_benevoles]
-    
-    await db.execute_many(query, inscriptions)
-    
-    return {"message": "Successfully express inscribed to zone benevole"}
 
 
-
-# # Function to get the postes inscriptions of a user
-# async def get_postes_inscriptions_user(user: User):
-#     # First get all of the possible postes
-#     query = SELECT_POSTES_QUERY
-    
-#     result = await db.fetch_rows(query)
-    
-#     to_send = []
-#     for jour in JOURS:
-#         for creneau in CRENEAUX:
-#             to_send += [{"festival_id": row["festival_id"], "poste": row["poste"], "jour": jour, "creneau": creneau, "nb_inscriptions": 0} for row in result]
-    
-#     filter = USER_FILTER
-#     query = SELECT_NB_INS_POSTES_QUERY.replace("CUSTOM_FILTER", filter)
-
-#     result = await db.fetch_rows(query, user.user_id)
-    
-#     # Update the nb_inscriptions for each poste
-#     for row in result:
-#         for poste in to_send:
-#             if row["poste"] == poste["poste"] and row["jour"] == poste["jour"] and row["creneau"] == poste["creneau"]:
-#                 poste["nb_inscriptions"] = row["nb_inscriptions"]
-    
-#     return to_send
-
-
-# # Function to get the zones benevoles inscriptions of a user
-# async def get_zones_benevoles_inscriptions_user(user: User):
-#     # First get all of the possible zone benevoles
-#     query = SELECT_ZONES_BENEVOLES_QUERY
-    
-#     result = await db.fetch_rows(query)
-
-#     to_send = []
-#     for jour in JOURS:
-#         for creneau in CRENEAUX:
-#             to_send += [{"poste": "Animation", "zone_plan": row["zone_plan"], "zone_benevole_id": row["zone_benevole_id"], "zone_benevole_name": row["zone_benevole"], "jour": jour, "creneau": creneau, "nb_inscriptions": 0} for row in result]
-    
-#     filter = USER_FILTER
-#     query = SELECT_NB_INS_ZONES_BENEVOLES_QUERY.replace("CUSTOM_FILTER", filter)
-
-#     result = await db.fetch_rows(query, user.user_id)
-    
-#     # Update the nb_inscriptions for each zone benevole
-#     for row in result:
-#         for zone_benevole in to_send:
-#             if row["zone_plan"] == zone_benevole["zone_plan"] and row["zone_benevole_id"] == zone_benevole["zone_benevole_id"] and row["zone_benevole_name"] == zone_benevole["zone_benevole_name"] and row["jour"] == zone_benevole["jour"] and row["creneau"] == zone_benevole["creneau"]:
-#                 zone_benevole["nb_inscriptions"] = row["nb_inscriptions"]
-                
-#     return to_send
\ No newline at end of file
+# Function to get the postes and zones benevoles inscriptions of a user for a festival
+# The double bookings are flagged on the inscriptions and listed by jour and creneau
+async def get_my_inscriptions(user_id: int, festival_id: int):
+    # Read from the primary, as the ETag of the response is bumped on the primary
+    rows = await db.fetch_rows(SELECT_USER_INSCRIPTIONS_QUERY, festival_id, user_id)
+
+    postes = []
+    zones_benevoles = []
+    conflicts = {}
+    for row in rows:
+        inscription = {**cell_fields(cell_key(row)), "is_present": row["is_present"], "is_conflict": row["is_conflict"]}
+        if row["is_poste"]:
+            postes.append(inscription)
+        else:
+            zones_benevoles.append(inscription)
+        if row["is_conflict"]:
+            conflict = conflicts.setdefault((row["jour"], row["creneau"]), {"jour": row["jour"], "creneau": row["creneau"], "nb_postes": 0, "nb_zones_benevoles": 0})
+            conflict["nb_postes" if row["is_poste"] else "nb_zones_benevoles"] += 1
+
+    return {"festival_id": festival_id, "postes": postes, "zones_benevoles": zones_benevoles, "conflicts": list(conflicts.values())}
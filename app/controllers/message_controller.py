@@ -1,8 +1,10 @@
-from ..database.db_session import get_db
+from ..database.db_session import get_db, get_admin_db
 from ..models.message import MessageSend, MessageSendPoste, MessageSendEveryone
 from .referent_controller import get_users_for_referent
 
 db = get_db()
+# Messages to everyone are bulk inserts, they run on the admin pool
+admin_db = get_admin_db()
 
 
 # Function to send a message
@@ -107,7 +109,7 @@ async def send_message_to_everyone(message: MessageSendEveryone, user_id: int, u
     
     values = [[message.festival_id, user, user_id, username, role, message.message] for user in user_ids]
     
-    await db.insert_many("messages", values, columns)
+    await admin_db.insert_many("messages", values, columns)
     
     return {"message": "Message sent to everyone"}
 
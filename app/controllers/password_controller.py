@@ -0,0 +1,65 @@
+# This file contains the hashing and verification of the passwords
+# bcrypt is slow on purpose (~250 ms), so it runs in a thread pool instead of the event loop
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+# Global variables
+
+# Number of passwords hashed or verified at the same time
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 4))
+# Number of passwords waiting for a worker before the requests are rejected with a 503
+HASH_QUEUE_LIMIT = int(os.environ.get("PASSWORD_HASH_QUEUE_LIMIT", 64))
+# Seconds sent in the Retry-After header of the 503
+HASH_RETRY_AFTER_SECONDS = 2
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+# Number of passwords being hashed or waiting for a worker
+_pending = 0
+
+
+# Function to run a bcrypt operation in the thread pool
+# The bcrypt library releases the GIL, so the workers really run in parallel
+async def _run(function, *args):
+    global _pending
+    if _pending >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, please try again",
+            headers={"Retry-After": str(HASH_RETRY_AFTER_SECONDS)},
+        )
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, function, *args)
+    finally:
+        _pending -= 1
+
+
+# Function to verify the password
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run(pwd_context.verify, plain_password, hashed_password)
+
+
+# Function to hash the password
+async def get_password_hash(password: str) -> str:
+    return await _run(pwd_context.hash, password)
+
+
+# Function to get the state of the thread pool, used by the admin endpoints
+def password_hash_stats() -> dict:
+    return {
+        "workers": HASH_WORKERS,
+        "queue_limit": HASH_QUEUE_LIMIT,
+        "pending": _pending,
+    }
+
+
+# Function to stop the thread pool on shutdown
+def shutdown_password_executor():
+    _executor.shutdown(wait=False, cancel_futures=True)
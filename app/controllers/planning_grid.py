@@ -0,0 +1,255 @@
+# This file contains the construction of the planning grids of the inscriptions
+# A grid has one cell per poste or zone benevole, jour and creneau, with the number of inscriptions
+
+import json
+from array import array
+
+try:
+    import msgpack
+except ImportError:
+    # MessagePack is optional, without it the columnar grids are only sent as JSON
+    msgpack = None
+
+# Jours and creneaux of the festivals that do not define their own
+JOURS = ["Vendredi", "Samedi", "Dimanche"]
+CRENEAUX = ["8h-10h", "10h-12h", "12h-14h", "14h-16h", "16h-18h"]
+# Every zone benevole can take 2 volunteers per creneau
+ZONE_BENEVOLE_MAX_CAPACITY = 2
+
+# Media types of the columnar grids, negotiated with the Accept header
+COLUMNAR_JSON_MEDIA_TYPE = "application/vnd.awi.planning-columnar+json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+# Media types answered with the list of cells
+CELLS_MEDIA_TYPES = ("application/json", "application/*", "*/*")
+
+SELECT_FESTIVAL_SLOTS_QUERY = """
+    SELECT jours, creneaux
+    FROM festivals
+    WHERE festival_id = $1;
+    """
+
+
+# Jours and creneaux of a festival
+# A slot (jour, creneau) is referenced by its index, jour index * number of creneaux + creneau index
+class FestivalSlots:
+
+    def __init__(self, jours: list, creneaux: list):
+        self.jours = list(jours)
+        self.creneaux = list(creneaux)
+        self._indexes = {slot: index for index, slot in enumerate(self)}
+
+    def __iter__(self):
+        for jour in self.jours:
+            for creneau in self.creneaux:
+                yield jour, creneau
+
+    def __len__(self) -> int:
+        return len(self.jours) * len(self.creneaux)
+
+    # Function to get the index of a slot, None if the festival does not have it
+    def index(self, jour: str, creneau: str) -> int | None:
+        return self._indexes.get((jour, creneau))
+
+
+DEFAULT_SLOTS = FestivalSlots(JOURS, CRENEAUX)
+
+
+# Function to get the jours and creneaux of a festival
+async def load_festival_slots(db, festival_id: int) -> FestivalSlots:
+    row = await db.fetch_row(SELECT_FESTIVAL_SLOTS_QUERY, festival_id)
+    # The jours and creneaux of a festival are never NULL nor empty (see festivals in inscription.sql)
+    if row is None:
+        return DEFAULT_SLOTS
+    return FestivalSlots(row["jours"], row["creneaux"])
+
+
+# Function to get the cell of an inscription
+# (poste, jour, creneau) for a poste, (zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau) for a zone benevole
+def cell_key(inscription) -> tuple:
+    if inscription["is_poste"]:
+        return (inscription["poste"], inscription["jour"], inscription["creneau"])
+    return (inscription["zone_plan"], inscription["zone_benevole_id"], inscription["zone_benevole_name"], inscription["jour"], inscription["creneau"])
+
+
+# Function to describe a cell with the columns of its inscriptions
+def cell_fields(key: tuple) -> dict:
+    if len(key) == 3:
+        return {"poste": key[0], "jour": key[1], "creneau": key[2]}
+    return {"poste": "Animation", "zone_plan": key[0], "zone_benevole_id": key[1], "zone_benevole_name": key[2], "jour": key[3], "creneau": key[4]}
+
+
+# Function to describe the new count of a cell, sent to the clients following the planning
+def cell_delta(key: tuple, count: int) -> dict:
+    return {**cell_fields(key), "nb_inscriptions": count}
+
+
+# Function to get the target of a cell (poste or zone benevole), the cell without its jour and creneau
+def cell_target(key: tuple) -> tuple:
+    return key[:-2]
+
+
+# Function to get the target of a poste row
+def poste_target(row) -> tuple:
+    return (row["poste"],)
+
+
+# Function to get the target of a zone benevole row of the csv
+def zone_target(row) -> tuple:
+    return (row["zone_plan"], row["zone_benevole_id"], row["zone_benevole"])
+
+
+# Number of inscriptions of every target (poste or zone benevole) and slot of a festival
+# The counts are stored in a dense array, row by target: counts[target index * number of slots + slot index]
+class Occupancy:
+
+    def __init__(self, targets: list, slots: FestivalSlots):
+        self.targets = targets
+        self.slots = slots
+        self._target_indexes = {target: index for index, target in enumerate(targets)}
+        self.counts = array("i", [0]) * (len(targets) * len(slots))
+
+    # Function to get the position of a cell in counts, None if the cell is not in the grid
+    def position(self, key: tuple) -> int | None:
+        target_index = self._target_indexes.get(cell_target(key))
+        slot_index = self.slots.index(key[-2], key[-1])
+        if target_index is None or slot_index is None:
+            return None
+        return target_index * len(self.slots) + slot_index
+
+    # Function to add delta to the count of a cell, nothing is done if the cell is not in the grid
+    def add(self, key: tuple, delta: int):
+        position = self.position(key)
+        if position is not None:
+            self.counts[position] += delta
+
+    def count(self, key: tuple) -> int:
+        position = self.position(key)
+        return 0 if position is None else self.counts[position]
+
+    # Function to get the counts of all the slots of a target
+    def target_counts(self, target_index: int) -> array:
+        nb_slots = len(self.slots)
+        return self.counts[target_index * nb_slots:(target_index + 1) * nb_slots]
+
+    # Function to get the share of the places taken, capacities has the capacity of every target
+    # The inscriptions over the capacity of a cell are not counted
+    def fill_rate(self, capacities: list) -> float:
+        places = filled = 0
+        for target_index, capacity in enumerate(capacities):
+            places += capacity * len(self.slots)
+            filled += sum(min(count, capacity) for count in self.target_counts(target_index))
+        return filled / places if places else 1.0
+
+
+# Function to build the grid of the postes
+# postes are the rows of the postes table, occupancy the number of inscriptions of these postes (in the same order)
+# and registered the cells in which the user is signed up
+def build_postes_grid(postes, occupancy: Occupancy, registered) -> list:
+    to_send = []
+    nb_slots = len(occupancy.slots)
+    counts = occupancy.counts
+    for slot_index, (jour, creneau) in enumerate(occupancy.slots):
+        for target_index, row in enumerate(postes):
+            key = (row["poste"], jour, creneau)
+            to_send.append({"festival_id": row["festival_id"], "poste": row["poste"], "jour": jour, "creneau": creneau, "nb_inscriptions": counts[target_index * nb_slots + slot_index], "is_register": key in registered, "max_capacity": row["max_capacity"]})
+    return to_send
+
+
+# Function to build the grid of the zones benevoles
+# zones are the distinct zones to animate of the csv
+def build_zones_grid(zones, occupancy: Occupancy, registered) -> list:
+    to_send = []
+    nb_slots = len(occupancy.slots)
+    counts = occupancy.counts
+    for slot_index, (jour, creneau) in enumerate(occupancy.slots):
+        for target_index, row in enumerate(zones):
+            key = (row["zone_plan"], row["zone_benevole_id"], row["zone_benevole"], jour, creneau)
+            to_send.append({"festival_id": row["festival_id"], "poste": "Animation", "zone_plan": row["zone_plan"], "zone_benevole_id": row["zone_benevole_id"], "zone_benevole_name": row["zone_benevole"], "jour": jour, "creneau": creneau, "nb_inscriptions": counts[target_index * nb_slots + slot_index], "is_register": key in registered, "max_capacity": ZONE_BENEVOLE_MAX_CAPACITY})
+    return to_send
+
+
+# Function to build a grid in the columnar format, much smaller than the list of cells
+# jours, creneaux and targets (the postes or zones benevoles) are sent once, max_capacity has the capacity of every target
+# nb_inscriptions has the counts by position (target index * number of slots + slot index, see Occupancy)
+# and registered the positions of the cells in which the user is signed up
+def build_columnar_grid(festival_id: int, targets: list, capacities: list, occupancy: Occupancy, registered) -> dict:
+    positions = (occupancy.position(key) for key in registered)
+    return {
+        "festival_id": festival_id,
+        "jours": occupancy.slots.jours,
+        "creneaux": occupancy.slots.creneaux,
+        "targets": targets,
+        "max_capacity": capacities,
+        "nb_inscriptions": occupancy.counts.tolist(),
+        "registered": sorted(position for position in positions if position is not None),
+    }
+
+
+def postes_columnar_grid(festival_id: int, postes, occupancy: Occupancy, registered) -> dict:
+    return build_columnar_grid(festival_id, [{"poste": row["poste"]} for row in postes], [row["max_capacity"] for row in postes], occupancy, registered)
+
+
+def zones_columnar_grid(festival_id: int, zones, occupancy: Occupancy, registered) -> dict:
+    targets = [{"zone_plan": row["zone_plan"], "zone_benevole_id": row["zone_benevole_id"], "zone_benevole_name": row["zone_benevole"]} for row in zones]
+    return build_columnar_grid(festival_id, targets, [ZONE_BENEVOLE_MAX_CAPACITY] * len(zones), occupancy, registered)
+
+
+# Function to convert a list of cells (as built by the database) to the columnar format
+# The targets are taken in the order of the cells
+def columnar_grid_from_cells(festival_id: int, cells: list, slots: FestivalSlots) -> dict:
+    targets = {}
+    capacities = {}
+    keys = []
+    for cell in cells:
+        is_poste = "zone_plan" not in cell
+        key = cell_key({**cell, "is_poste": is_poste})
+        fields = ("poste",) if is_poste else ("zone_plan", "zone_benevole_id", "zone_benevole_name")
+        targets.setdefault(cell_target(key), {field: cell[field] for field in fields})
+        capacities.setdefault(cell_target(key), cell["max_capacity"])
+        keys.append(key)
+    occupancy = Occupancy(list(targets), slots)
+    for key, cell in zip(keys, cells):
+        occupancy.add(key, cell["nb_inscriptions"])
+    registered = [key for key, cell in zip(keys, cells) if cell["is_register"]]
+    return build_columnar_grid(festival_id, list(targets.values()), list(capacities.values()), occupancy, registered)
+
+
+# Function to choose the format of a grid from the Accept header
+# Returns "msgpack", "columnar" or "cells" (the list of cells, also for application/json and the wildcards)
+# The format with the highest q value is taken, q=0 refuses a media type
+# On a tie a media type is preferred to a wildcard, then the first one listed is taken
+# MessagePack is sent as columnar JSON when the msgpack package is not installed
+def negotiate_grid_format(accept: str | None) -> str:
+    if not accept:
+        return "cells"
+    best_format, best_rank = None, (0.0, False)
+    for media_range in accept.split(","):
+        media_type, *params = [part.strip().lower() for part in media_range.split(";")]
+        if media_type in MSGPACK_MEDIA_TYPES:
+            grid_format = "msgpack" if msgpack is not None else "columnar"
+        elif media_type == COLUMNAR_JSON_MEDIA_TYPE:
+            grid_format = "columnar"
+        elif media_type in CELLS_MEDIA_TYPES:
+            grid_format = "cells"
+        else:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        rank = (q, "*" not in media_type)
+        if q > 0 and rank > best_rank:
+            best_format, best_rank = grid_format, rank
+    # The list of cells is also sent when no media type of the grids is accepted
+    return best_format or "cells"
+
+
+# Function to encode a columnar grid in the negotiated format, returns the body and its media type
+def encode_columnar_grid(grid: dict, grid_format: str) -> tuple:
+    if grid_format == "msgpack":
+        return msgpack.packb(grid), MSGPACK_MEDIA_TYPES[0]
+    return json.dumps(grid, separators=(",", ":")).encode(), COLUMNAR_JSON_MEDIA_TYPE
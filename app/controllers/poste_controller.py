@@ -1,4 +1,5 @@
 from ..database.db_session import get_db
+from ..cache.planning_events import plannings_invalidated
 
 db = get_db()
 
@@ -12,6 +13,8 @@ async def create_poste(festival_id: int, poste: str, description_poste: str, max
         ON CONFLICT (festival_id, poste) DO NOTHING;"""
     
         result = await db.execute(query, festival_id, poste, description_poste, max_capacity)
+        # The postes are part of the planning of the festival
+        await plannings_invalidated(db, festival_id)
     
         return { "message" :"Poste created successfully" }
 
@@ -24,6 +27,7 @@ async def get_all_postes(festival_id: int):
         FROM postes
         WHERE festival_id = $1;"""
     
+        # Not read from a replica, the ETag of poste_router.py must not be given to postes older than it
         result = await db.fetch_rows(query, festival_id)
         
         result = [dict(row) for row in result]
@@ -38,6 +42,7 @@ async def delete_poste(festival_id: int, poste: str):
         WHERE festival_id = $1 AND poste = $2;"""
     
         result = await db.execute(query, festival_id, poste)
+        await plannings_invalidated(db, festival_id)
     
         return { "message" :"Poste deleted successfully" }
 
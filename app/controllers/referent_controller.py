@@ -1,6 +1,5 @@
 from ..database.db_session import get_db
-import json
-from .user_controller import get_role_ids
+from .user_controller import get_role_ids, bump_token_version
 
 db = get_db()
 
@@ -33,6 +32,8 @@ async def assign_referent_to_poste(user_id: int, poste_id: int, festival_id: int
         """
         
         result = await db.execute(query, user_id, ref_role_id)
+        # The roles of the user changed, the roles in his tokens are revoked
+        await bump_token_version(user_id)
 
     return { "message" :"Referent assigned to poste successfully" }
 
@@ -60,6 +61,8 @@ async def unassign_referent_from_poste(user_id: int, poste_id: int, festival_id:
         """
         
         result = await db.execute(query, user_id, ref_role_id)
+        # The roles of the user changed, the roles in his tokens are revoked
+        await bump_token_version(user_id)
 
     return { "message" :"Referent unassigned from poste successfully" }
 
@@ -109,13 +112,11 @@ async def get_users_for_referent(user_id: int, festival_id: int):
         postes.poste_id, inscriptions.poste;
         """
     
-    result = await db.fetch_rows(query, user_id, festival_id)
+    result = await db.fetch_rows(query, user_id, festival_id, read_only=True)
     
+    # The jsonb column is already decoded by the connection codec
     result = [dict(row) for row in result]
     
-    for row in result:
-        row["inscriptions"] = json.loads(row["inscriptions"])
-    
     return result
     
     
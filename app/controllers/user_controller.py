@@ -1,12 +1,48 @@
+import base64
+import json
+
+from fastapi import HTTPException
+
 from ..database.db_session import get_db
-from ..models.user import User, UpdateUser
-from passlib.context import CryptContext
+from ..models.user import User, UpdateUser, UserPage, UserSummary
+from ..cache.user_cache import user_cache
+from ..cache.planning_events import user_deleted
+from ..cache.token_revocations import token_revocations, REVOCATION_CHANNEL
+from ..controllers.password_controller import get_password_hash
 
 # Global variables
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 db = get_db()
 
+# Query used to authenticate every request, it is prepared on every connection
+FIND_USER_BY_USERNAME_QUERY = """
+    SELECT
+        u.user_id,
+        u.username,
+        u.email,
+        u.telephone,
+        u.password,
+        u.disabled,
+        array_agg(r.role_name) AS roles,
+        u.prenom,
+        u.nom,
+        u.tshirt,
+        u.vegan,
+        u.hebergement,
+        u.association,
+        u.token_version
+    FROM
+        users u
+    JOIN
+        user_roles ur ON u.user_id = ur.user_id
+    JOIN
+        roles r ON ur.role_id = r.role_id
+    WHERE
+        u.username = $1
+    GROUP BY
+        u.user_id, u.username, u.email;
+    """
+db.register_statement("find_user_by_username", FIND_USER_BY_USERNAME_QUERY)
+
 """class User(BaseModel):
     user_id: int | None = None
     username: str
@@ -29,48 +65,29 @@ async def create_user(user: User):
     VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
     RETURNING user_id;
     """
-    user_id = await db.fetch_val(query, user.username, user.email, user.telephone, user.password, user.nom, user.prenom, user.tshirt, user.vegan, user.hebergement, user.association)
-    query = """
-    INSERT INTO user_roles (user_id, role_id)
-    VALUES ($1, $2);
-    """
     role_ids = await get_role_ids(user.roles)
-    for role in role_ids:
-        await db.execute(query, user_id, role)
+    # The user and its roles are inserted in a single transaction
+    async with db.transaction() as tx:
+        user_id = await tx.fetch_val(query, user.username, user.email, user.telephone, user.password, user.nom, user.prenom, user.tshirt, user.vegan, user.hebergement, user.association)
+        query = """
+        INSERT INTO user_roles (user_id, role_id)
+        VALUES ($1, $2);
+        """
+        await tx.execute_many(query, [(user_id, role) for role in role_ids])
     return { "message": "User successfully created" }
 
 
 # Function to get the user from the database using the username
 async def find_user_by_username(username: str) -> User:
-    query = """
-    SELECT
-        u.user_id,
-        u.username,
-        u.email,
-        u.telephone,
-        u.password,
-        u.disabled,
-        array_agg(r.role_name) AS roles,
-        u.prenom,
-        u.nom,
-        u.tshirt,
-        u.vegan,
-        u.hebergement,
-        u.association
-    FROM
-        users u
-    JOIN
-        user_roles ur ON u.user_id = ur.user_id
-    JOIN
-        roles r ON ur.role_id = r.role_id
-    WHERE
-        u.username = $1
-    GROUP BY
-        u.user_id, u.username, u.email;
-    """
-    result = await db.fetch_row(query, username)
+    user, _ = await find_user_and_token_version(username)
+    return user
+
+# Function to get the user and its token version using the username, (None, None) if it does not exist
+# The version is put in the tokens, it is not a field of User as the user is returned by the routes
+async def find_user_and_token_version(username: str) -> tuple:
+    result = await db.fetch_row_prepared("find_user_by_username", username)
     if result is None:
-        return None
+        return None, None
     user_dict = dict(result)
     user = User(
         user_id=user_dict["user_id"],
@@ -88,7 +105,21 @@ async def find_user_by_username(username: str) -> User:
         hebergement=user_dict["hebergement"],
         association=user_dict["association"]
         )
-    return user
+    return user, user_dict["token_version"]
+
+# Function to get the user using the username, from the cache if possible
+# Used by the authentication of every request, the returned user has no password
+async def find_user_by_username_cached(username: str) -> User:
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    generation = user_cache.generation
+    user = await find_user_by_username(username)
+    if user is None:
+        return None
+    user.password = ""
+    user_cache.set(user, generation)
+    return user.model_copy()
 
 # Function to get the user from the database using the email
 async def find_user_by_email(email: str) -> User:
@@ -189,6 +220,36 @@ async def find_user_by_user_id(user_id: int) -> User:
     return user
 
 
+# Function to bump the token version of a user
+# All of the access tokens created before are revoked (stateless token verification)
+async def bump_token_version(user_id: int):
+    query = """
+    WITH bumped AS (
+        UPDATE users SET token_version = token_version + 1 WHERE user_id = $1 RETURNING user_id, token_version
+    )
+    SELECT token_version, pg_notify($2, user_id || ':' || token_version) FROM bumped;
+    """
+    version = await db.fetch_val(query, user_id, REVOCATION_CHANNEL)
+    if version is not None:
+        token_revocations.revoke(user_id, version)
+    user_cache.invalidate(user_id)
+
+
+# Function to revoke all of the tokens of a banned or deleted user
+# reason is "disabled" or "deleted"
+async def revoke_user_tokens(user_id: int, reason: str):
+    if reason == "disabled":
+        token_revocations.disable(user_id)
+    else:
+        token_revocations.delete(user_id)
+    # Tell the other workers
+    query = """
+    SELECT pg_notify($1, $2);
+    """
+    await db.execute(query, REVOCATION_CHANNEL, f"{user_id}:{reason}")
+    user_cache.invalidate(user_id)
+
+
 # Function that returns the role ids of the roles passed in parameter
 async def get_role_ids(roles: list[str]) -> list[int]:
     roles = "(" + ", ".join([f"'{role}'" for role in roles]) + ")"
@@ -210,6 +271,7 @@ async def ban_user_by_user_id(user_id: int):
     UPDATE users SET disabled = true WHERE user_id = $1;
     """
     await db.execute(query, user_id)
+    await revoke_user_tokens(user_id, "disabled")
     return { "message": "User successfully banned" }
 
 
@@ -266,16 +328,106 @@ async def get_all_users(page: int, limit: int):
     return users
 
 
+# Query of the cursor pagination, the page is selected on the primary key before joining the roles
+# so that a deep page costs the same as the first one
+# $1 is the last user_id of the previous page, $2 the number of users + 1 to know if there is a next page
+# $3 is an optional ILIKE filter on the username
+SELECT_USERS_AFTER_QUERY = """
+    SELECT
+        u.user_id,
+        u.username,
+        u.email,
+        u.telephone,
+        u.disabled,
+        COALESCE(array_agg(r.role_name) FILTER (WHERE r.role_name IS NOT NULL), '{}') AS roles,
+        u.prenom,
+        u.nom,
+        u.tshirt,
+        u.vegan,
+        u.hebergement,
+        u.association
+    FROM (
+        SELECT *
+        FROM users
+        WHERE user_id > $1
+        AND ($3::text IS NULL OR username ILIKE $3)
+        ORDER BY user_id
+        LIMIT $2
+    ) u
+    LEFT JOIN
+        user_roles ur ON u.user_id = ur.user_id
+    LEFT JOIN
+        roles r ON ur.role_id = r.role_id
+    GROUP BY
+        u.user_id, u.username, u.email, u.telephone, u.disabled, u.prenom, u.nom, u.tshirt, u.vegan, u.hebergement, u.association
+    ORDER BY
+        u.user_id;
+    """
+
+
+# Function to create the opaque cursor pointing after a user
+def encode_cursor(user_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"after": user_id}).encode()).decode()
+
+
+# Function to read a cursor, an empty cursor is the first page
+# The user_id of the cursor must fit in the INTEGER user_id column
+def decode_cursor(cursor: str) -> int:
+    if not cursor:
+        return 0
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode()))["after"]
+    except (ValueError, KeyError, TypeError, OverflowError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(after, int) or isinstance(after, bool) or not 0 <= after < 2**31:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after
+
+
+# Function to get a page of users with the cursor pagination
+async def get_users_after(cursor: str, limit: int, username: str | None = None):
+    after = decode_cursor(cursor)
+    limit = max(limit, 1)
+    pattern = f"%{username}%" if username is not None else None
+    result = await db.fetch_rows(SELECT_USERS_AFTER_QUERY, after, limit + 1, pattern, read_only=True)
+    users = []
+    for row in result[:limit]:
+        user_dict = dict(row)
+        user = User(
+            user_id=user_dict["user_id"],
+            username=user_dict["username"],
+            email=user_dict["email"],
+            telephone=user_dict["telephone"],
+            disabled=user_dict["disabled"], 
+            password="",
+            roles=user_dict["roles"],
+            prenom=user_dict["prenom"],
+            nom=user_dict["nom"],
+            tshirt=user_dict["tshirt"],
+            vegan=user_dict["vegan"],
+            hebergement=user_dict["hebergement"],
+            association=user_dict["association"]
+            )
+        users.append(user)
+    next_cursor = encode_cursor(users[-1].user_id) if len(result) > limit else None
+    return UserPage(users=users, next_cursor=next_cursor)
+
+
 # Function to delete all personal data
 async def delete_data(user: User):
     query = """
     DELETE FROM users WHERE user_id = $1;
     """
     await db.execute(query, user.user_id)
+    await revoke_user_tokens(user.user_id, "deleted")
+    # The inscriptions of the user are deleted with it
+    await user_deleted(db, user.user_id)
     return { "message": "Data successfully deleted" }
 
 # Function to update user info
 async def update_user_info(user: User, new_info: UpdateUser):
+    # The authenticated user may only carry the claims of the token, get the full user
+    user = await find_user_by_user_id(user.user_id)
     # Check if username already exists
     if new_info.username != user.username:
         user_exists = await find_user_by_username(new_info.username)
@@ -303,6 +455,10 @@ async def update_user_info(user: User, new_info: UpdateUser):
         user_id = $10;
     """
     await db.execute(query, new_info.username, new_info.email, new_info.telephone, new_info.nom, new_info.prenom, new_info.tshirt, new_info.vegan, new_info.hebergement, new_info.association, user.user_id)
+    # The tokens carry the username
+    if new_info.username != user.username:
+        await bump_token_version(user.user_id)
+    user_cache.invalidate(user.user_id)
     return { "message": "User info successfully updated" }
 
 # Function to search for users by username with pagination
@@ -360,9 +516,106 @@ async def search_users(page: int, limit: int, username: str):
     return users
 
 
+# Query of the search across the username, names, email and telephone
+# The matches use the trigram indexes, both substrings (ILIKE) and fuzzy words (<%), ranked by similarity
+# $1 is the search text, $2 the ILIKE pattern, $3 the limit and $4 the offset
+SEARCH_USERS_QUERY = """
+    SELECT
+        u.user_id,
+        u.username,
+        u.email,
+        u.telephone,
+        u.disabled,
+        COALESCE(array_agg(r.role_name) FILTER (WHERE r.role_name IS NOT NULL), '{}') AS roles,
+        u.prenom,
+        u.nom,
+        u.tshirt,
+        u.vegan,
+        u.hebergement,
+        u.association
+    FROM (
+        SELECT
+            *,
+            GREATEST(
+                word_similarity($1, username),
+                word_similarity($1, nom),
+                word_similarity($1, prenom),
+                word_similarity($1, email),
+                word_similarity($1, telephone)
+            ) AS rank
+        FROM users
+        WHERE
+            username ILIKE $2
+            OR nom ILIKE $2
+            OR prenom ILIKE $2
+            OR email ILIKE $2
+            OR telephone ILIKE $2
+            OR $1 <% username
+            OR $1 <% nom
+            OR $1 <% prenom
+        ORDER BY rank DESC, user_id
+        LIMIT $3 OFFSET $4
+    ) u
+    LEFT JOIN
+        user_roles ur ON u.user_id = ur.user_id
+    LEFT JOIN
+        roles r ON ur.role_id = r.role_id
+    GROUP BY
+        u.user_id, u.username, u.email, u.telephone, u.disabled, u.prenom, u.nom, u.tshirt, u.vegan, u.hebergement, u.association, u.rank
+    ORDER BY
+        u.rank DESC, u.user_id;
+    """
+
+# Query of the autocomplete, only the prefix index of the usernames is read
+AUTOCOMPLETE_USERS_QUERY = """
+    SELECT user_id, username
+    FROM users
+    WHERE lower(username) LIKE $1
+    ORDER BY lower(username)
+    LIMIT $2;
+    """
+
+
+# Function to escape the wildcards of a LIKE pattern
+def escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# Function to search the users by username, nom, prenom, email or telephone
+async def search_users_ranked(text: str, page: int, limit: int):
+    offset = (page - 1) * limit
+    result = await db.fetch_rows(SEARCH_USERS_QUERY, text, f"%{escape_like(text)}%", limit, offset, read_only=True)
+    users = []
+    for row in result:
+        user_dict = dict(row)
+        user = User(
+            user_id=user_dict["user_id"],
+            username=user_dict["username"],
+            email=user_dict["email"],
+            telephone=user_dict["telephone"],
+            disabled=user_dict["disabled"], 
+            password="",
+            roles=user_dict["roles"],
+            prenom=user_dict["prenom"],
+            nom=user_dict["nom"],
+            tshirt=user_dict["tshirt"],
+            vegan=user_dict["vegan"],
+            hebergement=user_dict["hebergement"],
+            association=user_dict["association"]
+            )
+        users.append(user)
+    return users
+
+
+# Function to autocomplete the usernames starting with a prefix
+async def autocomplete_users(prefix: str, limit: int):
+    result = await db.fetch_rows(AUTOCOMPLETE_USERS_QUERY, escape_like(prefix.lower()) + "%", limit, read_only=True)
+    return [UserSummary(user_id=row["user_id"], username=row["username"]) for row in result]
+
+
 # Function to update user password
 async def update_user_password(user_id: int, new_password: str):
-    hashed_password = pwd_context.hash(new_password)
+    hashed_password = await get_password_hash(new_password)
     query = """
     UPDATE users
     SET
@@ -371,4 +624,6 @@ async def update_user_password(user_id: int, new_password: str):
         user_id = $2;
     """
     await db.execute(query, hashed_password, user_id)
+    # Log out the other sessions
+    await bump_token_version(user_id)
     return { "message": "Password successfully updated" }
\ No newline at end of file
@@ -1,18 +1,98 @@
+import asyncio
 import asyncpg
+import functools
+import json
 import os
+import sys
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from .query_stats import QueryStats, count_rows, percentile
+
+
+# Decorator to time the functions of the Database and of the Transaction
+# The duration, number of rows and caller of every query are recorded in the query stats
+def timed(function):
+    @functools.wraps(function)
+    async def wrapper(self, query, *args, **kwargs):
+        # Name of the controller function that executes the query
+        caller = sys._getframe(1).f_code.co_name
+        statement = query
+        # For insert_many the first argument is the name of the table
+        if function.__name__ == "insert_many":
+            statement = f"COPY {query}"
+        # For the prepared functions the first argument is the name of the statement
+        elif function.__name__.endswith("_prepared"):
+            statement = f"PREPARED {query}"
+        start = time.perf_counter()
+        failed = True
+        result = None
+        try:
+            result = await function(self, query, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            rows = len(args[0]) if function.__name__.startswith("execute_many") else count_rows(result)
+            self.stats.record(statement, args, duration_ms, rows, caller, failed)
+    return wrapper
+
+
+# Id of the user of the current request, set by the authentication
+# It is used to send the reads of a user to the primary for a short time after his own writes
+current_user_id = ContextVar("current_user_id", default=None)
+
+
+# Connection class used by the pool
+# It keeps the hot statements prepared on the connection, by name
+class Connection(asyncpg.Connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = {}
+
 
 class Database:
 
-    # Initialize the database 
-    def __init__(self):
+    # Initialize the database
+    # The size and timeouts of the pool can be configured with the environment variables
+    # {env_prefix}_MIN_SIZE, {env_prefix}_MAX_SIZE, {env_prefix}_COMMAND_TIMEOUT and {env_prefix}_ACQUIRE_TIMEOUT
+    # Read replicas can be given as a comma separated list of DSNs in {env_prefix}_REPLICA_DSNS
+    def __init__(self, name: str = "main", env_prefix: str = "DB_POOL", min_size: int = 10, max_size: int = 30, command_timeout: float = 60, acquire_timeout: float = 30):
+        self.name = name
+        self.min_size = int(os.environ.get(f"{env_prefix}_MIN_SIZE", min_size))
+        self.max_size = int(os.environ.get(f"{env_prefix}_MAX_SIZE", max_size))
+        self.command_timeout = float(os.environ.get(f"{env_prefix}_COMMAND_TIMEOUT", command_timeout))
+        self.acquire_timeout = float(os.environ.get(f"{env_prefix}_ACQUIRE_TIMEOUT", acquire_timeout))
         self.user = os.environ.get("POSTGRES_USER_1")
         self.password = os.environ.get("POSTGRES_PASSWORD_1")
         self.host = os.environ.get("POSTGRES_HOST_1")
         self.port = os.environ.get("POSTGRES_PORT_1")
         self.database = os.environ.get("POSTGRES_DB_1")
         self._cursor = None
+        self.replica_dsns = [dsn.strip() for dsn in os.environ.get(f"{env_prefix}_REPLICA_DSNS", "").split(",") if dsn.strip()]
+        # Time during which the reads of a user go to the primary after one of his writes
+        self.read_your_writes_seconds = float(os.environ.get(f"{env_prefix}_READ_YOUR_WRITES_SECONDS", 5))
+        self.stats = QueryStats()
+        # Registry of the hot statements (name -> query) prepared on every connection
+        self._hot_statements = {}
+
+        # Statistics of the pool
+        self._waiters = 0
+        self._acquire_count = 0
+        self._acquire_timeouts = 0
+        self._acquire_wait_total_ms = 0.0
+        self._acquire_wait_max_ms = 0.0
+        self._acquire_waits = deque(maxlen=1000)
 
         self._connection_pool = None
+        self._replica_pools = []
+        self._replica_index = 0
+        # user_id -> time until which his reads go to the primary
+        self._recent_writers = {}
+        # Dedicated connection for LISTEN, it is not part of the pool
+        self._listen_connection = None
 
     # Function to connect to the database
     # Create a connection pool
@@ -20,36 +100,177 @@ class Database:
         if not self._connection_pool:
             try:
                 self._connection_pool = await asyncpg.create_pool(
-                    min_size=10,
-                    max_size=30,
-                    command_timeout=60,
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                    command_timeout=self.command_timeout,
                     host=self.host,
                     port=self.port,
                     user=self.user,
                     password=self.password,
                     database=self.database,
+                    connection_class=Connection,
+                    init=self._init_connection,
                 )
 
             except Exception as e:
                 print("Database ERROR while connecting: ", e)
                 raise e
+
+            # Create a pool for each read replica
+            # A replica that is not reachable is skipped, its reads go to the primary
+            for dsn in self.replica_dsns:
+                try:
+                    replica_pool = await asyncpg.create_pool(
+                        dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        command_timeout=self.command_timeout,
+                        connection_class=Connection,
+                        init=self._init_connection,
+                    )
+                    self._replica_pools.append(replica_pool)
+                except Exception as e:
+                    print("Database ERROR while connecting to replica: ", e)
     
+    # Function called on every new connection of the pool
+    async def _init_connection(self, con: Connection):
+        # Decode json and jsonb columns directly into python objects
+        for type_name in ["json", "jsonb"]:
+            await con.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+        # Prepare the hot statements so that they are planned once per connection
+        for name, query in self._hot_statements.items():
+            try:
+                con.prepared_statements[name] = await con.prepare(query)
+            except Exception as e:
+                # The statement will be prepared on first use instead
+                print(f"Database ERROR while preparing statement {name}: ", e)
+
+    # Function to register a hot statement
+    # It is prepared on every connection of the pool and can be called by name
+    # with the *_prepared functions, example: db.fetch_row_prepared("find_user_by_username", username)
+    def register_statement(self, name: str, query: str):
+        self._hot_statements[name] = query
+
+    # Function to get a prepared statement of a connection by name
+    async def _get_prepared(self, con: Connection, name: str):
+        statement = con.prepared_statements.get(name)
+        if statement is None:
+            # Registered after the connection was created
+            statement = await con.prepare(self._hot_statements[name])
+            con.prepared_statements[name] = statement
+        return statement
+
+    # Function to get a connection from the pool
+    # It keeps track of the number of waiters and of the time spent waiting
+    async def _acquire(self, pool=None):
+        if pool is None:
+            pool = self._connection_pool
+        self._waiters += 1
+        start = time.perf_counter()
+        try:
+            return await pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._acquire_timeouts += 1
+            print(f"Database ERROR: no connection available in the {self.name} pool after {self.acquire_timeout} s")
+            raise
+        finally:
+            self._waiters -= 1
+            wait_ms = (time.perf_counter() - start) * 1000
+            self._acquire_count += 1
+            self._acquire_wait_total_ms += wait_ms
+            self._acquire_wait_max_ms = max(self._acquire_wait_max_ms, wait_ms)
+            self._acquire_waits.append(wait_ms)
+
+    # Function to choose the pool of a read
+    # Read only queries go to the replicas (round robin), except for a user that just wrote
+    def _read_pool(self, read_only: bool):
+        if not read_only or not self._replica_pools:
+            return self._connection_pool
+        user_id = current_user_id.get()
+        if user_id is not None and self._recent_writers.get(user_id, 0) > time.monotonic():
+            return self._connection_pool
+        self._replica_index = (self._replica_index + 1) % len(self._replica_pools)
+        return self._replica_pools[self._replica_index]
+
+    # Function to remember that the current user wrote to the primary
+    def _mark_write(self):
+        if not self._replica_pools:
+            return
+        user_id = current_user_id.get()
+        if user_id is None:
+            return
+        now = time.monotonic()
+        # Forget the expired writers from time to time
+        if len(self._recent_writers) > 10000:
+            self._recent_writers = {key: until for key, until in self._recent_writers.items() if until > now}
+        self._recent_writers[user_id] = now + self.read_your_writes_seconds
+
+    # Function to get the live statistics of the pool
+    def pool_stats(self) -> dict:
+        size = self._connection_pool.get_size() if self._connection_pool else 0
+        idle = self._connection_pool.get_idle_size() if self._connection_pool else 0
+        waits = sorted(self._acquire_waits)
+        return {
+            "name": self.name,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "waiters": self._waiters,
+            "acquire_count": self._acquire_count,
+            "acquire_timeouts": self._acquire_timeouts,
+            "acquire_wait_mean_ms": round(self._acquire_wait_total_ms / self._acquire_count, 3) if self._acquire_count else 0,
+            "acquire_wait_p95_ms": round(percentile(waits, 95), 3),
+            "acquire_wait_max_ms": round(self._acquire_wait_max_ms, 3),
+            "replicas": [{"size": pool.get_size(), "in_use": pool.get_size() - pool.get_idle_size(), "idle": pool.get_idle_size()} for pool in self._replica_pools],
+        }
+
+    # Function to listen to a postgres channel (LISTEN/NOTIFY)
+    # The callback is called with the payload of every notification
+    async def listen(self, channel: str, callback):
+        if not self._listen_connection:
+            try:
+                self._listen_connection = await asyncpg.connect(
+                    host=self.host,
+                    port=self.port,
+                    user=self.user,
+                    password=self.password,
+                    database=self.database,
+                )
+            except Exception as e:
+                print("Database ERROR while connecting the listener: ", e)
+                raise e
+        await self._listen_connection.add_listener(channel, lambda connection, pid, channel, payload: callback(payload))
+
     # Function to close the connection pool
     async def close(self):
+        if self._listen_connection:
+            await self._listen_connection.close()
+            self._listen_connection = None
         if self._connection_pool:
             await self._connection_pool.close()
             self._connection_pool = None
+        for pool in self._replica_pools:
+            await pool.close()
+        self._replica_pools = []
 
     # All of the functions below will first try and
     # get a connection from the connection pool
     # and then after executing the query, release the connection
+    # The fetch functions can be given read_only=True to be sent to a read replica
 
     # Function to fetch multiple rows
-    async def fetch_rows(self, query: str, *args):
+    @timed
+    async def fetch_rows(self, query: str, *args, read_only: bool = False):
         if not self._connection_pool:
             await self.connect()
         else:
-            con = await self._connection_pool.acquire()
+            if not read_only:
+                # The query may write, like INSERT ... RETURNING
+                self._mark_write()
+            pool = self._read_pool(read_only)
+            con = await self._acquire(pool)
             try:
                 result = await con.fetch(query, *args)
                 return result
@@ -57,14 +278,18 @@ class Database:
                 print("Database ERROR while fetching rows: ", e)
                 raise e
             finally:
-                await self._connection_pool.release(con)
+                await pool.release(con)
 
     # Function to fetch a single row
-    async def fetch_row(self, query: str, *args):
+    @timed
+    async def fetch_row(self, query: str, *args, read_only: bool = False):
         if not self._connection_pool:
             await self.connect()
         else:
-            con = await self._connection_pool.acquire()
+            if not read_only:
+                self._mark_write()
+            pool = self._read_pool(read_only)
+            con = await self._acquire(pool)
             try:
                 result = await con.fetchrow(query, *args)
                 return result
@@ -72,15 +297,19 @@ class Database:
                 print("Database ERROR while fetching row: ", e)
                 raise e
             finally:
-                await self._connection_pool.release(con)
+                await pool.release(con)
     
     # Function to execute a query that returns a single value
     # Example: INSERT INTO users (username, email, password) VALUES ($1, $2, $3) RETURNING user_id;
-    async def fetch_val(self, query: str, *args):
+    @timed
+    async def fetch_val(self, query: str, *args, read_only: bool = False):
         if not self._connection_pool:
             await self.connect()
         else:
-            con = await self._connection_pool.acquire()
+            if not read_only:
+                self._mark_write()
+            pool = self._read_pool(read_only)
+            con = await self._acquire(pool)
             try:
                 result = await con.fetchval(query, *args)
                 return result
@@ -88,14 +317,16 @@ class Database:
                 print("Database ERROR while fetching val: ", e)
                 raise e
             finally:
-                await self._connection_pool.release(con)
+                await pool.release(con)
 
     # Function to execute any query
+    @timed
     async def execute(self, query: str, *args):
         if not self._connection_pool:
             await self.connect()
         else:
-            con = await self._connection_pool.acquire()
+            self._mark_write()
+            con = await self._acquire()
             try:
                 result = await con.execute(query, *args)
                 return result
@@ -106,11 +337,13 @@ class Database:
                 await self._connection_pool.release(con)
                 
     # Function to insert multiple rows
+    @timed
     async def insert_many(self, table_name: str, data: list, columns: list):
         if not self._connection_pool:
             await self.connect()
         else:
-            con = await self._connection_pool.acquire()
+            self._mark_write()
+            con = await self._acquire()
             try:
                 # Use copy_records_to_table for efficient bulk inserts
                 result = await con.copy_records_to_table(
@@ -126,11 +359,13 @@ class Database:
                 await self._connection_pool.release(con)
     
     # Function to execute the same query multiple times with different arguments
+    @timed
     async def execute_many(self, query: str, args: list):
         if not self._connection_pool:
             await self.connect()
         else:
-            con = await self._connection_pool.acquire()
+            self._mark_write()
+            con = await self._acquire()
             try:
                 await con.executemany(query, args)
             except Exception as e:
@@ -139,4 +374,256 @@ class Database:
             finally:
                 await self._connection_pool.release(con)
 
+    # Function to fetch multiple rows with a prepared statement
+    @timed
+    async def fetch_rows_prepared(self, name: str, *args, read_only: bool = False):
+        if not self._connection_pool:
+            await self.connect()
+        if not read_only:
+            self._mark_write()
+        pool = self._read_pool(read_only)
+        con = await self._acquire(pool)
+        try:
+            statement = await self._get_prepared(con, name)
+            return await statement.fetch(*args)
+        except Exception as e:
+            print("Database ERROR while fetching rows: ", e)
+            raise e
+        finally:
+            await pool.release(con)
+
+    # Function to fetch a single row with a prepared statement
+    @timed
+    async def fetch_row_prepared(self, name: str, *args, read_only: bool = False):
+        if not self._connection_pool:
+            await self.connect()
+        if not read_only:
+            self._mark_write()
+        pool = self._read_pool(read_only)
+        con = await self._acquire(pool)
+        try:
+            statement = await self._get_prepared(con, name)
+            return await statement.fetchrow(*args)
+        except Exception as e:
+            print("Database ERROR while fetching row: ", e)
+            raise e
+        finally:
+            await pool.release(con)
+
+    # Function to fetch a single value with a prepared statement
+    @timed
+    async def fetch_val_prepared(self, name: str, *args, read_only: bool = False):
+        if not self._connection_pool:
+            await self.connect()
+        if not read_only:
+            # The prepared statements can call functions that write, like apply_inscriptions_batch
+            self._mark_write()
+        pool = self._read_pool(read_only)
+        con = await self._acquire(pool)
+        try:
+            statement = await self._get_prepared(con, name)
+            return await statement.fetchval(*args)
+        except Exception as e:
+            print("Database ERROR while fetching val: ", e)
+            raise e
+        finally:
+            await pool.release(con)
+
+    # Function to execute a prepared statement, returns the status like execute
+    @timed
+    async def execute_prepared(self, name: str, *args):
+        if not self._connection_pool:
+            await self.connect()
+        self._mark_write()
+        con = await self._acquire()
+        try:
+            statement = await self._get_prepared(con, name)
+            await statement.fetch(*args)
+            return statement.get_statusmsg()
+        except Exception as e:
+            print("Database ERROR while executing query: ", e)
+            raise e
+        finally:
+            await self._connection_pool.release(con)
+
+    # Function to execute a prepared statement multiple times with different arguments
+    @timed
+    async def execute_many_prepared(self, name: str, args: list):
+        if not self._connection_pool:
+            await self.connect()
+        self._mark_write()
+        con = await self._acquire()
+        try:
+            statement = await self._get_prepared(con, name)
+            await statement.executemany(args)
+        except Exception as e:
+            print("Database ERROR while executing many: ", e)
+            raise e
+        finally:
+            await self._connection_pool.release(con)
+
+    # Function to start a transaction
+    # Usage: async with db.transaction() as tx:
+    # All of the queries executed through tx use the same connection
+    # and are committed once when leaving the block (rolled back on error)
+    def transaction(self):
+        return Transaction(self)
+
+
+# A transaction pins a single connection of the pool
+# It exposes the same functions as the Database
+# Calling tx.transaction() inside of it creates a savepoint
+class Transaction:
+
+    def __init__(self, database: Database, connection=None):
+        self._database = database
+        self._connection = connection
+        # Only the outermost transaction acquires and releases the connection
+        self._owns_connection = connection is None
+        self._transaction = None
+
+    async def __aenter__(self):
+        if self._owns_connection:
+            if not self._database._connection_pool:
+                await self._database.connect()
+            self._connection = await self._database._acquire()
+            self._database._mark_write()
+        try:
+            # asyncpg creates a savepoint if a transaction is already started on the connection
+            self._transaction = self._connection.transaction()
+            await self._transaction.start()
+        except Exception as e:
+            print("Database ERROR while starting transaction: ", e)
+            if self._owns_connection:
+                await self._database._connection_pool.release(self._connection)
+            raise e
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self._transaction.commit()
+            else:
+                await self._transaction.rollback()
+        finally:
+            if self._owns_connection:
+                await self._database._connection_pool.release(self._connection)
+                self._connection = None
+
+    # Function to create a nested transaction (savepoint)
+    def transaction(self):
+        return Transaction(self._database, self._connection)
+
+    # The queries of a transaction are recorded in the stats of its database
+    @property
+    def stats(self):
+        return self._database.stats
+
+    # Function to fetch multiple rows
+    @timed
+    async def fetch_rows(self, query: str, *args):
+        try:
+            return await self._connection.fetch(query, *args)
+        except Exception as e:
+            print("Database ERROR while fetching rows: ", e)
+            raise e
+
+    # Function to fetch a single row
+    @timed
+    async def fetch_row(self, query: str, *args):
+        try:
+            return await self._connection.fetchrow(query, *args)
+        except Exception as e:
+            print("Database ERROR while fetching row: ", e)
+            raise e
+
+    # Function to execute a query that returns a single value
+    @timed
+    async def fetch_val(self, query: str, *args):
+        try:
+            return await self._connection.fetchval(query, *args)
+        except Exception as e:
+            print("Database ERROR while fetching val: ", e)
+            raise e
+
+    # Function to execute any query
+    @timed
+    async def execute(self, query: str, *args):
+        try:
+            return await self._connection.execute(query, *args)
+        except Exception as e:
+            print("Database ERROR while executing query: ", e)
+            raise e
+
+    # Function to insert multiple rows
+    @timed
+    async def insert_many(self, table_name: str, data: list, columns: list):
+        try:
+            return await self._connection.copy_records_to_table(
+                table_name=table_name,
+                records=data,
+                columns=columns,
+            )
+        except Exception as e:
+            print("Database ERROR while inserting many: ", e)
+            raise e
+
+    # Function to execute the same query multiple times with different arguments
+    @timed
+    async def execute_many(self, query: str, args: list):
+        try:
+            await self._connection.executemany(query, args)
+        except Exception as e:
+            print("Database ERROR while executing many: ", e)
+            raise e
+
+    # Function to fetch multiple rows with a prepared statement
+    @timed
+    async def fetch_rows_prepared(self, name: str, *args):
+        try:
+            statement = await self._database._get_prepared(self._connection, name)
+            return await statement.fetch(*args)
+        except Exception as e:
+            print("Database ERROR while fetching rows: ", e)
+            raise e
+
+    # Function to fetch a single row with a prepared statement
+    @timed
+    async def fetch_row_prepared(self, name: str, *args):
+        try:
+            statement = await self._database._get_prepared(self._connection, name)
+            return await statement.fetchrow(*args)
+        except Exception as e:
+            print("Database ERROR while fetching row: ", e)
+            raise e
+
+    # Function to fetch a single value with a prepared statement
+    @timed
+    async def fetch_val_prepared(self, name: str, *args):
+        try:
+            statement = await self._database._get_prepared(self._connection, name)
+            return await statement.fetchval(*args)
+        except Exception as e:
+            print("Database ERROR while fetching val: ", e)
+            raise e
+
+    # Function to execute a prepared statement, returns the status like execute
+    @timed
+    async def execute_prepared(self, name: str, *args):
+        try:
+            statement = await self._database._get_prepared(self._connection, name)
+            await statement.fetch(*args)
+            return statement.get_statusmsg()
+        except Exception as e:
+            print("Database ERROR while executing query: ", e)
+            raise e
 
+    # Function to execute a prepared statement multiple times with different arguments
+    @timed
+    async def execute_many_prepared(self, name: str, args: list):
+        try:
+            statement = await self._database._get_prepared(self._connection, name)
+            await statement.executemany(args)
+        except Exception as e:
+            print("Database ERROR while executing many: ", e)
+            raise e
@@ -3,7 +3,18 @@ from .db import Database
 # Create a single instance of the database for the whole application
 database_instance = Database()
 
+# Small separate pool for the admin and bulk jobs (csv refresh, auto assign, festival activation...)
+# so that long jobs never starve the connections used by the volunteers
+admin_database_instance = Database(name="admin", env_prefix="DB_ADMIN_POOL", min_size=1, max_size=3, command_timeout=600)
+
 # Function to get the database instance
 def get_db():
     return database_instance
 
+# Function to get the database instance reserved to the admin and bulk jobs
+def get_admin_db():
+    return admin_database_instance
+
+# Function to get all of the database instances
+def get_databases():
+    return [database_instance, admin_database_instance]
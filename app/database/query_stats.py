@@ -0,0 +1,137 @@
+import hashlib
+import os
+import re
+import time
+from collections import deque
+
+# Queries slower than this are printed in the slow query log
+SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "500"))
+# Number of durations kept per statement to compute the percentiles
+SAMPLES_PER_STATEMENT = int(os.environ.get("DB_QUERY_STATS_SAMPLES", "1000"))
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![$\w])\d+\b")
+
+
+# Function to get the fingerprint of a query
+# Two queries that only differ by whitespace or literals have the same fingerprint
+def fingerprint(query: str) -> str:
+    query = _STRING_LITERAL.sub("?", query)
+    query = _NUMBER_LITERAL.sub("?", query)
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+# Function to describe the shape of the parameters of a query without their values
+# Example: (42, "Samedi", [1, 2, 3]) -> "(int, str[6], list[3])"
+def parameters_shape(args) -> str:
+    shapes = []
+    for arg in args:
+        if isinstance(arg, (str, bytes, list, tuple, dict)):
+            shapes.append(f"{type(arg).__name__}[{len(arg)}]")
+        else:
+            shapes.append(type(arg).__name__)
+    return "(" + ", ".join(shapes) + ")"
+
+
+# Function to get the number of rows from the result of a query
+def count_rows(result) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    # Status of execute and copy, example: "UPDATE 3" or "COPY 120"
+    if isinstance(result, str):
+        last = result.rsplit(" ", 1)[-1]
+        return int(last) if last.isdigit() else 0
+    return 1
+
+
+# Function to get a percentile of a sorted list of values
+def percentile(sorted_values: list, percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# Statistics of a single statement
+class StatementStats:
+
+    def __init__(self, query: str):
+        self.query = query
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.callers = set()
+        self.durations = deque(maxlen=SAMPLES_PER_STATEMENT)
+
+    def record(self, duration_ms: float, rows: int, caller: str, failed: bool):
+        self.count += 1
+        self.rows += rows
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        self.callers.add(caller)
+        self.durations.append(duration_ms)
+        if failed:
+            self.errors += 1
+
+    def to_dict(self) -> dict:
+        durations = sorted(self.durations)
+        return {
+            "id": hashlib.md5(self.query.encode()).hexdigest()[:12],
+            "query": self.query,
+            "callers": sorted(self.callers),
+            "count": self.count,
+            "errors": self.errors,
+            "rows": self.rows,
+            "rows_per_call": round(self.rows / self.count, 2) if self.count else 0,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0,
+            "p50_ms": round(percentile(durations, 50), 3),
+            "p95_ms": round(percentile(durations, 95), 3),
+            "p99_ms": round(percentile(durations, 99), 3),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+# Statistics of all of the statements executed by the Database
+class QueryStats:
+
+    def __init__(self, slow_query_ms: float = SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self.started_at = time.time()
+        # Cache of query text -> fingerprint, the queries are module constants so it stays small
+        self._fingerprints = {}
+        self._statements = {}
+
+    # Function to record the execution of a query
+    def record(self, query: str, args, duration_ms: float, rows: int, caller: str, failed: bool = False):
+        key = self._fingerprints.get(query)
+        if key is None:
+            key = fingerprint(query)
+            self._fingerprints[query] = key
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = StatementStats(key)
+            self._statements[key] = statement
+        statement.record(duration_ms, rows, caller, failed)
+
+        if duration_ms >= self.slow_query_ms:
+            print(f"Database SLOW QUERY ({duration_ms:.1f} ms, {rows} rows) in {caller}: {key[:300]} | params: {parameters_shape(args)}")
+
+    # Function to get the statistics sorted by total time spent
+    def snapshot(self, limit: int = 50) -> dict:
+        statements = sorted(self._statements.values(), key=lambda s: s.total_ms, reverse=True)
+        return {
+            "since": self.started_at,
+            "slow_query_ms": self.slow_query_ms,
+            "statements": [statement.to_dict() for statement in statements[:limit]],
+        }
+
+    # Function to reset the statistics
+    def reset(self):
+        self.started_at = time.time()
+        self._statements = {}
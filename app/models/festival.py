@@ -5,4 +5,6 @@ class Festival(BaseModel):
     festival_name: str
     festival_description: str
     is_active: bool | None = None
+    jours: list[str] | None = None
+    creneaux: list[str] | None = None
 
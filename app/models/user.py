@@ -27,5 +27,18 @@ class UpdateUser(BaseModel):
     association: str
     
 
+# Page of users of the cursor pagination
+# next_cursor is None on the last page
+class UserPage(BaseModel):
+    users: list[User]
+    next_cursor: str | None = None
+
+
+# Minimal user returned by the autocomplete
+class UserSummary(BaseModel):
+    user_id: int
+    username: str
+
+
 class Password(BaseModel):
     password: str
\ No newline at end of file
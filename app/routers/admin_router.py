@@ -0,0 +1,30 @@
+from fastapi import APIRouter, Security
+from typing import Annotated
+from ..controllers.auth_controller import verify_token
+from ..controllers.admin_controller import (
+    get_query_stats,
+    reset_query_stats,
+    get_pool_stats
+)
+from ..models.user import User
+
+
+admin_router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+)
+
+# Get the latency statistics of the queries, sorted by total time spent
+@admin_router.get("/db/query-stats", response_model=dict, description="Get the latency statistics of the database queries")
+async def get_query_stats_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])], limit: int = 50):
+    return await get_query_stats(limit)
+
+# Reset the statistics of the queries
+@admin_router.delete("/db/query-stats", response_model=dict, description="Reset the statistics of the database queries")
+async def reset_query_stats_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
+    return await reset_query_stats()
+
+# Get the live statistics of the connection pools (in use, idle, waiters, acquire wait time)
+@admin_router.get("/db/pool-stats", response_model=dict, description="Get the statistics of the database connection pools")
+async def get_pool_stats_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
+    return await get_pool_stats()
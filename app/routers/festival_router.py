@@ -6,15 +6,38 @@ from ..controllers.festival_controller import (
     get_all_festivals,
     delete_festival,
     activate_festival,
-    get_active_festival
+    get_active_festival,
+    update_festival_slots
 )
 from ..models.user import User
 from ..models.festival import Festival
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
+
+# Function to check the jours or creneaux of a festival
+# Each of them is a row or column of the planning, an empty or repeated one would add a slot that cannot be used
+def check_slot_names(names: list[str] | None) -> list[str] | None:
+    if names is None:
+        return names
+    if any(not name.strip() for name in names):
+        raise ValueError("The jours and creneaux cannot be empty")
+    if len(set(names)) != len(names):
+        raise ValueError("The jours and creneaux cannot be repeated")
+    return names
 
 class CreateFestival(BaseModel):
     festival_name: str
     festival_description: str
+    jours: list[str] | None = Field(default=None, min_length=1)
+    creneaux: list[str] | None = Field(default=None, min_length=1)
+
+    _check_slots = field_validator("jours", "creneaux")(check_slot_names)
+
+class UpdateFestivalSlots(BaseModel):
+    festival_id: int
+    jours: list[str] = Field(min_length=1)
+    creneaux: list[str] = Field(min_length=1)
+
+    _check_slots = field_validator("jours", "creneaux")(check_slot_names)
 
 class FestivalActivate(BaseModel):
     festival_id: int
@@ -28,7 +51,7 @@ festival_router = APIRouter(
 
 @festival_router.post("", response_model=dict, description="Create a new festival")
 async def create_festival_route(festival: CreateFestival, user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
-    return await create_festival(festival.festival_name, festival.festival_description)
+    return await create_festival(festival.festival_name, festival.festival_description, festival.jours, festival.creneaux)
 
 @festival_router.get("", response_model=list[Festival], description="Get all festivals")
 async def get_all_festivals_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
@@ -42,6 +65,10 @@ async def delete_festival_route(festival_id: int, user: Annotated[User, Security
 async def activate_festival_route(festival: FestivalActivate, user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
     return await activate_festival(festival.festival_id, festival.is_active)
 
+@festival_router.put("/slots", response_model=dict, description="Change the jours and creneaux of a festival")
+async def update_festival_slots_route(festival: UpdateFestivalSlots, user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
+    return await update_festival_slots(festival.festival_id, festival.jours, festival.creneaux)
+
 @festival_router.get("/active", response_model=Optional[Festival], description="Get active festival")
 async def get_active_festival_route(user: Annotated[User, Security(verify_token, scopes=["User"])]):
     return await get_active_festival()
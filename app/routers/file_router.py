@@ -1,9 +1,10 @@
-from fastapi import APIRouter, Depends, Security
+from fastapi import APIRouter, Depends, Security, Request, Response
 from typing import Annotated
 from ..controllers.auth_controller import verify_token
 from ..controllers.file_controller import refresh_csv_table, get_games_info, get_games_info_by_id
 from ..models.user import User
 from ..models.file import Game
+from ..cache.festival_versions import festival_versions, not_modified_response
 from fastapi import File, UploadFile
 import io
 import csv
@@ -37,7 +38,11 @@ async def upload_csv_route(user: Annotated[User, Security(verify_token, scopes=[
 
 
 @file_router.get("/jeux", response_model=list[dict], description="Get all jeux")
-async def get_games_info_route(user: Annotated[User, Security(verify_token, scopes=["User"])]):
+async def get_games_info_route(user: Annotated[User, Security(verify_token, scopes=["User"])], request: Request, response: Response):
+    # The games of the active festival only change with a csv refresh or an activation
+    not_modified = not_modified_response(request, response, festival_versions.etag("games", None))
+    if not_modified is not None:
+        return not_modified
     return await get_games_info()
 
 # Get jeux par id et par festival
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Security
+from fastapi import APIRouter, Security, Request, Response, HTTPException
+from fastapi.responses import StreamingResponse
 from typing import Annotated
 from pydantic import BaseModel
 from ..controllers.auth_controller import verify_token
@@ -11,24 +12,30 @@ from ..controllers.inscription_controller import (
     get_nb_inscriptions_zone_benevole,
     auto_assign_flexibles_to_postes,
     auto_assign_flexibles_to_zones_benevoles,
+    preview_auto_assign,
+    apply_auto_assign_plan,
     batch_inscription_poste,
     batch_inscription_zone_benevole,
-    #get_postes_inscriptions_user,
-    #get_zones_benevoles_inscriptions_user
+    get_my_inscriptions,
     get_inscriptions_poste,
     get_inscriptions_zone_benevole,
+    get_festival_inscriptions_details,
     assign_user_to_poste,
     delete_user_to_poste,
     delete_user_to_zone_benevole,
     get_flexibles,
+    get_nb_flexibles,
     express_inscription_poste,
-    express_inscription_zone_benevole
+    express_inscription_zone_benevole,
+    stream_planning_events
     )
 from ..models.user import User
 from ..models.inscription import InscriptionPoste, InscriptionZoneBenevole, BatchInscriptionPoste, BatchInscriptionZoneBenevole, AssignInscriptionPoste, AssignInscriptionZoneBenevole, ExpressInscriptionPoste, ExpressInscriptionZoneBenevole
 from ..models.message import MessageSendEveryone, MessageSend
 from ..controllers.message_controller import send_message_to_everyone, send_message
 from ..controllers.festival_controller import get_active_festival
+from ..cache.festival_versions import festival_versions, not_modified_response
+from ..controllers.planning_grid import negotiate_grid_format, encode_columnar_grid
 
 
 inscription_router = APIRouter(
@@ -62,30 +69,86 @@ async def desinscription_zone_benevole(inscription: InscriptionZoneBenevole, use
     return await desinscription_user_zone_benevole(user, inscription)
 
 
-@inscription_router.get("/poste", response_model=list, description="Get all inscriptions poste numbers by day and creneau")
-async def get_nb_inscriptions_postes_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["User"])]):
-    return await get_nb_inscriptions_poste(user.user_id, festival_id)
+# Function to send a grid in the format asked by the Accept header
+# The list of cells is sent by default, the columnar format as JSON or MessagePack when asked
+async def planning_grid_response(request: Request, response: Response, scope: str, festival_id: int, user_id: int, get_grid):
+    grid_format = negotiate_grid_format(request.headers.get("accept"))
+    response.headers["Vary"] = "Accept"
+    # The grid depends on the user through is_register
+    not_modified = not_modified_response(request, response, festival_versions.etag(scope, festival_id, user_id, grid_format))
+    if not_modified is not None:
+        not_modified.headers["Vary"] = "Accept"
+        return not_modified
+    if grid_format == "cells":
+        return await get_grid(user_id, festival_id)
+    body, media_type = encode_columnar_grid(await get_grid(user_id, festival_id, columnar=True), grid_format)
+    return Response(content=body, media_type=media_type, headers={header: response.headers[header] for header in ("ETag", "Cache-Control", "Vary")})
 
 
-@inscription_router.get("/zone-benevole", response_model=list, description="Get all inscriptions zone benevole numbers by day and creneau")
-async def get_nb_inscriptions_zone_benevoles_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["User"])]):
-    return await get_nb_inscriptions_zone_benevole(user.user_id, festival_id)
+@inscription_router.get("/poste", response_model=list, description="Get all inscriptions poste numbers by day and creneau (columnar with Accept: application/vnd.awi.planning-columnar+json or application/msgpack)")
+async def get_nb_inscriptions_postes_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["User"])], request: Request, response: Response):
+    return await planning_grid_response(request, response, "grid-postes", festival_id, user.user_id, get_nb_inscriptions_poste)
 
 
-@inscription_router.put("/poste/auto-assign-flexibles", response_model=dict, description="Auto assign flexibles to postes")
-async def auto_assign_flexibles_to_postes_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
-    result = await auto_assign_flexibles_to_postes()
-    # Get active festival
+@inscription_router.get("/zone-benevole", response_model=list, description="Get all inscriptions zone benevole numbers by day and creneau (columnar with Accept: application/vnd.awi.planning-columnar+json or application/msgpack)")
+async def get_nb_inscriptions_zone_benevoles_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["User"])], request: Request, response: Response):
+    return await planning_grid_response(request, response, "grid-zones", festival_id, user.user_id, get_nb_inscriptions_zone_benevole)
+
+
+@inscription_router.get("/stream", description="Stream the changes of the number of inscriptions of a festival (Server-Sent Events)")
+async def stream_planning_events_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["User"])]):
+    return StreamingResponse(
+        stream_planning_events(festival_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# The auto assignment runs on the given festival, the active one by default
+async def auto_assign_festival_id(festival_id: int | None) -> int:
+    if festival_id is not None:
+        return festival_id
     festival = await get_active_festival()
-    festival_id = festival.festival_id
+    if festival is None:
+        raise HTTPException(status_code=404, detail="No active festival")
+    return festival.festival_id
+
+
+@inscription_router.put("/poste/auto-assign-flexibles", response_model=dict, description="Auto assign flexibles to postes")
+async def auto_assign_flexibles_to_postes_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])], festival_id: int | None = None):
+    festival_id = await auto_assign_festival_id(festival_id)
+    result = await auto_assign_flexibles_to_postes(festival_id)
     # Send a message to everyone to inform them of the changes
     result2 = await send_message_to_everyone(MessageSendEveryone(festival_id=festival_id, message="Les inscriptions pour les postes ont été mises à jour. Veuillez vérifier vos inscriptions."), user.user_id, user.username, user.roles)
     return result
 
 
 @inscription_router.put("/zone-benevole/auto-assign-flexibles", response_model=dict, description="Auto assign flexibles to zones benevoles")
-async def auto_assign_flexibles_to_zones_benevoles_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
-    return await auto_assign_flexibles_to_zones_benevoles()
+async def auto_assign_flexibles_to_zones_benevoles_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])], festival_id: int | None = None):
+    return await auto_assign_flexibles_to_zones_benevoles(await auto_assign_festival_id(festival_id))
+
+
+@inscription_router.post("/poste/auto-assign-flexibles/preview", response_model=dict, description="Preview the auto assignment of the flexibles to postes, without changing the inscriptions")
+async def preview_auto_assign_flexibles_to_postes_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])], festival_id: int | None = None):
+    return await preview_auto_assign("postes", await auto_assign_festival_id(festival_id))
+
+
+@inscription_router.put("/poste/auto-assign-flexibles/{plan_id}", response_model=dict, description="Apply a previewed auto assignment of the flexibles to postes")
+async def apply_auto_assign_flexibles_to_postes_route(plan_id: str, user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
+    result = await apply_auto_assign_plan("postes", plan_id)
+    # Send a message to everyone to inform them of the changes
+    await send_message_to_everyone(MessageSendEveryone(festival_id=result["festival_id"], message="Les inscriptions pour les postes ont été mises à jour. Veuillez vérifier vos inscriptions."), user.user_id, user.username, user.roles)
+    return result
+
+
+@inscription_router.post("/zone-benevole/auto-assign-flexibles/preview", response_model=dict, description="Preview the auto assignment of the flexibles to postes and zones benevoles, without changing the inscriptions")
+async def preview_auto_assign_flexibles_to_zones_benevoles_route(user: Annotated[User, Security(verify_token, scopes=["Admin"])], festival_id: int | None = None):
+    return await preview_auto_assign("zones", await auto_assign_festival_id(festival_id))
+
+
+@inscription_router.put("/zone-benevole/auto-assign-flexibles/{plan_id}", response_model=dict, description="Apply a previewed auto assignment of the flexibles to postes and zones benevoles")
+async def apply_auto_assign_flexibles_to_zones_benevoles_route(plan_id: str, user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
+    return await apply_auto_assign_plan("zones", plan_id)
 
 
 @inscription_router.post("/poste/batch-inscription", response_model=dict, description="Batch inscriptions and desinscriptions to postes")
@@ -104,6 +167,10 @@ async def get_inscriptions_poste_route(poste: InscriptionPoste, user: Annotated[
 async def get_inscriptions_zone_benevole_route(zone_benevole: InscriptionZoneBenevole, user: Annotated[User, Security(verify_token, scopes=["Referent"])]):
     return await get_inscriptions_zone_benevole(zone_benevole)
 
+@inscription_router.get("/details", response_model=dict, description="Get the inscriptions of all the postes and zones benevoles of a festival, or of one jour")
+async def get_festival_inscriptions_details_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["Referent"])], jour: str | None = None):
+    return await get_festival_inscriptions_details(festival_id, jour)
+
 @inscription_router.put("/poste/assign", response_model=dict, description="Assign a user to a poste")
 async def assign_user_to_poste_route(poste: AssignInscriptionPoste, user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
     result = await assign_user_to_poste(poste)
@@ -124,6 +191,10 @@ async def delete_user_to_zone_benevole_route(zone_benevole: AssignInscriptionZon
 async def get_flexibles_poste_route(query: FlexiblesQuery, user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
     return await get_flexibles(query.festival_id, query.jour, query.creneau)
 
+@inscription_router.get("/poste/flexibles/count", response_model=list, description="Get the number of flexibles of every jour and creneau of a festival")
+async def get_nb_flexibles_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["Admin"])]):
+    return await get_nb_flexibles(festival_id)
+
 @inscription_router.post("/poste/express-inscription", response_model=dict, description="Express inscription to postes")
 async def express_inscription_poste_route(inscriptions: ExpressInscriptionPoste, user: Annotated[User, Security(verify_token, scopes=["User"])]):
     return await express_inscription_poste(user, inscriptions)
@@ -132,10 +203,9 @@ async def express_inscription_poste_route(inscriptions: ExpressInscriptionPoste,
 async def express_inscription_zone_benevole_route(inscriptions: ExpressInscriptionZoneBenevole, user: Annotated[User, Security(verify_token, scopes=["User"])]):
     return await express_inscription_zone_benevole(user, inscriptions)
 
-# @inscription_router.get("/poste/my-postes", response_model=list, description="Get my postes inscriptions")
-# async def get_my_postes_inscriptions_route(user: Annotated[User, Security(verify_token, scopes=["User"])]):
-#     return await get_postes_inscriptions_user(user)
-
-# @inscription_router.get("/zone-benevole/my-zones-benevoles", response_model=list, description="Get my zones benevoles inscriptions")
-# async def get_my_zones_benevoles_inscriptions_route(user: Annotated[User, Security(verify_token, scopes=["User"])]):
-#     return await get_zones_benevoles_inscriptions_user(user)
\ No newline at end of file
+@inscription_router.get("/me", response_model=dict, description="Get my postes and zones benevoles inscriptions for a festival, with the double bookings")
+async def get_my_inscriptions_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["User"])], request: Request, response: Response):
+    not_modified = not_modified_response(request, response, festival_versions.etag("me", festival_id, user.user_id))
+    if not_modified is not None:
+        return not_modified
+    return await get_my_inscriptions(user.user_id, festival_id)
\ No newline at end of file
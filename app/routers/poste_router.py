@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Security
+from fastapi import APIRouter, Security, Request, Response
 from typing import Annotated
 from ..controllers.auth_controller import verify_token
 from ..controllers.poste_controller import (
@@ -8,6 +8,7 @@ from ..controllers.poste_controller import (
     get_referents_for_poste
 )
 from ..models.user import User
+from ..cache.festival_versions import festival_versions, not_modified_response
 from pydantic import BaseModel
 
 
@@ -36,7 +37,10 @@ async def create_poste_route(poste: CreatePoste, user: Annotated[User, Security(
 
 # Get all postes for a festival
 @poste_router.get("/{festival_id}", response_model=list, description="Get all postes")
-async def get_all_postes_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["User"])]):
+async def get_all_postes_route(festival_id: int, user: Annotated[User, Security(verify_token, scopes=["User"])], request: Request, response: Response):
+    not_modified = not_modified_response(request, response, festival_versions.etag("postes", festival_id))
+    if not_modified is not None:
+        return not_modified
     return await get_all_postes(festival_id)
 
 # Delete a poste
@@ -3,8 +3,8 @@ from fastapi.responses import JSONResponse
 from typing import Annotated
 
 from ..controllers.auth_controller import verify_token
-from ..controllers.user_controller import find_user_by_user_id, ban_user_by_user_id, get_all_users, delete_data, update_user_info, search_users
-from ..models.user import User, UpdateUser
+from ..controllers.user_controller import find_user_by_user_id, ban_user_by_user_id, get_all_users, delete_data, update_user_info, search_users, get_users_after, search_users_ranked, autocomplete_users
+from ..models.user import User, UpdateUser, UserPage, UserSummary
 
 
 user_router = APIRouter(
@@ -24,8 +24,11 @@ async def get_user(user_id: int, user: Annotated[ User , Security(verify_token,
 async def ban_user(user_id: int, user: Annotated[None, Security(verify_token, scopes=["Admin"])]):
     return await ban_user_by_user_id(user_id)
 
-@user_router.get("/", response_model=list[User], description="Get all users")
-async def get_all_users_route(user: Annotated[None, Security(verify_token, scopes=["Admin"])], page: int = 1, limit: int = 10):
+# With a cursor (empty for the first page) the response is a UserPage with the next_cursor, otherwise the page/limit list
+@user_router.get("/", response_model=list[User] | UserPage, description="Get all users, by page or by cursor")
+async def get_all_users_route(user: Annotated[None, Security(verify_token, scopes=["Admin"])], page: int = 1, limit: int = 10, cursor: str | None = None):
+    if cursor is not None:
+        return await get_users_after(cursor, limit)
     return await get_all_users(page, limit)
 
 @user_router.delete("/delete-data", response_model=dict, description="Delete all personal data")
@@ -36,8 +39,17 @@ async def delete_data_route(user: Annotated[None, Security(verify_token, scopes=
 async def update_user_info_route(user: Annotated[None, Security(verify_token, scopes=["User"])], new_info: UpdateUser):
     return await update_user_info(user, new_info)
 
-@user_router.get("/search/username", response_model=list[User], description="Search for users by username")
-async def search_users_route(user: Annotated[None, Security(verify_token, scopes=["Admin"])], username: str, page: int = 1, limit: int = 10):
+@user_router.get("/search/username", response_model=list[User] | UserPage, description="Search for users by username, by page or by cursor")
+async def search_users_route(user: Annotated[None, Security(verify_token, scopes=["Admin"])], username: str, page: int = 1, limit: int = 10, cursor: str | None = None):
+    if cursor is not None:
+        return await get_users_after(cursor, limit, username)
     return await search_users(page, limit, username)
     
 
+@user_router.get("/search/all", response_model=list[User], description="Search for users by username, nom, prenom, email or telephone, ranked by similarity")
+async def search_users_ranked_route(user: Annotated[None, Security(verify_token, scopes=["Admin"])], q: str, page: int = 1, limit: int = 20):
+    return await search_users_ranked(q, page, limit)
+
+@user_router.get("/search/autocomplete", response_model=list[UserSummary], description="Autocomplete the usernames starting with a prefix")
+async def autocomplete_users_route(user: Annotated[None, Security(verify_token, scopes=["Admin"])], prefix: str, limit: int = 10):
+    return await autocomplete_users(prefix, limit)
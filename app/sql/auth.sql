@@ -1,4 +1,5 @@
 DROP TABLE IF EXISTS user_roles CASCADE;
+DROP TABLE IF EXISTS deleted_users;
 DROP TABLE IF EXISTS users CASCADE;
 DROP TABLE IF EXISTS roles CASCADE;
 
@@ -21,9 +22,45 @@ CREATE TABLE users (
     vegan BOOLEAN DEFAULT FALSE,
     hebergement VARCHAR(255) NOT NULL,
     association VARCHAR(255) NOT NULL, 
-    disabled BOOLEAN DEFAULT FALSE 
+    disabled BOOLEAN DEFAULT FALSE,
+    -- Bumped to revoke the access tokens of the user (ban, role change, password change...)
+    token_version INTEGER NOT NULL DEFAULT 0
 );
 
+-- Users deleted recently, their access tokens are refused until they expire (stateless token verification)
+-- The rows are added by the trigger below and loaded by the token revocations of every worker
+CREATE TABLE deleted_users (
+    user_id INTEGER PRIMARY KEY,
+    deleted_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- The rows older than a day, far longer than the lifetime of an access token, are removed on the way
+CREATE OR REPLACE FUNCTION record_deleted_user()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    DELETE FROM deleted_users WHERE deleted_at < NOW() - INTERVAL '1 day';
+    INSERT INTO deleted_users (user_id) VALUES (OLD.user_id)
+    ON CONFLICT (user_id) DO UPDATE SET deleted_at = NOW();
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER users_record_deleted
+AFTER DELETE ON users
+FOR EACH ROW EXECUTE FUNCTION record_deleted_user();
+
+-- Trigram indexes for the substring and fuzzy search of the users
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX users_username_trgm_idx ON users USING GIN (username gin_trgm_ops);
+CREATE INDEX users_nom_trgm_idx ON users USING GIN (nom gin_trgm_ops);
+CREATE INDEX users_prenom_trgm_idx ON users USING GIN (prenom gin_trgm_ops);
+CREATE INDEX users_email_trgm_idx ON users USING GIN (email gin_trgm_ops);
+CREATE INDEX users_telephone_trgm_idx ON users USING GIN (telephone gin_trgm_ops);
+-- Index for the prefix autocomplete of the usernames
+CREATE INDEX users_username_prefix_idx ON users (lower(username) text_pattern_ops);
+
 
 -- Create the "user_roles" table to manage user-to-role relationships
 CREATE TABLE user_roles (
@@ -1,3 +1,6 @@
+DROP TABLE IF EXISTS auto_assign_plans;
+DROP TABLE IF EXISTS festival_changes;
+DROP TABLE IF EXISTS flexible_slots;
 DROP TABLE IF EXISTS inscriptions CASCADE;
 DROP TABLE IF EXISTS csv;
 DROP TABLE IF EXISTS postes CASCADE;
@@ -8,9 +11,19 @@ CREATE TABLE festivals (
     festival_name VARCHAR(255),
     festival_description VARCHAR(255),
     is_active BOOLEAN DEFAULT FALSE,
+    -- Jours and creneaux of the planning of the festival, in their order
+    -- They are never NULL nor empty, the grids of the database and of the planning cache must have the same slots
+    jours VARCHAR(255)[] NOT NULL DEFAULT ARRAY['Vendredi', 'Samedi', 'Dimanche'] CHECK (cardinality(jours) > 0),
+    creneaux VARCHAR(255)[] NOT NULL DEFAULT ARRAY['8h-10h', '10h-12h', '12h-14h', '14h-16h', '16h-18h'] CHECK (cardinality(creneaux) > 0),
     UNIQUE (festival_name)
 );
 
+-- For a database created before the jours and creneaux were required, without dropping the festivals:
+-- UPDATE festivals SET jours = DEFAULT WHERE jours IS NULL OR cardinality(jours) = 0;
+-- UPDATE festivals SET creneaux = DEFAULT WHERE creneaux IS NULL OR cardinality(creneaux) = 0;
+-- ALTER TABLE festivals ALTER COLUMN jours SET NOT NULL, ALTER COLUMN creneaux SET NOT NULL;
+-- ALTER TABLE festivals ADD CHECK (cardinality(jours) > 0), ADD CHECK (cardinality(creneaux) > 0);
+
 CREATE TABLE inscriptions (
     user_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
     festival_id INTEGER REFERENCES festivals(festival_id) ON DELETE CASCADE,
@@ -26,6 +39,22 @@ CREATE TABLE inscriptions (
     UNIQUE (user_id, festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau, is_poste)
 );
 
+-- Index used to count the inscriptions of a slot when checking its capacity
+CREATE INDEX inscriptions_slot_idx ON inscriptions (festival_id, jour, creneau, poste, zone_plan, zone_benevole_id, zone_benevole_name);
+-- Index used by the auto assignment of the flexibles, which reads the inscriptions of one festival
+CREATE INDEX inscriptions_festival_flexibles_idx ON inscriptions (festival_id, is_poste, user_id, jour, creneau);
+
+-- Plans of the auto assignment of the flexibles computed by a preview, applied later by their plan_id
+-- to_delete has the inscriptions dropped by the plan, changes the number of writes of the festival it was computed on (see festival_changes)
+CREATE TABLE auto_assign_plans (
+    plan_id VARCHAR(32) PRIMARY KEY,
+    kind VARCHAR(10),
+    festival_id INTEGER REFERENCES festivals(festival_id) ON DELETE CASCADE,
+    changes BIGINT,
+    to_delete JSONB,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
 CREATE TABLE csv (
     poste VARCHAR(255) DEFAULT 'Animation',
     festival_id INTEGER REFERENCES festivals(festival_id) ON DELETE CASCADE,
@@ -143,6 +172,338 @@ BEGIN
 END;
 $$;
 
+-- Function to sign up a user to a slot (poste or zone benevole, jour and creneau) if it is not full
+-- The capacity of a poste is its max_capacity, the capacity of a zone benevole is given by p_zone_capacity
+-- An advisory lock on the slot serializes the signups of the same slot only, it is released at the end of the transaction
+-- Returns 'inserted', 'already' if the user was already signed up, 'full'
+-- or 'invalid' if the jour or creneau is not one of the festival (it would not be in the plannings)
+CREATE OR REPLACE FUNCTION insert_inscription_capped(
+    p_user_id INTEGER,
+    p_festival_id INTEGER,
+    p_poste VARCHAR,
+    p_zone_plan VARCHAR,
+    p_zone_benevole_id VARCHAR,
+    p_zone_benevole_name VARCHAR,
+    p_jour VARCHAR,
+    p_creneau VARCHAR,
+    p_is_poste BOOLEAN,
+    p_zone_capacity INTEGER
+)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    capacity INTEGER;
+    taken INTEGER;
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1
+        FROM festivals
+        WHERE festival_id = p_festival_id AND array_position(jours, p_jour) IS NOT NULL AND array_position(creneaux, p_creneau) IS NOT NULL
+    ) THEN
+        RETURN 'invalid';
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(p_festival_id, hashtext(concat_ws(':', p_poste, p_zone_plan, p_zone_benevole_id, p_zone_benevole_name, p_jour, p_creneau, p_is_poste)));
+
+    IF EXISTS (
+        SELECT 1
+        FROM inscriptions
+        WHERE user_id = p_user_id AND festival_id = p_festival_id AND poste = p_poste AND zone_plan = p_zone_plan
+            AND zone_benevole_id = p_zone_benevole_id AND zone_benevole_name = p_zone_benevole_name
+            AND jour = p_jour AND creneau = p_creneau AND is_poste = p_is_poste
+    ) THEN
+        RETURN 'already';
+    END IF;
+
+    IF p_is_poste THEN
+        SELECT max_capacity INTO capacity FROM postes WHERE festival_id = p_festival_id AND poste = p_poste;
+    ELSE
+        capacity := p_zone_capacity;
+    END IF;
+
+    -- The previous holders of the lock have committed, their inscriptions are counted
+    SELECT COUNT(*) INTO taken
+    FROM inscriptions
+    WHERE festival_id = p_festival_id AND jour = p_jour AND creneau = p_creneau AND poste = p_poste
+        AND zone_plan = p_zone_plan AND zone_benevole_id = p_zone_benevole_id AND zone_benevole_name = p_zone_benevole_name
+        AND is_poste = p_is_poste;
+
+    IF capacity IS NOT NULL AND taken >= capacity THEN
+        RETURN 'full';
+    END IF;
+
+    INSERT INTO inscriptions (user_id, festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau, is_poste)
+    VALUES (p_user_id, p_festival_id, p_poste, p_zone_plan, p_zone_benevole_id, p_zone_benevole_name, p_jour, p_creneau, p_is_poste)
+    ON CONFLICT (user_id, festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau, is_poste) DO NOTHING;
+    RETURN 'inserted';
+END;
+$$;
+
+-- Function to apply desinscriptions and inscriptions of a user in one call, and so in one transaction
+-- p_is_poste tells if the rows are postes or zones benevoles, p_zone_capacity is given to insert_inscription_capped
+-- If p_clear_jour is not NULL, the inscriptions of the user for p_clear_festival_id, p_clear_jour and p_clear_creneau are removed first
+-- (with the zones benevoles under the poste "Animation" if it is not signed up again), used by the express inscriptions
+-- The desinscriptions are the parallel arrays d_*, removing the poste "Animation" also removes its zones benevoles for the same jour and creneau
+-- The inscriptions are the parallel arrays i_*, the slots are locked in a fixed order so that two concurrent calls cannot deadlock
+-- The writes of the user are counted before the slots are locked, else the triggers of the inserts
+-- would wait for the row of the user while holding the slots (see add_festival_changes)
+-- Returns the result of each inscription in the same order: 'inserted', 'already', 'full' or 'invalid'
+CREATE OR REPLACE FUNCTION apply_inscriptions_batch(
+    p_user_id INTEGER,
+    p_is_poste BOOLEAN,
+    p_zone_capacity INTEGER,
+    p_clear_festival_id INTEGER,
+    p_clear_jour VARCHAR,
+    p_clear_creneau VARCHAR,
+    d_festival_id INTEGER[],
+    d_poste VARCHAR[],
+    d_zone_plan VARCHAR[],
+    d_zone_benevole_id VARCHAR[],
+    d_zone_benevole_name VARCHAR[],
+    d_jour VARCHAR[],
+    d_creneau VARCHAR[],
+    i_festival_id INTEGER[],
+    i_poste VARCHAR[],
+    i_zone_plan VARCHAR[],
+    i_zone_benevole_id VARCHAR[],
+    i_zone_benevole_name VARCHAR[],
+    i_jour VARCHAR[],
+    i_creneau VARCHAR[]
+)
+RETURNS TEXT[]
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    statuses TEXT[] := array_fill(NULL::TEXT, ARRAY[cardinality(i_festival_id)]);
+    item RECORD;
+    item_status TEXT;
+    idx BIGINT;
+BEGIN
+    PERFORM add_festival_changes(
+        i_festival_id || d_festival_id || p_clear_festival_id,
+        array_fill(p_user_id, ARRAY[cardinality(i_festival_id) + cardinality(d_festival_id) + 1])
+    );
+
+    IF p_clear_jour IS NOT NULL THEN
+        DELETE FROM inscriptions
+        WHERE user_id = p_user_id AND festival_id = p_clear_festival_id AND jour = p_clear_jour AND creneau = p_clear_creneau
+            AND (
+                is_poste = p_is_poste
+                OR (p_is_poste AND is_poste = False AND poste = 'Animation' AND NOT ('Animation' = ANY(i_poste)))
+            );
+    END IF;
+
+    DELETE FROM inscriptions i
+    USING unnest(d_festival_id, d_poste, d_zone_plan, d_zone_benevole_id, d_zone_benevole_name, d_jour, d_creneau)
+        AS d(festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau)
+    WHERE i.user_id = p_user_id AND i.festival_id = d.festival_id AND i.jour = d.jour AND i.creneau = d.creneau
+        AND i.poste = d.poste AND i.is_active = True
+        AND (
+            (i.is_poste = p_is_poste AND i.zone_plan = d.zone_plan AND i.zone_benevole_id = d.zone_benevole_id AND i.zone_benevole_name = d.zone_benevole_name)
+            OR (p_is_poste AND d.poste = 'Animation' AND i.is_poste = False)
+        );
+
+    -- The same slot given several times is signed up once
+    FOR item IN
+        SELECT t.festival_id, t.poste, t.zone_plan, t.zone_benevole_id, t.zone_benevole_name, t.jour, t.creneau, array_agg(t.idx) AS idxs
+        FROM unnest(i_festival_id, i_poste, i_zone_plan, i_zone_benevole_id, i_zone_benevole_name, i_jour, i_creneau) WITH ORDINALITY
+            AS t(festival_id, poste, zone_plan, zone_benevole_id, zone_benevole_name, jour, creneau, idx)
+        GROUP BY t.festival_id, t.poste, t.zone_plan, t.zone_benevole_id, t.zone_benevole_name, t.jour, t.creneau
+        ORDER BY t.festival_id, t.poste, t.zone_plan, t.zone_benevole_id, t.zone_benevole_name, t.jour, t.creneau
+    LOOP
+        item_status := insert_inscription_capped(
+            p_user_id, item.festival_id, item.poste, item.zone_plan, item.zone_benevole_id, item.zone_benevole_name,
+            item.jour, item.creneau, p_is_poste, p_zone_capacity
+        );
+        FOREACH idx IN ARRAY item.idxs LOOP
+            statuses[idx] := item_status;
+        END LOOP;
+    END LOOP;
+
+    RETURN statuses;
+END;
+$$;
+
+-- Number of poste inscriptions of every user by festival, jour and creneau
+-- A user with more than one poste for the same jour and creneau is a flexible
+-- The table is kept up to date by the trigger below on every write of the inscriptions
+CREATE TABLE flexible_slots (
+    festival_id INTEGER REFERENCES festivals(festival_id) ON DELETE CASCADE,
+    user_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
+    jour VARCHAR(255),
+    creneau VARCHAR(255),
+    nb_postes INTEGER NOT NULL,
+    PRIMARY KEY (festival_id, user_id, jour, creneau)
+);
+
+-- Index used to list and count the flexibles of a festival
+CREATE INDEX flexible_slots_flexibles_idx ON flexible_slots (festival_id, jour, creneau) WHERE nb_postes > 1;
+
+-- Function to add delta to the number of postes of a user for a jour and creneau
+CREATE OR REPLACE FUNCTION add_flexible_slot(
+    p_festival_id INTEGER,
+    p_user_id INTEGER,
+    p_jour VARCHAR,
+    p_creneau VARCHAR,
+    delta INTEGER
+)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO flexible_slots (festival_id, user_id, jour, creneau, nb_postes)
+    VALUES (p_festival_id, p_user_id, p_jour, p_creneau, delta)
+    ON CONFLICT (festival_id, user_id, jour, creneau) DO UPDATE
+    SET nb_postes = flexible_slots.nb_postes + delta;
+
+    DELETE FROM flexible_slots
+    WHERE festival_id = p_festival_id AND user_id = p_user_id AND jour = p_jour AND creneau = p_creneau AND nb_postes <= 0;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION update_flexible_slots()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') AND OLD.is_poste THEN
+        PERFORM add_flexible_slot(OLD.festival_id, OLD.user_id, OLD.jour, OLD.creneau, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.is_poste THEN
+        PERFORM add_flexible_slot(NEW.festival_id, NEW.user_id, NEW.jour, NEW.creneau, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- The updates that do not change the slot of a poste inscription (like is_present) are skipped
+CREATE TRIGGER inscriptions_flexible_slots_insert_delete
+AFTER INSERT OR DELETE ON inscriptions
+FOR EACH ROW EXECUTE FUNCTION update_flexible_slots();
+
+CREATE TRIGGER inscriptions_flexible_slots_update
+AFTER UPDATE OF festival_id, user_id, jour, creneau, is_poste ON inscriptions
+FOR EACH ROW
+WHEN ((OLD.festival_id, OLD.user_id, OLD.jour, OLD.creneau, OLD.is_poste) IS DISTINCT FROM (NEW.festival_id, NEW.user_id, NEW.jour, NEW.creneau, NEW.is_poste))
+EXECUTE FUNCTION update_flexible_slots();
+
+-- Fill the table with the inscriptions already there
+INSERT INTO flexible_slots (festival_id, user_id, jour, creneau, nb_postes)
+SELECT festival_id, user_id, jour, creneau, COUNT(*)
+FROM inscriptions
+WHERE is_poste = True
+GROUP BY festival_id, user_id, jour, creneau;
+
+-- Number of writes of the inscriptions and postes of a festival, by writer
+-- A writer is the user of the inscriptions, or 0 for the postes, so that the concurrent signups do not update the same row
+-- A plan of the auto assignment is only applied if the sum of the counts of its festival did not change
+-- The rows are never removed while the festival exists (no foreign key on the users), so the sum only grows
+CREATE TABLE festival_changes (
+    festival_id INTEGER REFERENCES festivals(festival_id) ON DELETE CASCADE,
+    user_id INTEGER,
+    changes BIGINT NOT NULL,
+    PRIMARY KEY (festival_id, user_id)
+);
+
+-- Function to count the writes of the writers of the festivals, given as the parallel arrays festival_ids and user_ids
+-- The writers take the advisory lock of the festival in shared mode, the apply of a plan takes it alone
+-- (the lock has a single bigint key, it cannot be mistaken for the locks of the slots which have two keys)
+-- The rows are counted in the order of their keys so that two writers cannot deadlock
+CREATE OR REPLACE FUNCTION add_festival_changes(festival_ids INTEGER[], user_ids INTEGER[])
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    writer RECORD;
+BEGIN
+    FOR writer IN
+        SELECT DISTINCT c.festival_id, c.user_id
+        FROM unnest(festival_ids, user_ids) AS c(festival_id, user_id)
+        WHERE c.festival_id IS NOT NULL
+        ORDER BY c.festival_id, c.user_id
+    LOOP
+        PERFORM pg_advisory_xact_lock_shared(writer.festival_id);
+        INSERT INTO festival_changes (festival_id, user_id, changes)
+        VALUES (writer.festival_id, writer.user_id, 1)
+        ON CONFLICT (festival_id, user_id) DO UPDATE
+        SET changes = festival_changes.changes + 1;
+    END LOOP;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION bump_inscriptions_changes()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    festival_ids INTEGER[];
+    user_ids INTEGER[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(festival_id), array_agg(user_id) INTO festival_ids, user_ids FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(festival_id), array_agg(user_id) INTO festival_ids, user_ids FROM old_rows;
+    ELSE
+        SELECT array_agg(festival_id), array_agg(user_id) INTO festival_ids, user_ids
+        FROM (SELECT festival_id, user_id FROM new_rows UNION SELECT festival_id, user_id FROM old_rows) AS changed;
+    END IF;
+
+    PERFORM add_festival_changes(festival_ids, user_ids);
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION bump_postes_changes()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    festival_ids INTEGER[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(festival_id) INTO festival_ids FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(festival_id) INTO festival_ids FROM old_rows;
+    ELSE
+        SELECT array_agg(festival_id) INTO festival_ids
+        FROM (SELECT festival_id FROM new_rows UNION SELECT festival_id FROM old_rows) AS changed;
+    END IF;
+
+    -- The statement triggers also run when no row was written
+    IF festival_ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+    PERFORM add_festival_changes(festival_ids, array_fill(0, ARRAY[cardinality(festival_ids)]));
+    RETURN NULL;
+END;
+$$;
+
+-- One trigger by event, as a trigger with transition tables can only have one event
+CREATE TRIGGER inscriptions_changes_insert
+AFTER INSERT ON inscriptions REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_inscriptions_changes();
+
+CREATE TRIGGER inscriptions_changes_update
+AFTER UPDATE ON inscriptions REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_inscriptions_changes();
+
+CREATE TRIGGER inscriptions_changes_delete
+AFTER DELETE ON inscriptions REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_inscriptions_changes();
+
+CREATE TRIGGER postes_changes_insert
+AFTER INSERT ON postes REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_postes_changes();
+
+CREATE TRIGGER postes_changes_update
+AFTER UPDATE ON postes REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_postes_changes();
+
+CREATE TRIGGER postes_changes_delete
+AFTER DELETE ON postes REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_postes_changes();
+
 -- DROP TABLE IF EXISTS to_changeCTE;
 -- DROP TABLE IF EXISTS new_zones;
 
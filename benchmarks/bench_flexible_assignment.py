@@ -0,0 +1,68 @@
+# Micro-benchmark of the assignment of the flexible volunteers
+# Usage: python benchmarks/bench_flexible_assignment.py [--volunteers 10000] [--postes 12]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.controllers.flexible_assignment import assign_flexibles
+from app.controllers.planning_grid import JOURS, CRENEAUX
+
+
+# Every volunteer signs up to 1 to 4 postes in every slot, half of them are flexible
+def make_slot(nb_volunteers: int, nb_postes: int):
+    fixed = [0] * nb_postes
+    choices = []
+    for _ in range(nb_volunteers):
+        postes = random.sample(range(nb_postes), random.choice([1, 1, 2, 3, 4]))
+        if len(postes) == 1:
+            fixed[postes[0]] += 1
+        else:
+            mask = 0
+            for poste in postes:
+                mask |= 1 << poste
+            choices.append(mask)
+    # Capacities around the average demand, some postes are short and some have room left
+    capacities = [max(0, random.randint(nb_volunteers // nb_postes // 2, 2 * nb_volunteers // nb_postes) - fixed[poste]) for poste in range(nb_postes)]
+    return choices, capacities
+
+
+# Previous behavior: every flexible volunteer keeps one of its postes at random
+def random_assignment(choices, capacities):
+    loads = [0] * len(capacities)
+    for mask in choices:
+        postes = [poste for poste in range(len(capacities)) if mask >> poste & 1]
+        loads[random.choice(postes)] += 1
+    return sum(max(0, load - capacity) for load, capacity in zip(loads, capacities))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--volunteers", type=int, default=10000)
+    parser.add_argument("--postes", type=int, default=12)
+    args = parser.parse_args()
+    random.seed(0)
+
+    slots = [make_slot(args.volunteers, args.postes) for _ in JOURS for _ in CRENEAUX]
+    flexibles = sum(len(choices) for choices, _ in slots)
+
+    start = time.perf_counter()
+    overflow = 0
+    for choices, capacities in slots:
+        assignment, slot_overflow = assign_flexibles(choices, capacities)
+        assert all(choices[volunteer] >> target & 1 for volunteer, target in enumerate(assignment))
+        overflow += slot_overflow
+    elapsed = (time.perf_counter() - start) * 1000
+
+    random_overflow = sum(random_assignment(choices, capacities) for choices, capacities in slots)
+    print(f"{len(slots)} slots, {args.volunteers} volunteers per slot, {flexibles} flexible inscriptions to assign")
+    print(f"max flow: {elapsed:.1f} ms, {overflow} volunteers over capacity")
+    print(f"random:   {random_overflow} volunteers over capacity")
+
+
+if __name__ == "__main__":
+    main()
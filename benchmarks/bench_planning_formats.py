@@ -0,0 +1,65 @@
+# Micro-benchmark of the formats of the planning grid of the zones benevoles
+# It compares the size and the time to build and encode the list of cells with the columnar format
+# Usage: python benchmarks/bench_planning_formats.py [--zones 300] [--inscriptions 3000]
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.controllers.planning_grid import DEFAULT_SLOTS, Occupancy, zone_target, build_zones_grid, zones_columnar_grid, encode_columnar_grid, msgpack
+
+USER_ID = 1
+
+
+def make_data(nb_zones: int, nb_inscriptions: int, nb_users: int = 5000):
+    zones = [{"festival_id": 1, "zone_plan": f"Plan {i // 10}", "zone_benevole_id": str(i), "zone_benevole": f"Zone benevole {i}"} for i in range(nb_zones)]
+    occupancy = Occupancy([zone_target(row) for row in zones], DEFAULT_SLOTS)
+    registered = set()
+    slots = list(DEFAULT_SLOTS)
+    for _ in range(nb_inscriptions):
+        zone = random.choice(zones)
+        key = (*zone_target(zone), *random.choice(slots))
+        occupancy.add(key, 1)
+        if random.randint(1, nb_users) == USER_ID:
+            registered.add(key)
+    return zones, occupancy, registered
+
+
+def measure(function, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zones", type=int, default=300)
+    parser.add_argument("--inscriptions", type=int, default=3000)
+    args = parser.parse_args()
+    random.seed(0)
+    zones, occupancy, registered = make_data(args.zones, args.inscriptions)
+
+    # The list of cells is encoded by FastAPI with the standard json module
+    formats = {
+        "cells json": lambda: json.dumps(build_zones_grid(zones, occupancy, registered)).encode(),
+        "columnar json": lambda: encode_columnar_grid(zones_columnar_grid(1, zones, occupancy, registered), "columnar")[0],
+    }
+    if msgpack is not None:
+        formats["columnar msgpack"] = lambda: encode_columnar_grid(zones_columnar_grid(1, zones, occupancy, registered), "msgpack")[0]
+
+    print(f"{args.zones} zones x {len(DEFAULT_SLOTS)} slots, {args.inscriptions} inscriptions")
+    print(f"{'format':>17} {'bytes':>9} {'ms':>7}")
+    for name, encode in formats.items():
+        print(f"{name:>17} {len(encode()):>9} {measure(encode):>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
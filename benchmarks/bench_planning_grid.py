@@ -0,0 +1,95 @@
+# Micro-benchmark of the construction of the planning grid of the zones benevoles
+# It compares the previous linear merge with the merge on the occupancy array of the cells
+# (the grid is now built by the database or by the planning cache, which keeps the counts in an array by zone and slot)
+# Usage: python benchmarks/bench_planning_grid.py [--zones 1000] [--inscriptions 10000]
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.controllers.planning_grid import JOURS, CRENEAUX, DEFAULT_SLOTS, Occupancy, zone_target, build_zones_grid
+
+USER_ID = 1
+# The linear merge takes minutes past this size
+LEGACY_MAX_ZONES = 300
+
+
+def make_data(nb_zones: int, nb_inscriptions: int, nb_users: int = 5000):
+    zones = [{"festival_id": 1, "zone_plan": f"Plan {i // 10}", "zone_benevole_id": str(i), "zone_benevole": f"Zone {i}"} for i in range(nb_zones)]
+    inscriptions = []
+    for _ in range(nb_inscriptions):
+        zone = random.choice(zones)
+        inscriptions.append((zone["zone_plan"], zone["zone_benevole_id"], zone["zone_benevole"], random.choice(JOURS), random.choice(CRENEAUX), random.randint(1, nb_users)))
+    # Rows of the GROUP BY, with the users of the previous array_agg and the is_register of the bool_or
+    users = {}
+    for plan, zone_id, name, jour, creneau, user_id in inscriptions:
+        users.setdefault((plan, zone_id, name, jour, creneau), []).append(user_id)
+    counts = []
+    for (plan, zone_id, name, jour, creneau), group in users.items():
+        counts.append({"zone_plan": plan, "zone_benevole_id": zone_id, "zone_benevole_name": name, "jour": jour, "creneau": creneau, "nb_inscriptions": len(group), "users": group, "is_register": USER_ID in group})
+    return zones, counts
+
+
+# Previous version of get_nb_inscriptions_zone_benevole, every group scans the whole grid
+def legacy_build_zones_grid(zones, counts):
+    to_send = []
+    for jour in JOURS:
+        for creneau in CRENEAUX:
+            to_send += [{"festival_id": row["festival_id"], "poste": "Animation", "zone_plan": row["zone_plan"], "zone_benevole_id": row["zone_benevole_id"], "zone_benevole_name": row["zone_benevole"], "jour": jour, "creneau": creneau, "nb_inscriptions": 0, "is_register": False, "max_capacity": 2} for row in zones]
+    for row in counts:
+        for zone_benevole in to_send:
+            if row["zone_plan"] == zone_benevole["zone_plan"] and row["zone_benevole_id"] == zone_benevole["zone_benevole_id"] and row["zone_benevole_name"] == zone_benevole["zone_benevole_name"] and row["jour"] == zone_benevole["jour"] and row["creneau"] == zone_benevole["creneau"]:
+                zone_benevole["nb_inscriptions"] = row["nb_inscriptions"]
+                if USER_ID in row["users"]:
+                    zone_benevole["is_register"] = True
+    return to_send
+
+
+# Merge on the occupancy array of the cells, as done by the planning cache
+def array_build_zones_grid(zones, counts):
+    occupancy = Occupancy([zone_target(row) for row in zones], DEFAULT_SLOTS)
+    registered = set()
+    for row in counts:
+        key = (row["zone_plan"], row["zone_benevole_id"], row["zone_benevole_name"], row["jour"], row["creneau"])
+        occupancy.add(key, row["nb_inscriptions"])
+        if row["is_register"]:
+            registered.add(key)
+    return build_zones_grid(zones, occupancy, registered)
+
+
+def measure(function, *args, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zones", type=int, default=1000)
+    parser.add_argument("--inscriptions", type=int, default=10000)
+    args = parser.parse_args()
+    random.seed(0)
+
+    print(f"{'zones':>6} {'inscriptions':>13} {'cells':>7} {'groups':>7} {'legacy ms':>10} {'array ms':>9}")
+    for nb_zones in sorted({10, 100, LEGACY_MAX_ZONES, args.zones}):
+        nb_inscriptions = args.inscriptions * nb_zones // args.zones
+        zones, counts = make_data(nb_zones, nb_inscriptions)
+        new = array_build_zones_grid(zones, counts)
+        legacy = "skipped"
+        if nb_zones <= LEGACY_MAX_ZONES:
+            assert legacy_build_zones_grid(zones, counts) == new
+            legacy = f"{measure(legacy_build_zones_grid, zones, counts, repeat=1):.1f}"
+        cells = Counter(cell["nb_inscriptions"] > 0 for cell in new)
+        print(f"{nb_zones:>6} {nb_inscriptions:>13} {len(new):>7} {cells[True]:>7} {legacy:>10} {measure(array_build_zones_grid, zones, counts):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,18 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.database.db_session import get_db
+from app.database.db_session import get_db, get_admin_db
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 
 # Load the environment variables from the .env file
 load_dotenv()
 
+from app.controllers.auth_controller import STATELESS_TOKENS
+from app.cache.token_revocations import token_revocations
+from app.cache.user_cache import user_cache
+from app.controllers.password_controller import shutdown_password_executor
+from app.cache import planning_events
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Executed on startup
@@ -14,15 +20,26 @@ async def lifespan(app: FastAPI):
     try:
         db = get_db()
         await db.connect()
+        await get_admin_db().connect()
     except Exception as e:
         print("main ERROR while connecting: ", e)
         exit(1)
     app.state.db = db
     await insert_test_data(db)
+    # Keep the revoked tokens up to date for the stateless verification
+    if STATELESS_TOKENS:
+        await token_revocations.start(db)
+    # Drop the users banned, deleted or changed by the other workers from the cache
+    await user_cache.start(db)
+    # Keep the plannings in sync with the other workers
+    await planning_events.start(db)
     yield
     # Executed on shutdown
     print("Shutdown")
+    token_revocations.stop()
+    shutdown_password_executor()
     await app.state.db.close()
+    await get_admin_db().close()
 
 
 # Create a FastAPI app
@@ -59,6 +76,7 @@ from app.routers.festival_router import festival_router
 from app.routers.referent_router import referent_router
 from app.routers.poste_router import poste_router
 from app.routers.message_router import message_router
+from app.routers.admin_router import admin_router
 
 app.include_router(user_router)
 app.include_router(auth_router)
@@ -69,6 +87,7 @@ app.include_router(festival_router)
 app.include_router(referent_router)
 app.include_router(poste_router)
 app.include_router(message_router)
+app.include_router(admin_router)
 
 
 async def insert_test_data(db):